@@ -1,11 +1,28 @@
 #!/usr/bin/env python
 
+import argparse
+import hashlib
+import multiprocessing
+import struct
 import sys
 import os
+import time
 from cpus import Opcodes
+from cpus import SymbolTable
+
+if sys.version >= '3':
+    xrange = range
+
+# One instruction word, opcode in lowest byte
+_word = struct.Struct('<I')
+
+# Bump when generated code changes, invalidates build caches
+version = 2
 
 class Assembly:
-    
+    # Data directive sizes in bytes, DT is null terminated string
+    datasizes = {'B': 1, 'W': 2, 'D': 4, 'Q': 8, 'T': 0}
+
     def __init__(self):
         self.code = []
         self.opcodes = Opcodes()
@@ -21,22 +38,6 @@ class Assembly:
 
         return data
 
-    def getLabels(self, data):
-        labels = {}
-        index = 0
-        for line in data:
-            if ':' in line:
-                tmp = line.strip().split(':')
-                if tmp:
-                    label = tmp[0]
-                    if len(tmp) > 1:
-                        val = ':'.join(tmp[1:])
-                    else:
-                        val = ''
-                    labels[label] = { 'value': val, 'line': index }
-            index += 1
-        return labels
-
     def parseImmediate(self, data):
         try:
             if '0x' in data:
@@ -56,22 +57,66 @@ class Assembly:
                 args.append(item)
         return args
 
+    def parseString(self, data):
+        """ Parse quoted strings, each string is null terminated
+
+        >>> a = Assembly()
+        >>> list(a.parseString('"Hi" "!"'))
+        [72, 105, 0, 33, 0]
+        """
+        res = bytearray()
+        string = False
+        for c in data:
+            if not string and c == '"':
+                string = True
+            elif string and c == '"':
+                res.append(0)
+                string = False
+            elif string:
+                res.append(ord(c))
+        return res
+
+    def packData(self, val, size):
+        """ Pack value as little endian bytes
+        """
+        res = bytearray()
+        while size > 0:
+            res.append(val & 0xFF)
+            val >>= 8
+            size -= 1
+        return res
+
+    def packWord(self, opcode, imm):
+        return _word.pack((opcode & 0xFF) | ((imm & 0xFFFFFF) << 8))
+
     def assemble(self, data):
-        stub = []
-        datasect = []
+        """ Assemble source lines in one pass
+
+        Label references are recorded to fixup list and patched when
+        all labels are known.
+        @param data Source lines
+        @returns Tuple (code, data, labels, base), labels map name to address
+
+        >>> a = Assembly()
+        >>> (code, data, labels, base) = a.assemble(['Bi end', 'MOV r1, 0, 1', 'end:', 'STOP', '.data', 'x: dd 5'])
+        >>> labels['end'], labels['x'], base
+        (8, 12, 12)
+        >>> list(code[:4]), list(data)
+        ([48, 8, 0, 0], [5, 0, 0, 0])
+        """
+        code = bytearray()
+        datasect = bytearray()
         labels = {}
-        pc = 0
-        dpc = 0
-        index = 0
+        fixups = []
         base = 0
         mode = 'code'
 
-        ## FIXME Goes thorough the code three times,
-        ## need a better and cleaner implementation
-        for line in data:
+        for (lineno, line) in enumerate(data):
+            lineno += 1
             line = line.strip()
+            if '#' in line:
+                line = line[:line.index('#')].strip()
             if not line:
-                index += 1
                 continue
             if line == '.code':
                 mode = 'code'
@@ -80,251 +125,136 @@ class Assembly:
                 mode = 'data'
                 continue
             elif line[:5] == '.base':
-                b = line[6:]
-                base = self.parseImmediate(b)
+                base = self.parseImmediate(line[6:].strip())
                 continue
 
-            if '#' in line:
-                pos = line.index('#')
-                line = line[:pos].strip()
             if ':' in line:
-                tmp = line.split(':')
-                if tmp:
-                    label = tmp[0]
-                    if len(tmp) > 1:
-                        line = ':'.join(tmp[1:])
-                    else:
-                        line = ''
-                    if mode == 'code':
-                        labels[label] = { 'value': line, 'line': index, 'pos': pc }
-                    elif mode == 'data':
-                        labels[label] = { 'value': line, 'line': index, 'pos': base + dpc }
-            datasize = self.wordsize
-            tmp = line.split()
-            if tmp:
-                ucmd = tmp[0].upper()
-                rest = tmp[1:]
-                if len(ucmd) == 2 and ucmd[0] == 'D':
-                    if ucmd[1] == 'B':
-                        datasize = 1
-                    elif ucmd[1] == 'W':
-                        datasize = 2
-                    elif ucmd[1] == 'D':
-                        datasize = 4
-                    elif ucmd[1] == 'Q':
-                        datasize = 8
-                    elif ucmd[1] == 'T':
-                        datasize = 0
-
-                    if datasize == 0:
-                        string = False
-                        dataval = bytearray()
-                        for c in rest:
-                            if not string and c == '"':
-                                string = True
-                            elif string and c == '"':
-                                datasize += 1
-                                dataval.append(0)
-                                string = False
-                            elif string:
-                                datasize += 1
-                                dataval.append(c)
-            tmp = line.split()
-            if tmp:
+                (label, line) = line.split(':', 1)
+                line = line.strip()
                 if mode == 'code':
-                    pc += datasize
-                elif mode == 'data':
-                    dpc += datasize
-            index += 1
-
-        if base == 0:
-            base = pc
+                    labels[label] = ('code', len(code))
+                else:
+                    labels[label] = ('data', len(datasect))
 
-        pc = 0
-        dpc = 0
-        for line in data:
-            line = line.strip()
-            if not line:
-                index += 1
-                continue
-            if line == '.code':
-                mode = 'code'
+            tmp = line.split(None, 1)
+            if not tmp:
                 continue
-            elif line == '.data':
-                mode = 'data'
-                continue
-            elif line[:5] == '.base':
+            cmd = tmp[0]
+            rest = ''
+            if len(tmp) > 1:
+                rest = tmp[1]
+
+            if cmd in self.opcodes.aliases:
+                cmd = self.opcodes.aliases[cmd]
+            ucmd = cmd.upper()
+
+            opcode = None
+            if ucmd in self.opcodes.rev_upper_opcodes:
+                opcode = self.opcodes.rev_upper_opcodes[ucmd]
+            elif len(cmd) == 2 and ucmd[0] == 'D':
+                if mode == 'data':
+                    datasect += self.dataValue(ucmd, rest, False)
+                else:
+                    pos = len(code)
+                    val = self.dataValue(ucmd, rest, True)
+                    if val is None:
+                        val = bytearray(self.datasizes.get(ucmd[1], 4))
+                        fixups.append(('data', pos, len(val), rest, lineno))
+                    code += val
                 continue
-            if '#' in line:
-                pos = line.index('#')
-                line = line[:pos].strip()
-            if ':' in line:
-                tmp = line.split(':')
-                if tmp:
-                    label = tmp[0]
-                    if len(tmp) > 1:
-                        line = ':'.join(tmp[1:])
-                    else:
-                        line = ''
-                    #if mode == 'code':
-                    #    labels[label] = { 'value': line, 'line': index, 'pos': pc }
-                    if mode == 'data':
-                        labels[label] = { 'value': line, 'line': index, 'pos': base + dpc }
-            datasize = self.wordsize
-            tmp = line.split()
-            if tmp:
-                ucmd = tmp[0].upper()
-                rest = tmp[1:]
-                if len(ucmd) == 2 and ucmd[0] == 'D':
-                    if ucmd[1] == 'B':
-                        datasize = 1
-                    elif ucmd[1] == 'W':
-                        datasize = 2
-                    elif ucmd[1] == 'D':
-                        datasize = 4
-                    elif ucmd[1] == 'Q':
-                        datasize = 8
-                    elif ucmd[1] == 'T':
-                        datasize = 0
-
-                    if datasize == 0:
-                        string = False
-                        dataval = bytearray()
-                        for c in rest:
-                            if not string and c == '"':
-                                string = True
-                            elif string and c == '"':
-                                datasize += 1
-                                dataval.append(0)
-                                string = False
-                            elif string:
-                                datasize += 1
-                                dataval.append(c)
-            tmp = line.split()
-            if tmp:
-                if mode == 'code':
-                    pc += datasize
-                elif mode == 'data':
-                    dpc += datasize
-            index += 1
+            else:
+                opcode = self.parseImmediate(cmd)
+                if type(opcode) != int:
+                    raise ValueError('Unknown instruction: %s at line %s' % (cmd, lineno))
 
-        pc = 0
-        dpc = 0
-        mode = 'code'
-        for line in data:
-            line = line.strip()
-            if not line:
-                index += 1
-                continue
-            if line == '.code':
-                mode = 'code'
-                continue
-            elif line == '.data':
-                mode = 'data'
-                continue
-            elif line[:5] == '.base':
+            # Instructions in data section are ignored
+            if mode == 'data':
                 continue
 
-            if '#' in line:
-                pos = line.index('#')
-                line = line[:pos].strip()
-            if ':' in line:
-                tmp = line.split(':')
-                if tmp:
-                    if len(tmp) > 1:
-                        line = ':'.join(tmp[1:])
-                    else:
-                        line = ''
-
-            tmp = line.split()
-            if tmp:
-                cmd = tmp[0]
-                ucmd = tmp[0].upper()
-                rest = ' '.join(tmp[1:])
-                    
-                if cmd in self.opcodes.aliases:
-                    cmd = self.opcodes.aliases[cmd]
-                    ucmd = cmd.upper()
-
-                datasize = 4
-                if ucmd in self.opcodes.rev_upper_opcodes:
-                    opcode = self.opcodes.rev_upper_opcodes[ucmd]
-                elif len(cmd) == 2 and ucmd[0] == 'D':
-                    opcode = 'data'
-                    datasize = 4
-                    if ucmd[1] == 'B':
-                        datasize = 1
-                    elif ucmd[1] == 'W':
-                        datasize = 2
-                    elif ucmd[1] == 'D':
-                        datasize = 4
-                    elif ucmd[1] == 'Q':
-                        datasize = 8
-                    elif ucmd[1] == 'T':
-                        datasize = 0
-
-                    if datasize > 0:
-                        try:
-                            if '0x' in rest:
-                                dataval = int(rest, 16)
-                            else:
-                                dataval = int(rest)
-                        except:
-                            dataval = 0
-                    else:
-                        string = False
-                        dataval = bytearray()
-                        for c in rest:
-                            if not string and c == '"':
-                                string = True
-                            elif string and c == '"':
-                                datasize += 1
-                                dataval.append(0)
-                                string = False
-                            elif string:
-                                datasize += 1
-                                dataval.append(c)
-                else:
-                    try:
-                        if '0x' in cmd:
-                            opcode = int(cmd, 16)
-                        else:
-                            opcode = int(cmd)
-                    except:
-                        opcode = 'invalid' # FIXME
-
-                if 'i' == cmd[-1]:
-                    param = self.parseImmediate(rest)
-                elif opcode == 'data':
-                    param = self.parseImmediate(rest)
-                else:
-                    param = self.parseRegs(rest)
-
-                if mode == 'code':
-                    item = {'opcode': opcode, 'params': param, 'cmd': cmd, 'pos': pc, 'datasize': datasize}
-                    stub.append(item)
-                elif mode == 'data':
-                    if opcode == 'data':
-                        item = {'size': datasize, 'pos': base + dpc, 'val': dataval}
-                        datasect.append(item)
-                    else:
-                        datasize = 0
+            pos = len(code)
+            if cmd[-1] == 'i':
+                imm = self.parseImmediate(rest)
+                if imm == '.':
+                    imm = pos
+                elif type(imm) != int:
+                    fixups.append(('imm', pos, opcode, imm, lineno))
+                    imm = 0
+                code += self.packWord(opcode, imm)
+                continue
 
-                if mode == 'code':
-                    if opcode == 'data':
-                        pc += datasize
-                    else:
-                        pc += self.wordsize
-                elif mode == 'data':
-                    dpc += datasize
-        return (stub, datasect, labels, base)
+            values = []
+            refs = []
+            for (i, reg) in enumerate(self.parseRegs(rest)):
+                if reg[0] == 'r':
+                    values.append(self.getRegister(reg))
+                    continue
+                if cmd[-1].upper() != 'I' and reg != '0' and i < 2:
+                    raise ValueError('Expected register, got: %s at line %s' % (reg, lineno))
+                imm = self.parseImmediate(reg)
+                if type(imm) != int:
+                    refs.append((i, imm))
+                    imm = 0
+                values.append(imm)
+            if refs:
+                fixups.append(('regs', pos, opcode, (values, refs), lineno))
+            code += self.packWord(opcode, self.generateRegisters(values))
 
-    def getLabel(self, name, labels):
-        for lab in labels:
-            if lab == name:
-                return labels[lab]
+        if base == 0:
+            base = len(code)
+
+        for (name, (section, pos)) in labels.items():
+            if section == 'data':
+                pos += base
+            labels[name] = pos
+
+        self.patchFixups(code, fixups, labels)
+
+        return (code, datasect, labels, base)
+
+    def dataValue(self, ucmd, rest, immediate):
+        """ Get bytes of data directive
+        @param immediate Value is parsed like instruction immediate,
+            it's masked to 24 bits and may be label
+        @returns bytearray, or None if value is label
+        """
+        size = self.datasizes.get(ucmd[1], 4)
+        if size == 0:
+            return self.parseString(rest)
+        if immediate:
+            val = self.parseImmediate(rest)
+            if type(val) != int:
+                return None
+            val &= 0xFFFFFF
+        else:
+            try:
+                if '0x' in rest:
+                    val = int(rest, 16)
+                else:
+                    val = int(rest)
+            except:
+                val = 0
+        return self.packData(val, size)
+
+    def patchFixups(self, code, fixups, labels):
+        """ Patch label references to assembled code
+        """
+        for (kind, pos, arg, ref, lineno) in fixups:
+            if kind == 'regs':
+                (values, refs) = ref
+                values = values[:]
+                # Unknown labels are zero
+                for (i, name) in refs:
+                    values[i] = labels.get(name, 0)
+                code[pos:pos + 4] = self.packWord(arg, self.generateRegisters(values))
+                continue
 
-        return None
+            if ref not in labels:
+                raise ValueError('Unknown label: %s at line %s' % (ref, lineno))
+            val = labels[ref]
+            if kind == 'imm':
+                code[pos:pos + 4] = self.packWord(arg, val)
+            elif kind == 'data':
+                code[pos:pos + arg] = self.packData(val & 0xFFFFFF, arg)
 
     def getRegister(self, name):
         num = name[1:]
@@ -338,50 +268,6 @@ class Assembly:
 
         return r
 
-    def getImmediate(self, val, labels):
-        lab = self.getLabel(val, labels)
-        if lab is not None:
-            return lab['pos']
-
-        lab = val
-        try:
-            if '0x' in lab:
-                imm = int(lab, 16)
-            else:
-                imm = int(lab)
-        except:
-            imm = 0
-
-        return imm
-
-    def solveLabels(self, stub, labels):
-        pc = 0
-        for item in stub:
-            pars = item['params']
-            if type(pars) == str:
-                lab = self.getLabel(pars, labels)
-                if lab is not None:
-                    item['params'] = lab['pos']
-                elif pars == '.':
-                    item['params'] = item['pos']
-            elif type(pars) == int:
-                pass
-            else:
-                newpars = []
-                i = 0
-                for reg in pars: 
-                    if reg[0] == 'r':
-                        reg = self.getRegister(reg)
-                        newpars.append(reg)
-                    else:
-                        if item['cmd'][-1].upper() != 'I' and reg != '0' and reg != 0 and i < 2 and reg[0] != 'r':
-                            raise ValueError('Expected register, got: %s %s' % (reg, item))
-                        imm = self.getImmediate(reg, labels)
-                        newpars.append(imm)
-                    i += 1
-                item['params'] = newpars
-        return stub
-
     def generateRegisters(self, pars):
         x = 0
         y = 0
@@ -402,129 +288,351 @@ class Assembly:
         i = (i & 0xFF) << 16
         return (x | y | i)
 
-    def generateCode(self, stub):
-        code = []
-        bytecode = []
-        for item in stub:
-            inst = item['opcode']
-            pars = item['params']
-            data = False
-            if inst == 'data':
-                data = True
-                imm = pars
-            else:
-                inst = inst & 0xFF
+    def writeFile(self, fname, code, data, base=0):
+        writeBinary(fname, Image(code, data, base).toBytes())
+
+class Image:
+    """ Assembled program
+
+    >>> image = assembleSource('''
+    ... LOADi num
+    ... STOP
+    ... .data
+    ... num: dd 42
+    ... ''')
+    >>> image.base, image.symbols['num'], len(image.code), list(bytearray(image.data))
+    (8, 8, 8, [42, 0, 0, 0])
+    >>> image.toBytes()[:4] == b'RE01'
+    True
+    >>> len(image.toBytes())
+    24
+    >>> print (image.symbolText().strip())
+    00000008 num
+    """
+    # RE01 header: magic, data section position, data base address
+    header = struct.Struct('<4sII')
+
+    def __init__(self, code, data, base=0, symbols=None):
+        self.code = bytes(code)
+        self.data = bytes(data)
+        self.base = base
+        if symbols is None:
+            symbols = {}
+        self.symbols = symbols
+
+    def toBytes(self):
+        """ Get image as RE01 binary
+        """
+        datapos = self.header.size + len(self.code)
+        return self.header.pack(b'RE01', datapos, self.base) + self.code + self.data
+
+    def symbolText(self):
+        """ Get symbols as text, one "ADDRESS label" per line
+        """
+        return SymbolTable(self.symbols).toText()
+
+def writeBinary(fname, binary):
+    if os.path.isfile(fname):
+        print ('WARNING: Overwriting %s' % fname)
+    f = open(fname, 'wb')
+    f.write(binary)
+    f.close()
+
+def assembleSource(text):
+    """ Assemble source without touching disk or stdout
+    @param text Source as string or list of lines
+    @returns Image
+    """
+    if isinstance(text, (list, tuple)):
+        lines = text
+    else:
+        lines = text.splitlines()
+    (code, data, labels, base) = Assembly().assemble(lines)
+    return Image(code, data, base, labels)
+
+class BuildCache:
+    """ On disk cache of assembled binaries keyed by source hash
+
+    Least recently used entries are removed when total size exceeds limit.
+
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> c = BuildCache(tmp, limit=40)
+    >>> c.get(c.key(b'a')) is None
+    True
+    >>> c.put(c.key(b'a'), b'x' * 16)
+    >>> c.put(c.key(b'b'), b'y' * 16)
+    >>> c.get(c.key(b'a')) == b'x' * 16
+    True
+    >>> c.put(c.key(b'c'), b'z' * 16)
+    >>> c.get(c.key(b'b')) is None
+    True
+    >>> c.get(c.key(b'a')) is not None and c.get(c.key(b'c')) is not None
+    True
+    >>> shutil.rmtree(tmp)
+    """
+    suffix = '.bin'
+
+    def __init__(self, path, limit=64*1024*1024):
+        """ Initialize cache
+        @param path Cache directory, created when needed
+        @param limit Maximum total size of cached binaries in bytes
+        """
+        self.path = path
+        self.limit = limit
+        # Total size of entries, solved on first write
+        self.total = None
+        # Last use time given to entry, file system clock may be coarse
+        self.stamp = 0
+
+    def key(self, source):
+        """ Get cache key for source bytes
+        """
+        h = hashlib.sha1()
+        h.update(('%s:' % (version)).encode('ascii'))
+        h.update(source)
+        return h.hexdigest()
+
+    def entryPath(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def entries(self):
+        """ Get cached entries as (path, size, mtime)
+        """
+        res = []
+        if not os.path.isdir(self.path):
+            return res
+        for name in os.listdir(self.path):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            res.append((path, st.st_size, st.st_mtime))
+        return res
 
-                if type(pars) == list:
-                    imm = self.generateRegisters(pars)
-                else:
-                    imm = pars
-
-            imm = imm & 0xFFFFFF
-            if inst == 'data':
-                immcode = []
-                code.append(imm)
-                size = item['datasize']
-                while size > 0:
-                    immcode.append(imm & 0xFF)
-                    imm >>= 8
-                    size -= 1
-            else:
-                imm <<= 8
-                bytecode.append(inst)
-                code.append(inst | imm)
-                immcode = []
-                imm >>= 8
-                for i in xrange(self.wordsize-1):
-                    immcode.append(imm & 0xFF)
-                    imm >>= 8
-            bytecode += immcode
-        return (code, bytecode)
-
-    def generateData(self, data):
-        bindata = bytearray()
-        for item in data:
-            val = item['val']
-            size = item['size']
-            if type(val) != bytearray:
-                newval = bytearray()
-                while size > 0:
-                    newval.append(val & 0xFF)
-                    val >>= 8
-                    size -= 1
-                val = newval
-            bindata = bindata + val
-            
-        return bindata
+    def get(self, key):
+        """ Get cached binary, or None if not cached
+        """
+        path = self.entryPath(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        data = f.read()
+        f.close()
+        self.touch(path)
+        return data
 
-    def writeFile(self, fname, code, data, base=0):
-        if os.path.isfile(fname):
-            print ('WARNING: Overwriting %s' % fname)
-        
-        arr = bytearray()
-        for opcode in code:
-            arr.append(opcode)
-
-        header_size = 12
-        datapos = len(arr) + header_size
-
-        header = bytearray()
-        header.append('R')
-        header.append('E')
-        header.append('0')
-        header.append('1')
-        tmp = datapos
-        for i in xrange(4):
-            header.append(tmp & 0xFF)
-            tmp >>= 8
-        tmp = base
-        for i in xrange(4):
-            header.append(tmp & 0xFF)
-            tmp >>= 8
-        f = open(fname, 'wb')
-        f.write(header)
-        f.write(arr)
+    def touch(self, path):
+        """ Mark entry used, modification time tracks last use
+        """
+        self.stamp = max(time.time(), self.stamp + 0.001)
+        os.utime(path, (self.stamp, self.stamp))
+
+    def put(self, key, data):
+        """ Store binary to cache and evict old entries
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        if self.total is None:
+            self.total = sum([size for (path, size, mtime) in self.entries()])
+        path = self.entryPath(key)
+        if os.path.isfile(path):
+            self.total -= os.path.getsize(path)
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        f = open(tmp, 'wb')
         f.write(data)
         f.close()
-
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print ('Usage: %s file.asm [outfile]' % sys.argv[0])
-        sys.exit(1)
-    
-    fname = sys.argv[1]
+        os.rename(tmp, path)
+        self.touch(path)
+        self.total += len(data)
+        if self.total > self.limit:
+            self.evict()
+
+    def evict(self):
+        """ Remove least recently used entries until cache fits to limit
+        """
+        entries = sorted(self.entries(), key=lambda item: item[2])
+        total = sum([size for (path, size, mtime) in entries])
+        while entries and total > self.limit:
+            (path, size, mtime) = entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self.total = total
+
+def buildBinary(source, cache=None):
+    """ Assemble source to RE01 binary, reusing cached binary if possible
+    @param source Source as bytes
+    @param cache BuildCache or None
+    @returns Tuple (binary, image), image is None when binary came from cache
+    """
+    key = None
+    if cache is not None:
+        key = cache.key(source)
+        binary = cache.get(key)
+        if binary is not None:
+            return (binary, None)
+
+    image = assembleSource(source.decode('utf-8'))
+    binary = image.toBytes()
+    if cache is not None:
+        cache.put(key, binary)
+    return (binary, image)
+
+def buildSymbols(source, image=None, cache=None):
+    """ Get symbol file contents for source, reusing cache if possible
+    @param source Source as bytes
+    @param image Already assembled Image or None
+    @param cache BuildCache or None
+    @returns Symbol text as bytes
+    """
+    key = None
+    if cache is not None:
+        key = cache.key(b'symbols:' + source)
+        if image is None:
+            text = cache.get(key)
+            if text is not None:
+                return text
+    if image is None:
+        image = assembleSource(source.decode('utf-8'))
+    text = image.symbolText().encode('utf-8')
+    if cache is not None:
+        cache.put(key, text)
+    return text
+
+def symbolName(ofname):
+    """ Get symbol file name for binary, .bin extension is replaced
+    """
+    return os.path.splitext(ofname)[0] + '.sym'
+
+def assembleJob(job):
+    """ Assemble one file to output file, errors are returned not raised
+    @param job Tuple (source file, output file, cache directory, cache size, write symbols)
+    @returns Tuple (source file, cached, error message or None)
+    """
+    (fname, ofname, cachedir, cachesize, symbols) = job
+    cache = None
+    if cachedir is not None:
+        cache = BuildCache(cachedir, cachesize)
+    try:
+        f = open(fname, 'rb')
+        source = f.read()
+        f.close()
+        (binary, image) = buildBinary(source, cache)
+        f = open(ofname, 'wb')
+        f.write(binary)
+        f.close()
+        if symbols:
+            f = open(symbolName(ofname), 'wb')
+            f.write(buildSymbols(source, image, cache))
+            f.close()
+    except Exception as e:
+        return (fname, False, '%s' % (e))
+    return (fname, image is None, None)
+
+def assembleMany(fnames, outdir, jobs=None, cachedir=None, cachesize=64*1024*1024, symbols=False):
+    """ Assemble files in parallel to output directory
+    Output file is named after source, with .bin extension
+    @param jobs Number of worker processes, default is CPU count
+    @param symbols Write also symbol file with .sym extension
+    @returns List of (source file, cached, error message or None)
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    work = []
+    for fname in fnames:
+        name = os.path.splitext(os.path.basename(fname))[0]
+        work.append((fname, os.path.join(outdir, name + '.bin'), cachedir, cachesize, symbols))
+
+    if jobs == 1 or len(work) < 2:
+        return [assembleJob(job) for job in work]
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(assembleJob, work)
+    finally:
+        pool.close()
+        pool.join()
+
+def main():
+    parser = argparse.ArgumentParser(description='Assemble RE01 binary')
+    parser.add_argument('source', nargs='+', help='Assembly source file, or files with -d')
+    parser.add_argument('-d', '--outdir', default=None, help='Assemble all sources to this directory')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes with -d, default is CPU count')
+    parser.add_argument('-c', '--cache', default=None, help='Build cache directory')
+    parser.add_argument('--cache-size', type=int, default=64*1024*1024, help='Build cache size limit in bytes')
+    parser.add_argument('-s', '--symbols', action='store_true', help='Write symbol file next to output, with .sym extension')
+    args = parser.parse_args()
+
+    if args.outdir is not None:
+        failed = 0
+        for (fname, cached, error) in assembleMany(args.source, args.outdir, args.jobs, args.cache, args.cache_size, args.symbols):
+            if error is not None:
+                failed += 1
+                sys.stderr.write('%s: %s\n' % (fname, error))
+            elif cached:
+                print ('Cached: %s' % (fname))
+            else:
+                print ('Assembled: %s' % (fname))
+        if failed:
+            sys.exit(1)
+        return
+
+    if len(args.source) > 2:
+        parser.error('Give output directory with -d to assemble multiple files')
+    fname = args.source[0]
     ofname = None
-    if len(sys.argv) > 2:
-        ofname = sys.argv[2]
-
-    ass = Assembly()
-    data = ass.readfile(fname)
-    if data is None:
+    if len(args.source) > 1:
+        ofname = args.source[1]
+    if args.symbols and ofname is None:
+        parser.error('Give output file to write symbols')
+
+    try:
+        f = open(fname, 'rb')
+        source = f.read()
+        f.close()
+    except IOError:
         print ('Can\'t read file: %s' % (fname))
         sys.exit(1)
 
-    (stub, data, labels, base) = ass.assemble(data)
-    print labels
-    print base
-    print data
-    stub = ass.solveLabels(stub, labels)
-    print (stub)
-    (code, bytecode) = ass.generateCode(stub)
-    (bindata) = ass.generateData(data)
-    if ofname is not None:
+    cache = None
+    if args.cache is not None:
+        cache = BuildCache(args.cache, args.cache_size)
+
+    if cache is not None:
+        (binary, image) = buildBinary(source, cache)
+    else:
+        image = assembleSource(source.decode('utf-8'))
+        binary = image.toBytes()
+
+    if image is None:
+        print ('Cached: %s' % (fname))
+    else:
+        print (image.symbols)
+        print (image.base)
         print ("Code:")
-        for c in code:
-            print ("%.8x" % c)
+        for i in xrange(0, len(image.code) - 3, 4):
+            print ("%.8x" % _word.unpack_from(image.code, i))
         print ("Data:")
         binstr = ''
         i = 0
-        for c in bindata:
-            binstr += '%.2x ' % c 
+        for c in bytearray(image.data):
+            binstr += '%.2x ' % c
             i += 1
             if i % 16 == 0:
                 binstr += '\n'
         print (binstr)
-        ass.writeFile(ofname, bytecode, bindata, base)
-    else:
-        print stub
-        print code
+
+    if ofname is not None:
+        writeBinary(ofname, binary)
+        if args.symbols:
+            writeBinary(symbolName(ofname), buildSymbols(source, image, cache))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import json
+import multiprocessing
+import sys
+import time
+
+from cpus import RunResult
+from runner import fileLoad
+from runner import setupMachine
+
+# Cycles run between wall time checks
+slice_cycles = 100000
+
+def runJob(job):
+    """ Run one binary until it stops or a limit is hit
+    @param job Tuple (file name, cycle limit, wall time limit in seconds, translate)
+    @returns Result dictionary
+    """
+    (fname, cycles, timeout, translate) = job
+    res = {'file': fname}
+    image = fileLoad(fname)
+    if image is None:
+        res['reason'] = 'invalid'
+        res['error'] = 'Not a RE01 binary'
+        return res
+
+    (cpu, term, clock) = setupMachine(*image, echo=False)
+    if translate:
+        cpu.enableTranslation()
+
+    start = time.time()
+    reason = RunResult.BUDGET
+    error = None
+    while True:
+        budget = slice_cycles
+        if cycles is not None:
+            budget = min(budget, cycles - cpu.cycle)
+            if budget <= 0:
+                break
+        result = cpu.run(cycles=budget)
+        reason = result.reason
+        if result.error is not None:
+            error = repr(result.error)
+        if reason != RunResult.BUDGET:
+            break
+        if timeout is not None and time.time() - start >= timeout:
+            reason = 'timeout'
+            break
+    clock.stop()
+
+    lines = [line.rstrip() for line in term.getLines()]
+    while lines and not lines[-1]:
+        lines.pop()
+
+    res['reason'] = reason
+    res['error'] = error
+    res['instructions'] = cpu.instret
+    res['cycles'] = cpu.cycle
+    res['time'] = round(time.time() - start, 6)
+    res['pc'] = cpu.regs[cpu.pc]
+    res['regs'] = cpu.regs[:cpu.reg_cnt]
+    res['terminal'] = lines
+    return res
+
+def safeRunJob(job):
+    """ Run job, report unexpected errors as result instead of failing the pool
+    """
+    try:
+        return runJob(job)
+    except Exception as e:
+        return {'file': job[0], 'reason': 'error', 'error': repr(e)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Run RE01 binaries in parallel, print results as JSON lines')
+    parser.add_argument('files', nargs='+', help='Binaries or glob patterns')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes, default is CPU count')
+    parser.add_argument('-c', '--cycles', type=int, default=None, help='Cycle limit per binary')
+    parser.add_argument('-t', '--timeout', type=float, default=None, help='Wall time limit per binary in seconds')
+    parser.add_argument('-x', '--translate', action='store_true', help='Run with basic block translation')
+    parser.add_argument('-o', '--output', default=None, help='Write results to file instead of stdout')
+    args = parser.parse_args()
+
+    fnames = []
+    for item in args.files:
+        matches = sorted(glob.glob(item))
+        if matches:
+            fnames += matches
+        else:
+            fnames.append(item)
+
+    jobs = [(fname, args.cycles, args.timeout, args.translate) for fname in fnames]
+
+    if args.output is None:
+        out = sys.stdout
+    else:
+        out = open(args.output, 'w')
+
+    failed = 0
+    pool = multiprocessing.Pool(args.jobs)
+    try:
+        for res in pool.imap(safeRunJob, jobs):
+            if res['reason'] not in (RunResult.STOPPED, ):
+                failed += 1
+            out.write(json.dumps(res, sort_keys=True) + '\n')
+            out.flush()
+    finally:
+        pool.close()
+        pool.join()
+        if out is not sys.stdout:
+            out.close()
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
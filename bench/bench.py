@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+import argparse
+import fnmatch
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import micro
+import macro
+
+if sys.version >= '3':
+    xrange = range
+
+# Bump when benchmarks change so that old baselines are not compared
+version = 1
+
+def runBenchmark(bench, scale, repeat):
+    """ Run benchmark several times, keep best and median time
+    @param bench Function returning run function for scale
+    @param repeat Number of timed runs
+    @returns Tuple (units, best seconds, median seconds)
+    """
+    run = bench(scale)
+    times = []
+    units = 0
+    for i in xrange(repeat):
+        gc.collect()
+        (units, elapsed) = run()
+        times.append(elapsed)
+    times.sort()
+    return (units, times[0], times[len(times) // 2])
+
+def selectBenchmarks(patterns):
+    res = []
+    for item in micro.benchmarks + macro.benchmarks:
+        if not patterns or [p for p in patterns if fnmatch.fnmatch(item[0], p)]:
+            res.append(item)
+    return res
+
+def runAll(items, repeat, factor=1.0, out=None):
+    """ Run benchmarks
+    @param factor Multiplier for default scale
+    @returns Result dictionary
+    """
+    results = {}
+    for (name, unit, scale, bench) in items:
+        scale = max(1, int(scale * factor))
+        (units, best, median) = runBenchmark(bench, scale, repeat)
+        rate = 0.0
+        if best > 0:
+            rate = units / best
+        results[name] = {
+            'unit': unit,
+            'units': units,
+            'best': round(best, 6),
+            'median': round(median, 6),
+            'rate': round(rate, 1),
+            }
+        if out is not None:
+            out.write('%-28s %14.1f %s/s  best %.4fs  median %.4fs\n' % (name, rate, unit, best, median))
+            out.flush()
+
+    return {
+        'version': version,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'scale': factor,
+        'results': results,
+        }
+
+def compare(current, baseline, threshold):
+    """ Compare rates against baseline
+    @param threshold Allowed slowdown as fraction, 0.1 is 10%
+    @returns Tuple (report lines, regressed benchmark names)
+    """
+    lines = []
+    regressed = []
+    if baseline.get('version') != current.get('version'):
+        lines.append('Baseline is from different benchmark version, not comparing')
+        return (lines, regressed)
+    if baseline.get('scale') != current.get('scale'):
+        lines.append('WARNING: Baseline was run with scale %s' % (baseline.get('scale')))
+
+    lines.append('%-28s %14s %14s %8s' % ('Benchmark', 'Baseline', 'Current', 'Change'))
+    for name in sorted(current['results']):
+        cur = current['results'][name]
+        base = baseline['results'].get(name, None)
+        if base is None or not base['rate']:
+            lines.append('%-28s %14s %14.1f %8s' % (name, '-', cur['rate'], 'new'))
+            continue
+        change = (cur['rate'] - base['rate']) / base['rate']
+        mark = ''
+        if change < -threshold:
+            mark = '  REGRESSION'
+            regressed.append(name)
+        lines.append('%-28s %14.1f %14.1f %+7.1f%%%s' % (name, base['rate'], cur['rate'], change * 100, mark))
+    return (lines, regressed)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run emulator benchmarks')
+    parser.add_argument('patterns', nargs='*', help='Run only benchmarks matching these glob patterns')
+    parser.add_argument('-l', '--list', action='store_true', help='List benchmarks')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Timed runs per benchmark, best one counts')
+    parser.add_argument('-s', '--scale', type=float, default=1.0, help='Multiplier for benchmark sizes')
+    parser.add_argument('-o', '--output', default=None, help='Write results as JSON, use as baseline later')
+    parser.add_argument('-b', '--baseline', default=None, help='Compare against earlier results')
+    parser.add_argument('-t', '--threshold', type=float, default=10.0, help='Allowed slowdown against baseline in percent')
+    args = parser.parse_args()
+
+    items = selectBenchmarks(args.patterns)
+    if args.list:
+        for (name, unit, scale, bench) in items:
+            print ('%-28s %10d %s' % (name, scale, unit))
+        return
+    if not items:
+        parser.error('No benchmarks match')
+
+    baseline = None
+    if args.baseline is not None:
+        f = open(args.baseline, 'r')
+        baseline = json.load(f)
+        f.close()
+
+    current = runAll(items, max(1, args.repeat), args.scale, sys.stdout)
+
+    if args.output is not None:
+        f = open(args.output, 'w')
+        f.write(json.dumps(current, sort_keys=True, indent=2) + '\n')
+        f.close()
+
+    if baseline is not None:
+        (lines, regressed) = compare(current, baseline, args.threshold / 100.0)
+        print ('')
+        for line in lines:
+            print (line)
+        if regressed:
+            print ('%d benchmarks slower than baseline by more than %s%%' % (len(regressed), args.threshold))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import sys
+import time
+
+from cpus import RunResult
+from assembler import assembleSource
+from runner import imageMachine
+
+if sys.version >= '3':
+    xrange = range
+
+timer = getattr(time, 'perf_counter', time.time)
+
+def loopSource(count):
+    """ Tight arithmetic loop
+    """
+    return '''
+.code
+    LOADi count
+    MOV r1, r0
+    MOV r2, 0, 0
+    MOV r3, 0, 0
+loop:
+    ADD r2, 0, 3
+    SUB r1, 0, 1
+    BE r1, r3, 4
+    Bi loop
+    STOP
+.data
+count: dd %d
+''' % (count)
+
+def loopCheck(cpu, image, count):
+    return cpu.regs[2] == (count * 3) & 0xFFFFFFFF
+
+def memcpySource(count, words=1024):
+    """ Copy block of words count times
+    """
+    src = '\n'.join(['    dd %d' % (i) for i in xrange(words)])
+    dst = '\n'.join(['    dd 0'] * words)
+    return '''
+.code
+    LOADi reps
+    MOV r4, r0
+    MOV r3, 0, 0
+outer:
+    LOADi words
+    MOV r5, r0
+    LOADADDRi src
+    MOV r6, r0
+    LOADADDRi dst
+    MOV r7, r0
+copy:
+    LOAD32 r8, r6
+    STORE32 r7, r8
+    ADD r6, 0, 4
+    ADD r7, 0, 4
+    SUB r5, 0, 1
+    BE r5, r3, 4
+    Bi copy
+    SUB r4, 0, 1
+    BE r4, r3, 4
+    Bi outer
+    STOP
+# Keep data off code pages
+.base 0x10000
+.data
+reps: dd %d
+words: dd %d
+src:
+%s
+dst:
+%s
+''' % (max(1, count // words), words, src, dst)
+
+def memcpyCheck(cpu, image, count, words=1024):
+    last = image.symbols['dst'] + (words - 1) * 4
+    return cpu.mmu.getData(last, 4) == words - 1
+
+def recursionSource(count, depth=32):
+    """ Recursive subroutine calls, return address saved on stack
+    """
+    return '''
+.code
+    LOADADDRi stacktop
+    MOV r31, r0
+    MOV r2, 0, 0
+    MOV r3, 0, 0
+    LOADi reps
+    MOV r4, r0
+outer:
+    LOADi depth
+    MOV r1, r0
+    BSUBi func
+    # BSUB returns over the next instruction
+    MOV r0, r0
+    SUB r4, 0, 1
+    BE r4, r3, 4
+    Bi outer
+    STOP
+func:
+    PUSH 0, r32
+    BE r1, r3, 16
+    SUB r1, 0, 1
+    BSUBi func
+    MOV r0, r0
+    ADD r2, 0, 1
+    POP 0, r32
+    BRET
+# Stack grows down from here
+.base 0x10000
+.data
+stacktop:
+reps: dd %d
+depth: dd %d
+''' % (max(1, count // depth), depth)
+
+def recursionCheck(cpu, image, count, depth=32):
+    return cpu.regs[2] == max(1, count // depth) * depth
+
+def interruptSource(count):
+    """ Busy loop interrupted by timer every few instructions
+    """
+    return '''
+.code
+    Bi start
+    Bi timer
+    Bi .
+    Bi .
+start:
+    LOADi ticks
+    MOV r4, r0
+    MOV r1, 0, 0
+    MOV r2, 0, 0
+    SETI
+loop:
+    ADD r1, 0, 1
+    BE r2, r4, 4
+    Bi loop
+    STOP
+timer:
+    ADD r2, 0, 1
+    IRET
+.data
+ticks: dd %d
+''' % (count)
+
+def interruptCheck(cpu, image, count):
+    return cpu.regs[2] == count
+
+def interruptSetup(cpu, clock):
+    # Timer fires about every eight instructions
+    clock.cycles = 50
+    clock.start(cpu.cycle)
+    cpu.updateEvents()
+
+def guest(source, check, translate=False, setup=None):
+    """ Benchmark guest program, instructions per second
+    @param source Function returning source for scale
+    @param check Function (cpu, image, scale) validating result
+    @param translate Run with basic block translation
+    @param setup Function (cpu, clock) called before run
+    """
+    def bench(scale):
+        image = assembleSource(source(scale))
+        def run():
+            (cpu, term, clock) = imageMachine(image, echo=False)
+            if setup is not None:
+                setup(cpu, clock)
+            if translate:
+                cpu.enableTranslation()
+            start = timer()
+            res = cpu.run()
+            elapsed = timer() - start
+            clock.stop()
+            if res.reason != RunResult.STOPPED:
+                raise RuntimeError('Guest did not stop: %s' % (res))
+            if not check(cpu, image, scale):
+                raise RuntimeError('Guest gave wrong result')
+            return (cpu.instret, elapsed)
+        return run
+    return bench
+
+# Name, unit, default scale, benchmark
+benchmarks = []
+for (name, scale, source, check, setup) in (
+        ('loop', 100000, loopSource, loopCheck, None),
+        ('memcpy', 50000, memcpySource, memcpyCheck, None),
+        ('recursion', 30000, recursionSource, recursionCheck, None),
+        ('interrupt', 5000, interruptSource, interruptCheck, interruptSetup),
+        ):
+    benchmarks.append(('guest.%s.interp' % (name), 'instructions', scale, guest(source, check, False, setup)))
+    benchmarks.append(('guest.%s.translate' % (name), 'instructions', scale, guest(source, check, True, setup)))
@@ -0,0 +1,204 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from primitives import ALU
+from primitives import Mem
+from primitives import MMU
+from assembler import Image
+from assembler import assembleSource
+from runner import fileLoad
+from runner import setupMachine
+
+if sys.version >= '3':
+    xrange = range
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Fixed seed, every run touches same addresses
+seed = 1234
+
+def addresses(count, limit, align=4):
+    rnd = random.Random(seed)
+    return [rnd.randrange(0, limit // align) * align for i in xrange(count)]
+
+def memGetData(scale):
+    """ Mem.getData of 32 bit words at random addresses
+    @param scale Number of operations
+    """
+    def run():
+        m = Mem(1024*1024, flat=True)
+        addrs = addresses(scale, m.getSize())
+        get = m.getData
+        start = timer()
+        for pos in addrs:
+            get(pos, 4)
+        return (scale, timer() - start)
+    return run
+
+def memGetDataSparse(scale):
+    """ Mem.getData on sparse paged memory
+    """
+    def run():
+        m = Mem(1024*1024)
+        addrs = addresses(scale, m.getSize())
+        for pos in addrs[:256]:
+            m.setData(pos, pos, 4)
+        get = m.getData
+        start = timer()
+        for pos in addrs:
+            get(pos, 4)
+        return (scale, timer() - start)
+    return run
+
+def memSetData(scale):
+    """ Mem.setData of 32 bit words at random addresses
+    """
+    def run():
+        m = Mem(1024*1024, flat=True)
+        addrs = addresses(scale, m.getSize())
+        put = m.setData
+        start = timer()
+        for pos in addrs:
+            put(pos, pos, 4)
+        return (scale, timer() - start)
+    return run
+
+def pagedMMU(pages):
+    """ Get MMU with given number of 4k pages mapped from virtual 1M onwards
+    """
+    tablepos = pages * 0x1000
+    m = Mem(tablepos + pages * 4, flat=True)
+    for i in xrange(pages):
+        m.setData(tablepos + i * 4, (0x100000 + i * 0x1000) | 0x100, 4)
+    u = MMU(m)
+    if len(u.initialize(tablepos, pages)) != pages:
+        raise RuntimeError('Page table not read completely')
+    u.enable()
+    return u
+
+def mmuGetData(paging):
+    """ MMU.getData of 32 bit words, as seen by CPU
+    @param paging Translate through 32 mapped pages
+    """
+    def bench(scale):
+        def run():
+            if paging:
+                u = pagedMMU(32)
+                addrs = [0x100000 + pos for pos in addresses(scale, 32 * 0x1000)]
+            else:
+                u = MMU(Mem(1024*1024, flat=True))
+                addrs = addresses(scale, 1024*1024)
+            get = u.getData
+            start = timer()
+            for pos in addrs:
+                get(pos, 4)
+            return (scale, timer() - start)
+        return run
+    return bench
+
+def mmuVirtToPhysPaged(pages):
+    """ MMU.virtToPhys with paging enabled
+    @param pages Number of mapped pages, more than TLB size causes misses
+    """
+    def bench(scale):
+        def run():
+            u = pagedMMU(pages)
+            addrs = [0x100000 + pos for pos in addresses(scale, pages * 0x1000)]
+            solve = u.virtToPhys
+            start = timer()
+            for pos in addrs:
+                solve(pos)
+            return (scale, timer() - start)
+        return run
+    return bench
+
+def aluOps(scale):
+    """ Mix of ALU operations, each counts as one operation
+    """
+    def run():
+        a = ALU()
+        rnd = random.Random(seed)
+        values = [(rnd.randrange(0, 0xFFFFFFFF), rnd.randrange(1, 0xFFFF)) for i in xrange(256)]
+        ops = (a.add3, a.sub3, a.mul3, a.div3, a.mod3)
+        rounds = max(1, scale // (len(values) * (len(ops) + 3)))
+        start = timer()
+        for i in xrange(rounds):
+            for (x, y) in values:
+                for op in ops:
+                    op(x, y, 1)
+                a.and32(x, y)
+                a.shl32(x, y & 31)
+                a.not32(x)
+        return (rounds * len(values) * (len(ops) + 3), timer() - start)
+    return run
+
+def generatedSource(lines):
+    """ Generate assembly source of about given number of lines
+    """
+    res = ['.code']
+    for i in xrange(lines // 8):
+        res.append('label%d:' % (i))
+        res.append('\tMOV r1, 0, %d' % (i & 0xFF))
+        res.append('\tADD r2, r1, 3')
+        res.append('\tLOADi value%d' % (i % 64))
+        res.append('\tSTORE32 r3, r2')
+        res.append('\tBE r1, r2, 4')
+        res.append('\tBi label%d' % (i // 2))
+        res.append('\tSHL r2, 0, 1')
+    res.append('\tSTOP')
+    res.append('.data')
+    for i in xrange(64):
+        res.append('value%d: dd %d' % (i, i))
+    return '\n'.join(res)
+
+def assemblerLines(scale):
+    """ Assembler throughput, lines per second
+    """
+    def run():
+        source = generatedSource(scale)
+        count = len(source.splitlines())
+        start = timer()
+        assembleSource(source)
+        return (count, timer() - start)
+    return run
+
+def loaderBytes(scale):
+    """ Load RE01 image from file to memory, bytes per second
+    @param scale Image size in bytes
+    """
+    def run():
+        tmp = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmp, 'image.bin')
+            image = Image(bytearray(4096), bytearray(scale), 0x10000)
+            binary = image.toBytes()
+            f = open(fname, 'wb')
+            f.write(binary)
+            f.close()
+            start = timer()
+            (code, data, base) = fileLoad(fname)
+            (cpu, term, clock) = setupMachine(code, data, base, echo=False)
+            elapsed = timer() - start
+            clock.stop()
+            return (len(binary), elapsed)
+        finally:
+            shutil.rmtree(tmp)
+    return run
+
+# Name, unit, default scale, benchmark
+benchmarks = [
+    ('mem.getData', 'ops', 200000, memGetData),
+    ('mem.getData.sparse', 'ops', 200000, memGetDataSparse),
+    ('mem.setData', 'ops', 200000, memSetData),
+    ('mmu.getData.off', 'ops', 200000, mmuGetData(False)),
+    ('mmu.getData.on', 'ops', 200000, mmuGetData(True)),
+    ('mmu.virtToPhys.tlb', 'ops', 200000, mmuVirtToPhysPaged(32)),
+    ('mmu.virtToPhys.miss', 'ops', 200000, mmuVirtToPhysPaged(512)),
+    ('alu.ops', 'ops', 400000, aluOps),
+    ('asm.lines', 'lines', 20000, assemblerLines),
+    ('load.image', 'bytes', 8*1024*1024, loaderBytes),
+    ]
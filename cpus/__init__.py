@@ -3,6 +3,13 @@ import sys
 sys.path.append(os.path.dirname(__file__))
 
 from risc1 import RISC1
+from risc1 import RunResult
 from opcodes import Opcodes
+from translator import BlockTranslator
+from profiler import OpcodeProfiler
+from profiler import PCProfiler
+from symbols import SymbolTable
+from tracer import TraceRecorder
+from memstats import MemStats
 
-__all__ = [ "RISC1", "Opcodes" ]
+__all__ = [ "RISC1", "RunResult", "Opcodes", "BlockTranslator", "OpcodeProfiler", "PCProfiler", "SymbolTable", "TraceRecorder", "MemStats" ]
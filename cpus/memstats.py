@@ -0,0 +1,370 @@
+import json
+import sys
+
+from primitives import VirtualClock
+
+if sys.version >= '3':
+    xrange = range
+
+class MemStats:
+    """ Count memory accesses per page, and sample working set size
+
+    Reads, writes, instruction fetches and memory mapped IO hits are
+    counted by physical page, TLB hits and misses by virtual page.
+    Counting is hooked to CPU, MMU and memory only while attached.
+
+    >>> from assembler import assembleSource
+    >>> from runner import imageMachine
+    >>> image = assembleSource('''
+    ... LOADi num
+    ... STOREi num
+    ... STOREi 0x8000
+    ... STOP
+    ... .base 0x2000
+    ... .data
+    ... num: dd 65
+    ... ''')
+    >>> (cpu, term, clock) = imageMachine(image, echo=False)
+    >>> s = MemStats(interval=8, cpu=cpu)
+    >>> cpu.run()
+    stopped: instructions=4, cycles=17, pc=00000010
+    >>> s.detach()
+    >>> for row in s.rows():
+    ...     print (row)
+    (0, 0, 0, 4, 0)
+    (2, 1, 1, 0, 0)
+    (8, 0, 1, 0, 1)
+    >>> s.samples
+    [(10, 2), (17, 2)]
+    >>> s.summary()['footprint']['4k']
+    12288
+    >>> print (s.toCSV().splitlines()[1])
+    0x00000000,0,0,4,0
+
+    With MMU virtual page 0x10 is at physical page 0:
+
+    >>> cpu.mem.setData(0x1000, 0x00010100, 4)
+    >>> tmp = cpu.mmu.initialize(0x1000, 1)
+    >>> cpu.mmu.enable()
+    >>> s = MemStats(cpu=cpu)
+    >>> cpu.mmu.getData(0x10004, 4) == cpu.mem.getData(4, 4)
+    True
+    >>> cpu.mmu.getData(0x10008, 4) == cpu.mem.getData(8, 4)
+    True
+    >>> s.detach()
+    >>> s.rows()
+    [(0, 2, 0, 0, 0)]
+    >>> s.tlbRows()
+    [(16, 1, 1)]
+    >>> print (s.toCSV())
+    page,reads,writes,fetches,mmio
+    0x00000000,2,0,0,0
+    <BLANKLINE>
+    vpage,tlb_hits,tlb_misses
+    0x00010000,1,1
+    <BLANKLINE>
+
+    Only accesses hitting device are MMIO, not all on its page.
+    Several statistics can be attached at once:
+
+    >>> image = assembleSource('''
+    ... LOADi num
+    ... STOREi num
+    ... STOP
+    ... .base 0x8800
+    ... .data
+    ... num: dd 65
+    ... ''')
+    >>> (cpu, term, clock) = imageMachine(image, echo=False)
+    >>> a = MemStats(cpu=cpu)
+    >>> b = MemStats(cpu=cpu)
+    >>> b.detach()
+    >>> a.detach()
+    >>> 'translate' in cpu.mmu.__dict__ or 'fetchDecoded' in cpu.__dict__
+    False
+    >>> a = MemStats(cpu=cpu)
+    >>> b = MemStats(cpu=cpu)
+    >>> a.detach()
+    >>> cpu.run()
+    stopped: instructions=3, cycles=12, pc=0000000C
+    >>> b.detach()
+    >>> b.rows()
+    [(0, 0, 0, 3, 0), (8, 1, 1, 0, 0)]
+    >>> a.rows()
+    []
+    """
+    READS = 0
+    WRITES = 1
+    FETCHES = 2
+    MMIO = 3
+    columns = ('reads', 'writes', 'fetches', 'mmio')
+    # Counters of virtual pages
+    TLB_HITS = 0
+    TLB_MISSES = 1
+    tlbcolumns = ('tlb_hits', 'tlb_misses')
+
+    _pagesize = 0x1000
+    _pageshift = 12
+    # Page sizes of MMU entries
+    pagesizes = (('4k', 0x1000), ('64k', 0x10000), ('1M', 0x100000), ('64M', 0x4000000))
+
+    def __init__(self, interval=None, cpu=None):
+        """ Initialize statistics
+        @param interval Sample working set every this many cycles, None to disable
+        @param cpu CPU to attach to
+        """
+        self.interval = interval
+        self.cpu = None
+        self.timer = None
+        self.hooked = []
+        self.reset()
+        if cpu is not None:
+            self.attach(cpu)
+
+    def reset(self):
+        # Physical page index to counters
+        self.pages = {}
+        # Virtual page index to TLB counters
+        self.tlb = {}
+        # Pages touched since last sample
+        self.window = set()
+        # Working set samples as (cycle, pages)
+        self.samples = []
+        self.lastphys = 0
+
+    def counters(self, page):
+        counters = self.pages.get(page, None)
+        if counters is None:
+            counters = [0] * len(self.columns)
+            self.pages[page] = counters
+        return counters
+
+    def isMMIO(self, pos, size):
+        """ Does access hit device or special handler, not only its page
+        """
+        mem = self.mem
+        if not mem.isIO(pos, size):
+            return False
+        for addr in xrange(pos, pos + size):
+            if mem.getDevice(addr) is not None or mem.getSpecial(addr) is not None:
+                return True
+        return False
+
+    def count(self, pos, size, kind):
+        """ Count access of size bytes at physical position
+        """
+        if self.cpu is None:
+            # Detached, but hook stays under hook of another tool
+            return
+        mmio = self.isMMIO(pos, size)
+        first = pos >> self._pageshift
+        last = (pos + size - 1) >> self._pageshift
+        for page in xrange(first, last + 1):
+            counters = self.counters(page)
+            counters[kind] += 1
+            if mmio:
+                counters[self.MMIO] += 1
+            self.window.add(page)
+
+    def attach(self, cpu):
+        """ Start counting accesses of CPU
+
+        Translation is disabled while attached, translated blocks bind
+        load and store functions when they are built.
+        """
+        self.cpu = cpu
+        self.mem = cpu.mem
+        mmu = cpu.mmu
+        regs = cpu.regs
+        pcreg = cpu.pc
+        wordsize = cpu.wordsize
+        stats = self
+        cpu.suspendTranslation()
+
+        translate = mmu.translate
+        def countedTranslate(pos):
+            if stats.cpu is None:
+                return translate(pos)
+            page = pos >> stats._pageshift
+            counters = stats.tlb.get(page, None)
+            if counters is None:
+                counters = [0] * len(stats.tlbcolumns)
+                stats.tlb[page] = counters
+            if page in mmu._tlb:
+                counters[stats.TLB_HITS] += 1
+            else:
+                counters[stats.TLB_MISSES] += 1
+            res = translate(pos)
+            stats.lastphys = res[0]
+            return res
+
+        def physical(pos):
+            if mmu.isEnabled():
+                return stats.lastphys
+            return pos
+
+        getData = mmu.getData
+        def countedGetData(pos, size=1):
+            value = getData(pos, size)
+            stats.count(physical(pos), size, stats.READS)
+            return value
+
+        setData = mmu.setData
+        def countedSetData(pos, data, size=4):
+            setData(pos, data, size)
+            stats.count(physical(pos), size, stats.WRITES)
+
+        read32 = mmu.read32
+        def countedRead32(pos):
+            value = read32(pos)
+            stats.count(physical(pos), 4, stats.READS)
+            return value
+
+        write32 = mmu.write32
+        def countedWrite32(pos, data):
+            write32(pos, data)
+            stats.count(physical(pos), 4, stats.WRITES)
+
+        fetchDecoded = cpu.fetchDecoded
+        def countedFetch():
+            pos = regs[pcreg]
+            decoded = fetchDecoded()
+            stats.count(physical(pos), wordsize, stats.FETCHES)
+            return decoded
+
+        self.hook(mmu, 'translate', countedTranslate)
+        self.hook(mmu, 'getData', countedGetData)
+        self.hook(mmu, 'setData', countedSetData)
+        self.hook(mmu, 'read32', countedRead32)
+        self.hook(mmu, 'write32', countedWrite32)
+        self.hook(cpu, 'fetchDecoded', countedFetch)
+
+        if self.interval:
+            self.timer = VirtualClock(self.interval, self.sample)
+            self.timer.start(cpu.cycle)
+            cpu.addTimer(self.timer)
+
+    def hook(self, obj, name, func):
+        """ Replace method of object, previous instance attribute is
+        restored on detach
+        """
+        self.hooked.append((obj, name, func, obj.__dict__.get(name, None)))
+        setattr(obj, name, func)
+
+    def unhook(self):
+        """ Remove own hooks, hooks of other tools are kept
+        """
+        for (obj, name, func, previous) in reversed(self.hooked):
+            if obj.__dict__.get(name, None) is not func:
+                continue
+            if previous is None:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, previous)
+        self.hooked = []
+
+    def detach(self):
+        """ Stop counting, takes last sample of working set
+        """
+        if self.cpu is None:
+            return
+        self.unhook()
+        if self.timer is not None:
+            self.cpu.removeTimer(self.timer)
+            self.timer.stop()
+            self.timer = None
+            if self.window:
+                self.sample()
+        self.cpu.resumeTranslation()
+        self.cpu = None
+
+    def sample(self):
+        """ Record number of pages touched since previous sample
+        """
+        self.samples.append((self.cpu.cycle, len(self.window)))
+        self.window = set()
+
+    def rows(self):
+        """ Get counters as sorted list of (page, reads, writes, ...)
+        """
+        return [tuple([page] + self.pages[page]) for page in sorted(self.pages)]
+
+    def tlbRows(self):
+        """ Get TLB counters as sorted list of (virtual page, hits, misses)
+        """
+        return [tuple([page] + self.tlb[page]) for page in sorted(self.tlb)]
+
+    def summary(self):
+        """ Get totals, memory footprint per MMU page size and working set
+        """
+        totals = [0] * len(self.columns)
+        touched = []
+        for (page, counters) in self.pages.items():
+            for (i, val) in enumerate(counters):
+                totals[i] += val
+            if counters[self.READS] or counters[self.WRITES] or counters[self.FETCHES]:
+                touched.append(page << self._pageshift)
+
+        footprint = {}
+        for (name, size) in self.pagesizes:
+            footprint[name] = len(set(pos // size for pos in touched)) * size
+
+        tlbtotals = [0] * len(self.tlbcolumns)
+        for counters in self.tlb.values():
+            for (i, val) in enumerate(counters):
+                tlbtotals[i] += val
+
+        res = {
+            'pagesize': self._pagesize,
+            'pages': len(touched),
+            'totals': dict(zip(self.columns + self.tlbcolumns, totals + tlbtotals)),
+            'footprint': footprint,
+            }
+        lookups = tlbtotals[self.TLB_HITS] + tlbtotals[self.TLB_MISSES]
+        if lookups:
+            res['tlb_hit_rate'] = float(tlbtotals[self.TLB_HITS]) / lookups
+        if self.samples:
+            sizes = [pages for (cycle, pages) in self.samples]
+            res['working_set'] = {
+                'interval': self.interval,
+                'max': max(sizes),
+                'mean': float(sum(sizes)) / len(sizes),
+                }
+        return res
+
+    def toCSV(self):
+        """ Get physical page counters as CSV, followed by TLB counters
+        of virtual pages after empty line when MMU was used
+        """
+        lines = ['page,' + ','.join(self.columns)]
+        for row in self.rows():
+            lines.append('0x%.8X,' % (row[0] << self._pageshift) + ','.join(['%d' % (val) for val in row[1:]]))
+        if self.tlb:
+            lines.append('')
+            lines.append('vpage,' + ','.join(self.tlbcolumns))
+            for row in self.tlbRows():
+                lines.append('0x%.8X,' % (row[0] << self._pageshift) + ','.join(['%d' % (val) for val in row[1:]]))
+        return '\n'.join(lines) + '\n'
+
+    def toJSON(self):
+        return json.dumps({
+            'summary': self.summary(),
+            'columns': ['page'] + list(self.columns),
+            'pages': [[page << self._pageshift] + list(row) for (page, row) in sorted(self.pages.items())],
+            'tlb_columns': ['vpage'] + list(self.tlbcolumns),
+            'tlb_pages': [[page << self._pageshift] + list(row) for (page, row) in sorted(self.tlb.items())],
+            'samples': self.samples,
+            }, sort_keys=True, indent=2)
+
+    def save(self, fname):
+        """ Write statistics to file, CSV when name ends with .csv, otherwise JSON
+        """
+        if fname.lower().endswith('.csv'):
+            data = self.toCSV()
+        else:
+            data = self.toJSON() + '\n'
+        f = open(fname, 'w')
+        try:
+            f.write(data)
+        finally:
+            f.close()
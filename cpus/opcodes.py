@@ -61,6 +61,63 @@ class Opcodes:
         0xFF: 'STOP'
         }
 
+    # Handler family of instructions, for cost accounting and profiling
+    families = {
+        'NOP': 'control',
+        'LOAD8i': 'loadstore',
+        'LOAD16i': 'loadstore',
+        'LOAD32i': 'loadstore',
+        'STORE8i': 'loadstore',
+        'STORE16i': 'loadstore',
+        'STORE32i': 'loadstore',
+        'LOAD8': 'loadstore',
+        'LOAD16': 'loadstore',
+        'LOAD32': 'loadstore',
+        'STORE8': 'loadstore',
+        'STORE16': 'loadstore',
+        'STORE32': 'loadstore',
+        'LOADADDRi': 'loadstore',
+        'MOV': 'mov',
+        'MOVi': 'mov',
+        'SWP': 'mov',
+        'MAP': 'mmu',
+        'START': 'control',
+        'INTVEC': 'intvec',
+        'ADD': 'alu',
+        'SUB': 'alu',
+        'MUL': 'alu',
+        'DIV': 'alu',
+        'MOD': 'alu',
+        'SHL': 'alu',
+        'SHR': 'alu',
+        'AND': 'alu',
+        'OR': 'alu',
+        'XOR': 'alu',
+        'NOT': 'alu',
+        'PUSH': 'stack',
+        'POP': 'stack',
+        'Bi': 'branch',
+        'B': 'branch',
+        'BZi': 'branch',
+        'BZ': 'branch',
+        'BNZi': 'branch',
+        'BNZ': 'branch',
+        'BE': 'branch',
+        'BNE': 'branch',
+        'BLE': 'branch',
+        'BSUBi': 'branch',
+        'BSUB': 'branch',
+        'BRET': 'branch',
+        'IRET': 'intvec',
+        'SETI': 'intvec',
+        'CLRI': 'intvec',
+        'CO': 'coprocessor',
+        'COS': 'coprocessor',
+        'COQ': 'coprocessor',
+        'COH': 'coprocessor',
+        'STOP': 'control',
+        }
+
     aliases = {
         'LOADi': 'LOAD32i',
         'STOREi': 'STORE32i',
@@ -71,3 +128,56 @@ class Opcodes:
     def __init__(self):
         self.rev_opcodes = {v:k for k, v in self.opcodes.items()}
         self.rev_upper_opcodes = {v.upper():k for k, v in self.opcodes.items()}
+
+    def getName(self, op):
+        """ Get instruction name of opcode
+
+        >>> o = Opcodes()
+        >>> o.getName(0x10)
+        'ADD'
+        >>> o.getName(0xFE)
+        'UNKNOWN_FE'
+        """
+        return self.opcodes.get(op, 'UNKNOWN_%.2X' % (op))
+
+    def getFamily(self, op):
+        """ Get handler family of opcode
+
+        >>> o = Opcodes()
+        >>> o.getFamily(0x36)
+        'branch'
+        >>> o.getFamily(0xFE)
+        'illegal'
+        """
+        if op not in self.opcodes:
+            return 'illegal'
+        return self.families.get(self.opcodes[op], 'other')
+
+    def disassemble(self, op, imm):
+        """ Get instruction in assembler syntax
+
+        >>> o = Opcodes()
+        >>> o.disassemble(0x30, 0x1C)
+        'Bi 0x1C'
+        >>> o.disassemble(0x23, 0x030002)
+        'MOV r1, 0, 3'
+        >>> o.disassemble(0x22, 0x0300)
+        'POP 0, r2'
+        >>> o.disassemble(0xFF, 0)
+        'STOP'
+        """
+        name = self.getName(op)
+        if name[-1] == 'i':
+            return '%s 0x%X' % (name, imm)
+        fields = []
+        for reg in (imm & 0xFF, (imm >> 8) & 0xFF):
+            if reg > 0:
+                fields.append('r%s' % (reg - 1))
+            else:
+                fields.append('0')
+        fields.append('%s' % ((imm >> 16) & 0xFF))
+        while fields and fields[-1] == '0':
+            fields.pop()
+        if not fields:
+            return name
+        return '%s %s' % (name, ', '.join(fields))
@@ -0,0 +1,345 @@
+import bisect
+import json
+import sys
+
+if sys.version >= '3':
+    xrange = range
+
+class OpcodeProfiler:
+    """ Count executions and cycles per opcode and handler family
+
+    Cycles are attributed to the instruction which ends, so fetch and
+    decode cost is included.
+    """
+    def __init__(self, cpu=None):
+        self.cpu = None
+        self.counts = [0] * 256
+        self.cycles = [0] * 256
+        self.last = 0
+        if cpu is not None:
+            self.attach(cpu)
+
+    def attach(self, cpu):
+        """ Start profiling CPU by instrumenting its dispatch table
+        """
+        self.cpu = cpu
+        self.last = cpu.cycle
+        self.handle = cpu.instrument(self.wrap)
+
+    def detach(self):
+        """ Stop profiling, other profilers attached to CPU keep running
+
+        >>> from primitives import Mem, ALU
+        >>> from cpus import RISC1
+        >>> m = Mem(64, flat=True)
+        >>> m.write32(0, 0x00010210)
+        >>> m.write32(4, 0x000000FF)
+        >>> cpu = RISC1(m, ALU())
+        >>> p = OpcodeProfiler(cpu)
+        >>> pc = PCProfiler(cpu)
+        >>> p.detach()
+        >>> cpu.run()
+        stopped: instructions=2, cycles=5, pc=00000008
+        >>> p.results()['total']
+        {'count': 0, 'cycles': 0}
+        >>> pc.hotSpots()
+        [(0, 1, 3), (4, 1, 2)]
+        >>> pc.detach()
+        >>> cpu.dispatch == cpu.buildDispatch()
+        True
+        """
+        if self.cpu is not None:
+            self.cpu.uninstrument(self.handle)
+        self.cpu = None
+
+    def reset(self):
+        self.counts = [0] * 256
+        self.cycles = [0] * 256
+        if self.cpu is not None:
+            self.last = self.cpu.cycle
+
+    def wrap(self, op, handler):
+        """ Get counting wrapper for handler of opcode
+        """
+        cpu = self.cpu
+        counts = self.counts
+        cycles = self.cycles
+        profiler = self
+        def counted(op_, imm, rx, ry, ri):
+            try:
+                return handler(op_, imm, rx, ry, ri)
+            finally:
+                counts[op] += 1
+                cycles[op] += cpu.cycle - profiler.last
+                profiler.last = cpu.cycle
+        return counted
+
+    def results(self):
+        """ Get profile as dictionary
+        """
+        opcodes = self.getOpcodes()
+        ops = {}
+        families = {}
+        total_count = 0
+        total_cycles = 0
+        for op in xrange(256):
+            count = self.counts[op]
+            if not count:
+                continue
+            name = opcodes.getName(op)
+            family = opcodes.getFamily(op)
+            ops[name] = {'opcode': op, 'family': family, 'count': count, 'cycles': self.cycles[op]}
+            fam = families.setdefault(family, {'count': 0, 'cycles': 0})
+            fam['count'] += count
+            fam['cycles'] += self.cycles[op]
+            total_count += count
+            total_cycles += self.cycles[op]
+        return {
+            'opcodes': ops,
+            'families': families,
+            'total': {'count': total_count, 'cycles': total_cycles},
+            }
+
+    def getOpcodes(self):
+        if self.cpu is not None:
+            return self.cpu.opcodes
+        from opcodes import Opcodes
+        return Opcodes()
+
+    def toJSON(self):
+        return json.dumps(self.results(), sort_keys=True, indent=2)
+
+    def report(self):
+        """ Get text report sorted by cycles
+
+        >>> from primitives import Mem, ALU
+        >>> from cpus import RISC1
+        >>> m = Mem(64, flat=True)
+        >>> m.write32(0, 0x00010210)
+        >>> m.write32(4, 0x00010210)
+        >>> m.write32(8, 0x000000FF)
+        >>> cpu = RISC1(m, ALU())
+        >>> p = OpcodeProfiler(cpu)
+        >>> cpu.run()
+        stopped: instructions=3, cycles=8, pc=0000000C
+        >>> print (p.report())
+        Opcode           Count       Cycles  Cycles%
+        ADD                  2            6    75.0%
+        STOP                 1            2    25.0%
+        <BLANKLINE>
+        Family           Count       Cycles  Cycles%
+        alu                  2            6    75.0%
+        control              1            2    25.0%
+        <BLANKLINE>
+        Total                3            8
+        >>> p.detach()
+        """
+        res = self.results()
+        total = res['total']
+        lines = []
+        for (title, items) in (('Opcode', res['opcodes']), ('Family', res['families'])):
+            if lines:
+                lines.append('')
+            lines.append('%-12s %9s %12s %8s' % (title, 'Count', 'Cycles', 'Cycles%'))
+            for (name, item) in sorted(items.items(), key=lambda x: (-x[1]['cycles'], x[0])):
+                share = 0.0
+                if total['cycles']:
+                    share = 100.0 * item['cycles'] / total['cycles']
+                lines.append('%-12s %9d %12d %7.1f%%' % (name, item['count'], item['cycles'], share))
+        lines.append('')
+        lines.append('%-12s %9d %12d' % ('Total', total['count'], total['cycles']))
+        return '\n'.join(lines)
+
+class PCProfiler:
+    """ Count executed guest PCs and track call stacks
+
+    Calls are followed through BSUB/BSUBi and BRET, interrupt handlers
+    get own frame until IRET. Frames are named by the call target, using
+    symbol table when available.
+
+    >>> from assembler import assembleSource
+    >>> from runner import imageMachine
+    >>> from cpus import SymbolTable
+    >>> image = assembleSource('''
+    ... main:
+    ... MOV r1, 0, 3
+    ... MOV r3, 0, 0
+    ... loop:
+    ... BSUBi func
+    ... MOV r0, 0, 0
+    ... SUB r1, 0, 1
+    ... BE r1, r3, 4
+    ... Bi loop
+    ... STOP
+    ... func:
+    ... MOV r2, 0, 1
+    ... BRET
+    ... ''')
+    >>> (cpu, term, clock) = imageMachine(image, echo=False)
+    >>> p = PCProfiler(cpu, SymbolTable(image.symbols))
+    >>> cpu.run()
+    stopped: instructions=20, cycles=108, pc=00000020
+    >>> print (p.collapsed())
+    main 75
+    main;func 33
+    <BLANKLINE>
+    >>> p.hotSpots(2)
+    [(8, 3, 21), (20, 3, 21)]
+    >>> p.hotLoops()
+    [(8, 24, 2, 65)]
+    >>> p.detach()
+    """
+    def __init__(self, cpu=None, symbols=None):
+        self.cpu = None
+        self.symbols = symbols
+        self.reset()
+        if cpu is not None:
+            self.attach(cpu)
+
+    def reset(self):
+        self.counts = {}
+        self.cycles = {}
+        self.backedges = {}
+        self.stacks = {}
+        self.stack = []
+        self.key = ()
+        self.nextpc = None
+        if self.cpu is not None:
+            self.last = self.cpu.cycle
+        else:
+            self.last = 0
+
+    def attach(self, cpu):
+        """ Start profiling CPU by instrumenting its dispatch table
+        """
+        self.cpu = cpu
+        self.last = cpu.cycle
+        self.handle = cpu.instrument(self.wrap)
+
+    def detach(self):
+        if self.cpu is not None:
+            self.cpu.uninstrument(self.handle)
+        self.cpu = None
+
+    def wrap(self, op, handler):
+        """ Get wrapper recording PC, cycles and call stack changes
+        """
+        cpu = self.cpu
+        regs = cpu.regs
+        pcreg = cpu.pc
+        wordsize = cpu.wordsize
+        opcodes = cpu.opcodes
+        name = opcodes.getName(op)
+        call = name in ('BSUB', 'BSUBi')
+        ret = name == 'BRET'
+        iret = name == 'IRET'
+        branch = not (call or ret or iret)
+        profiler = self
+        counts = self.counts
+        cycles = self.cycles
+        stacks = self.stacks
+
+        def profiled(op_, imm, rx, ry, ri):
+            pos = regs[pcreg] - wordsize
+            if profiler.nextpc is not None and pos != profiler.nextpc:
+                # Control moved outside instruction stream: interrupt
+                profiler.enter(pos, True)
+            try:
+                return handler(op_, imm, rx, ry, ri)
+            finally:
+                spent = cpu.cycle - profiler.last
+                profiler.last = cpu.cycle
+                counts[pos] = counts.get(pos, 0) + 1
+                cycles[pos] = cycles.get(pos, 0) + spent
+                key = profiler.key
+                stacks[key] = stacks.get(key, 0) + spent
+                target = regs[pcreg]
+                profiler.nextpc = target
+                if call:
+                    profiler.enter(target, False)
+                elif ret or iret:
+                    profiler.leave(iret)
+                elif branch and target <= pos:
+                    edge = (target, pos)
+                    profiler.backedges[edge] = profiler.backedges.get(edge, 0) + 1
+        return profiled
+
+    def enter(self, target, interrupt):
+        self.stack.append((target, interrupt))
+        self.key = tuple(self.stack)
+
+    def leave(self, interrupt):
+        """ Pop frames up to the matching call or interrupt frame
+        """
+        stack = self.stack
+        for idx in xrange(len(stack) - 1, -1, -1):
+            if stack[idx][1] == interrupt:
+                del stack[idx:]
+                self.key = tuple(stack)
+                return
+
+    def frameName(self, addr, interrupt=False):
+        if self.symbols is not None:
+            name = self.symbols.name(addr)
+        else:
+            name = '%.8X' % (addr)
+        if interrupt:
+            name = '[int]%s' % (name)
+        return name
+
+    def collapsed(self, root='main'):
+        """ Get cycles per call stack in collapsed stack format
+
+        Each line is "root;caller;callee cycles", as used by flame graph tools.
+        """
+        merged = {}
+        for (key, spent) in self.stacks.items():
+            if not spent:
+                continue
+            names = [root] + [self.frameName(addr, interrupt) for (addr, interrupt) in key]
+            line = ';'.join(names)
+            merged[line] = merged.get(line, 0) + spent
+        return ''.join('%s %d\n' % (line, merged[line]) for line in sorted(merged))
+
+    def hotSpots(self, count=10):
+        """ Get most expensive PCs
+        @returns List of (pc, executions, cycles)
+        """
+        items = [(pc, self.counts[pc], self.cycles[pc]) for pc in self.counts]
+        items.sort(key=lambda x: (-x[2], x[0]))
+        return items[:count]
+
+    def hotLoops(self, count=10):
+        """ Get most expensive loops, found by taken backward branches
+
+        Cycles are spent at addresses from loop head to the branch,
+        subroutines called from the loop are not included.
+        @returns List of (head, branch, iterations, cycles)
+        """
+        pcs = sorted(self.cycles)
+        loops = []
+        for ((head, tail), iterations) in self.backedges.items():
+            first = bisect.bisect_left(pcs, head)
+            last = bisect.bisect_right(pcs, tail)
+            spent = sum(self.cycles[pc] for pc in pcs[first:last])
+            loops.append((head, tail, iterations, spent))
+        loops.sort(key=lambda x: (-x[3], x[0], x[1]))
+        return loops[:count]
+
+    def report(self, count=10):
+        """ Get text report of hot spots and hot loops
+        """
+        total = sum(self.cycles.values())
+        def share(spent):
+            if not total:
+                return 0.0
+            return 100.0 * spent / total
+
+        lines = ['%-8s %-24s %9s %12s %8s' % ('PC', 'Symbol', 'Count', 'Cycles', 'Cycles%')]
+        for (pc, executed, spent) in self.hotSpots(count):
+            lines.append('%.8X %-24s %9d %12d %7.1f%%' % (pc, self.frameName(pc), executed, spent, share(spent)))
+        lines.append('')
+        lines.append('%-8s %-8s %-24s %9s %12s %8s' % ('Head', 'Branch', 'Symbol', 'Iter', 'Cycles', 'Cycles%'))
+        for (head, tail, iterations, spent) in self.hotLoops(count):
+            lines.append('%.8X %.8X %-24s %9d %12d %7.1f%%' % (head, tail, self.frameName(head), iterations, spent, share(spent)))
+        return '\n'.join(lines)
@@ -1,46 +1,163 @@
 from opcodes import Opcodes
+from translator import BlockTranslator
 from primitives import IntVec
-from primitives import Stack
 from primitives import MMU
+import collections
 import time
 import sys
 
 if sys.version >= '3':
     xrange = range
 
+class RegisterView:
+    """ Read-only view to register file by register name
+
+    >>> v = RegisterView([5, 0, 7])
+    >>> v['r0']
+    5
+    >>> v['r2']
+    7
+    >>> 'r1' in v
+    True
+    >>> 'r3' in v
+    False
+    >>> sorted(v.items())
+    [('r0', 5), ('r1', 0), ('r2', 7)]
+    """
+    def __init__(self, regs):
+        self._regs = regs
+
+    def __getitem__(self, name):
+        try:
+            return self._regs[self.index(name)]
+        except (IndexError, ValueError):
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        try:
+            return 0 <= self.index(name) < len(self._regs)
+        except ValueError:
+            return False
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._regs)
+
+    def index(self, name):
+        if name[:1] != 'r':
+            raise ValueError('Not a register name: %s' % (name))
+        return int(name[1:])
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def keys(self):
+        return ['r%s' % (num) for num in xrange(len(self._regs))]
+
+    def items(self):
+        return [('r%s' % (num), val) for (num, val) in enumerate(self._regs)]
+
+class StopExecution(Exception):
+    """ Raised by STOP to leave the execution loop
+    """
+    pass
+
+class BreakpointHit(Exception):
+    """ Raised before executing instruction at breakpoint
+    """
+    pass
+
+class RunResult:
+    """ Result of RISC1.run()
+    """
+    STOPPED = 'stopped'
+    BUDGET = 'budget'
+    FAULT = 'fault'
+    BREAKPOINT = 'breakpoint'
+
+    def __init__(self, reason, instructions, cycles, pc, error=None):
+        self.reason = reason
+        self.instructions = instructions
+        self.cycles = cycles
+        self.pc = pc
+        self.error = error
+
+    def __repr__(self):
+        res = '%s: instructions=%s, cycles=%s, pc=%.8X' % (self.reason, self.instructions, self.cycles, self.pc)
+        if self.error is not None:
+            res += ', error=%r' % (self.error)
+        return res
+
 class RISC1:
     wordsize = 4
+    # Most cycles one instruction can take, fetch and decode included
+    max_inst_cycles = 7
+    # Instructions run in one batch when there's no budget
+    batch = 10000
+    # Most instructions interpreted before pending interrupts are polled,
+    # translated code polls at every block boundary
+    int_latency = 1000
 
     def __init__(self, mem, alu):
         self.mem = mem
         self.mmu = MMU(mem)
         self.alu = alu
-        self.regs = {}
         #self.intvec = None
         self.opcodes = Opcodes()
         self.cycle = 0
-        self.interrupt = []
+        # Retired instructions
+        self.instret = 0
+        self.breakpoints = set()
+        # Cycle driven timers and the earliest deadline of them
+        self.timers = []
+        self.next_event = None
+        # Raised interrupts waiting for delivery
+        self.interrupt = collections.deque()
+        self.pending = False
         self.inthandler = None
         #for num in xrange(255):
         # 32 registers
         self.reg_cnt = 32
-        for num in xrange(self.reg_cnt):
-            self.regs['r%s' % (num)] = 0
 
         # This is register containing Program Counter
-        self.pc = 'r30'
+        self.pc = 30
         # Stack register
-        self.stackreg = 'r31'
-        # Return register
-        self.retreg = 'r32'
+        self.stackreg = 31
+        # Return register, not visible as general purpose register
+        self.retreg = 32
+
+        # Register file indexed by register number
+        self.regs = [0] * (self.reg_cnt + 1)
+        self.regnames = RegisterView(self.regs)
+        # Allowed stack pointer range (bottom, top), None disables checking
+        self.stack_limit = None
         self.intvec = IntVec()
         self.intvec.read(self.mmu, 0, self.wordsize)
+        self.running = False
+        # Opcode -> handler table, one indexed call per instruction
+        self.dispatch = self.buildDispatch()
+        # Dispatch wrappers in order of instrument() calls
+        self.wrappers = []
+        # Nesting depth of suspendTranslation, and state to resume to
+        self.suspended = 0
+        self.resume_translation = False
+        # Decoded instructions keyed by physical address,
+        # invalidated per page when memory under them is written
+        self.icache = {}
+        self.icache_pages = {}
+        self.mem.addWriteWatcher(self.invalidateCode)
+        # Basic block translator, None when interpreting
+        self.translator = None
 
     def fetch(self):
         self.cycle += 1
         pos = self.regs[self.pc]
         flags = self.mmu.getPageFlags(pos)
-        if self.mmu.isEnabled() and not flags['execute']:
+        if flags is not None and not flags.bits & flags.EXECUTE:
             raise IndexError('Page is not executable: %.8X' % (pos))
         inst = self.mmu.getData(pos, self.wordsize)
         self.regs[self.pc] += self.wordsize
@@ -52,6 +169,108 @@ class RISC1:
         imm = (inst >> 8)
         return (opcode, imm)
 
+    def fetchDecoded(self):
+        """ Fetch and decode instruction at PC, using decoded cache
+
+        Returns tuple of (handler, op, imm, rx, ry, ri)
+        """
+        self.cycle += 2
+        pos = self.regs[self.pc]
+        phys = pos
+        if self.mmu.isEnabled():
+            (phys, flags) = self.mmu.translate(pos)
+            if not flags.bits & flags.EXECUTE:
+                raise IndexError('Page is not executable: %.8X' % (pos))
+
+        decoded = self.icache.get(phys, None)
+        if decoded is None:
+            decoded = self.decodeAt(phys)
+        self.regs[self.pc] = pos + self.wordsize
+        return decoded
+
+    def decodeAt(self, phys):
+        """ Decode instruction at physical address and cache it
+        """
+        inst = self.mem.getData(phys, self.wordsize)
+        op = inst & 0xFF
+        imm = inst >> 8
+        (rx, ry, ri) = self.solveRegIndexes(imm)
+        decoded = (self.dispatch[op], op, imm, rx, ry, ri)
+
+        self.icache[phys] = decoded
+        first = self.mem.watchPage(phys)
+        last = self.mem.watchPage(phys + self.wordsize - 1)
+        self.icache_pages.setdefault(first, []).append(phys)
+        if last != first:
+            self.icache_pages.setdefault(last, []).append(phys)
+        return decoded
+
+    def invalidateCode(self, page):
+        """ Drop decoded instructions on given memory page
+        """
+        for phys in self.icache_pages.pop(page, ()):
+            self.icache.pop(phys, None)
+
+    def flushDecoded(self):
+        """ Drop all decoded instructions
+        """
+        self.icache = {}
+        self.icache_pages = {}
+
+    def enableTranslation(self, enable=True):
+        """ Execute guest code as translated basic blocks
+
+        While suspended, takes effect when translation is resumed.
+        """
+        if self.suspended:
+            self.resume_translation = enable
+            return
+        if enable:
+            if self.translator is None:
+                self.translator = BlockTranslator(self)
+        else:
+            self.translator = None
+
+    def suspendTranslation(self):
+        """ Interpret until resumeTranslation, calls nest
+
+        For tools hooking CPU or memory methods, translated blocks bind
+        load and store functions when they are built.
+
+        >>> from primitives import Mem, ALU
+        >>> cpu = RISC1(Mem(64, flat=True), ALU())
+        >>> cpu.enableTranslation()
+        >>> cpu.suspendTranslation()
+        >>> cpu.suspendTranslation()
+        >>> cpu.translator is None
+        True
+        >>> cpu.resumeTranslation()
+        >>> cpu.translator is None
+        True
+        >>> cpu.resumeTranslation()
+        >>> cpu.translator is None
+        False
+        """
+        if not self.suspended:
+            self.resume_translation = self.translator is not None
+            self.enableTranslation(False)
+        self.suspended += 1
+
+    def resumeTranslation(self):
+        """ End suspendTranslation, translation continues after last one
+        """
+        if not self.suspended:
+            return
+        self.suspended -= 1
+        if not self.suspended:
+            self.enableTranslation(self.resume_translation)
+
+    def mappingChanged(self):
+        """ Virtual to physical mapping or page flags may have changed
+        """
+        if self.translator is not None:
+            self.translator.flush()
+
     def load(self, imm, size=None):
         if size is None:
             size = self.wordsize
@@ -68,6 +287,20 @@ class RISC1:
         i = (datas >> 16) & 0xFF
         return (x, y, i)
 
+    def solveRegIndexes(self, datas):
+        (x, y, i) = self.solveRegs(datas)
+        rx = None
+        ry = None
+        imm = None
+        if x > 0:
+            rx = x - 1
+        if y > 0:
+            ry = y - 1
+        if i > 0:
+            imm = i
+
+        return (rx, ry, imm)
+
     def solveRegNames(self, datas):
         (x, y, i) = self.solveRegs(datas)
         rx = None
@@ -83,7 +316,10 @@ class RISC1:
         return (rx, ry, imm)
 
     def solveValues(self, datas):
-        (rx, ry, imm) = self.solveRegNames(datas)
+        (rx, ry, imm) = self.solveRegIndexes(datas)
+        return self.regValues(rx, ry, imm)
+
+    def regValues(self, rx, ry, ri):
         xval = 0
         yval = 0
         immval = 0
@@ -91,399 +327,513 @@ class RISC1:
             xval = self.regs[rx]
         if ry is not None:
             yval = self.regs[ry]
-        if imm is not None:
-            immval = imm
+        if ri is not None:
+            immval = ri
 
         return (xval, yval, immval)
 
     def dump(self):
         print ("PC: %s" % (self.regs[self.pc]))
         for num in xrange(self.reg_cnt):
-            val = self.regs['r%s' % (num)]
+            val = self.regs[num]
             if val != 0:
                 print ("%4s: %.8X" % ('r%X' % num, val))
 
-    def handleLoadStoreXBits(self, loadorstore, imm, size):
-        (rx, ry, imm) = self.solveRegNames(imm)
+    def handleLoad(self, rx, ry, size):
         rimm = 0
+        if ry is not None:
+            rimm = self.regs[ry]
+        self.regs[rx] = self.load(rimm, size)
 
-        if loadorstore == 'load':
-            if ry is not None:
-                rimm = self.regs[ry]
-            self.regs[rx] = self.load(rimm, size)
-        elif loadorstore == 'store':
-            if ry is None:
-                ry = 'r0'
-            if rx is not None:
-                rimm = self.regs[rx]
-            self.store(rimm, self.regs[ry], size)
-
-    def handleLoad(self, imm, size):
-        self.handleLoadStoreXBits('load', imm, size)
-
-    def handleStore(self, imm, size):
-        self.handleLoadStoreXBits('store', imm, size)
-
-    def handleStoreLoad(self, op, imm):
-        handled = False
-        if op == self.opcodes.rev_opcodes['LOAD8i']:
-            self.regs['r0'] = self.load(imm, 1)
-            handled = True
-        elif op == self.opcodes.rev_opcodes['LOAD16i']:
-            self.regs['r0'] = self.load(imm, 2)
-            handled = True
-        elif op == self.opcodes.rev_opcodes['LOAD32i']:
-            self.regs['r0'] = self.load(imm, 4)
-            handled = True
-        elif op == self.opcodes.rev_opcodes['STORE8i']:
-            self.store(imm, self.regs['r0'], 1)
-            handled = True
-        elif op == self.opcodes.rev_opcodes['STORE16i']:
-            self.store(imm, self.regs['r0'], 2)
-            handled = True
-        elif op == self.opcodes.rev_opcodes['STORE32i']:
-            self.store(imm, self.regs['r0'], 4)
-            handled = True
-        elif op == self.opcodes.rev_opcodes['LOAD8']:
-            self.handleLoad(imm, 1)
-            handled = True
-        elif op == self.opcodes.rev_opcodes['LOAD16']:
-            self.handleLoad(imm, 2)
-            handled = True
-        elif op == self.opcodes.rev_opcodes['LOAD32']:
-            self.handleLoad(imm, 4)
-            handled = True
-        elif op == self.opcodes.rev_opcodes['STORE8']:
-            self.handleStore(imm, 1)
-            handled = True
-        elif op == self.opcodes.rev_opcodes['STORE16']:
-            self.handleStore(imm, 2)
-            handled = True
-        elif op == self.opcodes.rev_opcodes['STORE32']:
-            self.handleStore(imm, 4)
-            handled = True
-        elif op == self.opcodes.rev_opcodes['LOADADDRi']:
-            self.regs['r0'] = imm
-            handled = True
-
-        if handled:
-            self.cycle += 3
-
-        return handled
-
-    def handleMov(self, op, imm):
-        handled = False
-        if op == self.opcodes.rev_opcodes['MOV']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            if rx is not None:
-                src = 0            
-                if ry is not None:
-                    src = self.regs[ry]
-                if imm is not None:
-                    src += imm
-                self.regs[rx] = src
-                handled = True
-        elif op == self.opcodes.rev_opcodes['MOVi']:
-            self.regs['r0'] = imm
-            handled = True
-        elif op == self.opcodes.rev_opcodes['SWP']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            if imm is None:
-                imm = 0
-            if rx is not None and ry is not None:
-                tmp = self.regs[rx]
-                self.regs[rx] = self.regs[ry] + imm
-                self.regs[ry] = tmp + imm
-                handled = True
-
-        if handled:
-            self.cycle += 2
-        return handled
-
-    def handleBasicALU(self, op, imm):
-        handled = False
-        if op == self.opcodes.rev_opcodes['ADD']:
-            (rx, ry, dum) = self.solveRegNames(imm)
-            if rx is not None:
-                self.regs[rx] = self.alu.add(*self.solveValues(imm))
-            handled = True
-        elif op == self.opcodes.rev_opcodes['SUB']:
-            (rx, ry, dum) = self.solveRegNames(imm)
-            if rx is not None:
-                self.regs[rx] = self.alu.sub(*self.solveValues(imm))
-            handled = True
-        elif op == self.opcodes.rev_opcodes['MUL']:
-            (rx, ry, dum) = self.solveRegNames(imm)
-            if rx is not None:
-                self.regs[rx] = self.alu.mul(*self.solveValues(imm))
-            handled = True
-        elif op == self.opcodes.rev_opcodes['DIV']:
-            (rx, ry, dum) = self.solveRegNames(imm)
-            if rx is not None:
-                self.regs[rx] = self.alu.div(*self.solveValues(imm))
-            handled = True
-        elif op == self.opcodes.rev_opcodes['MOD']:
-            (rx, ry, dum) = self.solveRegNames(imm)
-            if rx is not None:
-                self.regs[rx] = self.alu.mod(*self.solveValues(imm))
-            handled = True
-
-        if handled:
-            self.cycle += 1
-        return handled
-
-    def handleBitwiseALU(self, op, imm):
-        handled = False
-        if op == self.opcodes.rev_opcodes['SHL']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            if rx is not None and imm is not None:
-                if ry is not None:
-                    target = ry
-                else:
-                    target = rx
-                self.regs[target] = self.alu.b_shl(self.regs[rx], imm)
-                handled = True
-        elif op == self.opcodes.rev_opcodes['SHR']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            if rx is not None and imm is not None:
-                if ry is not None:
-                    target = ry
-                else:
-                    target = rx
-                self.regs[target] = self.alu.b_shr(self.regs[rx], imm)
-                handled = True
-        elif op == self.opcodes.rev_opcodes['AND']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            if rx is not None and ry is not None:
-                self.regs[rx] = self.alu.b_and(self.regs[rx], self.regs[ry])
-                handled = True
-        elif op == self.opcodes.rev_opcodes['OR']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            if rx is not None and ry is not None:
-                self.regs[rx] = self.alu.b_or(self.regs[rx], self.regs[ry])
-                handled = True
-        elif op == self.opcodes.rev_opcodes['XOR']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            if rx is not None and ry is not None:
-                self.regs[rx] = self.alu.b_xor(self.regs[rx], self.regs[ry])
-                handled = True
-        elif op == self.opcodes.rev_opcodes['NOT']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            if rx is not None:
-                if ry is not None:
-                    target = ry
-                else:
-                    target = rx
-                self.regs[target] = self.alu.b_not(self.regs[rx])
-                handled = True
-
-        if handled:
-            self.cycle += 1
-
-        return handled
-
-    def handleBranching(self, op, imm):
-        handled = False
-
-        if op == self.opcodes.rev_opcodes['Bi']:
-            self.regs[self.pc] = imm
-            handled = True
-        elif op == self.opcodes.rev_opcodes['B']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            if rx is not None:
-                self.regs[self.pc] = self.regs[rx]
-            handled = True
-        elif op == self.opcodes.rev_opcodes['BZi']:
-            if self.regs['r0'] == 0:
-                self.regs[self.pc] = imm
-            handled = True
-        elif op == self.opcodes.rev_opcodes['BZ']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            reg = 'r0'
-            if ry is not None:
-                reg = ry
-            if self.regs[reg] == 0:
-                self.regs[self.pc] = self.regs[rx]
-            handled = True
-        elif op == self.opcodes.rev_opcodes['BNZi']:
-            if self.regs['r0'] != 0:
-                self.regs[self.pc] = imm
-            handled = True
-        elif op == self.opcodes.rev_opcodes['BNZ']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            reg = 'r0'
-            if ry is not None:
-                reg = ry
-            if self.regs[reg] != 0:
-                self.regs[self.pc] = self.regs[rx]
-            handled = True
-        elif op == self.opcodes.rev_opcodes['BE']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            if rx is not None and ry is not None and imm is not None:
-                if self.regs[rx] == self.regs[ry]:
-                    self.regs[self.pc] += imm
-                handled = True
-        elif op == self.opcodes.rev_opcodes['BNE']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            if rx is not None and ry is not None and imm is not None:
-                if self.regs[rx] != self.regs[ry]:
-                    self.regs[self.pc] += imm
-                handled = True
-        elif op == self.opcodes.rev_opcodes['BLE']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            im = 0
-            if imm is not None:
-                im = imm
-            if rx is not None and ry is not None:
-                if self.regs[ry] == 0:
-                    self.regs[self.pc] = self.regs[rx] + im
-                handled = True
-        elif op == self.opcodes.rev_opcodes['BSUBi']:
-            self.regs[self.retreg] = self.regs[self.pc] + self.wordsize
+    def handleStore(self, rx, ry, size):
+        rimm = 0
+        if ry is None:
+            ry = 0
+        if rx is not None:
+            rimm = self.regs[rx]
+        self.store(rimm, self.regs[ry], size)
+
+    def buildDispatch(self):
+        """ Build opcode to handler table
+
+        Every opcode named in Opcodes gets handler method "op<NAME>",
+        undefined opcodes fall to illegalInstruction.
+        Handlers are called with decoded operands: (op, imm, rx, ry, ri)
+        """
+        table = [self.illegalInstruction] * 256
+        for (op, name) in self.opcodes.opcodes.items():
+            handler = getattr(self, 'op%s' % (name), None)
+            if handler is not None:
+                table[op] = handler
+        return table
+
+    def instrument(self, wrapper):
+        """ Wrap every handler of dispatch table, for profiling and tracing
+
+        Translation is disabled while instrumented, translated blocks
+        don't go through the dispatch table. Without instrumentation the
+        plain table is used and there's no overhead.
+        Wrappers stack, so several profilers can be attached at once.
+        @param wrapper Function (op, handler) returning new handler
+        @returns Handle for uninstrument
+        """
+        if not self.wrappers:
+            self.suspendTranslation()
+        self.wrappers.append(wrapper)
+        self.dispatch = [wrapper(op, handler) for (op, handler) in enumerate(self.dispatch)]
+        self.flushDecoded()
+        return wrapper
+
+    def uninstrument(self, handle=None):
+        """ Remove one wrapper, others stay in place
+
+        Translation state is restored when last wrapper is removed.
+        @param handle Handle returned by instrument, None removes all wrappers
+
+        >>> from primitives import Mem, ALU
+        >>> m = Mem(64, flat=True)
+        >>> m.write32(0, 0x00010210)
+        >>> m.write32(4, 0x000000FF)
+        >>> cpu = RISC1(m, ALU())
+        >>> seen = []
+        >>> def wrapper(name):
+        ...     def wrap(op, handler):
+        ...         def wrapped(*args):
+        ...             seen.append((name, op))
+        ...             return handler(*args)
+        ...         return wrapped
+        ...     return wrap
+        >>> first = cpu.instrument(wrapper('first'))
+        >>> second = cpu.instrument(wrapper('second'))
+        >>> cpu.uninstrument(first)
+        >>> cpu.run()
+        stopped: instructions=2, cycles=5, pc=00000008
+        >>> seen
+        [('second', 16), ('second', 255)]
+        >>> cpu.uninstrument(second)
+        >>> cpu.wrappers
+        []
+        """
+        if not self.wrappers:
+            return
+        if handle is None:
+            self.wrappers = []
+        elif handle in self.wrappers:
+            self.wrappers.remove(handle)
+        else:
+            return
+
+        self.dispatch = self.buildDispatch()
+        for wrapper in self.wrappers:
+            self.dispatch = [wrapper(op, handler) for (op, handler) in enumerate(self.dispatch)]
+        self.flushDecoded()
+        if not self.wrappers:
+            self.resumeTranslation()
+
+    ## Store/Load
+    def opLOAD8i(self, op, imm, rx, ry, ri):
+        self.regs[0] = self.load(imm, 1)
+        self.cycle += 3
+
+    def opLOAD16i(self, op, imm, rx, ry, ri):
+        self.regs[0] = self.load(imm, 2)
+        self.cycle += 3
+
+    def opLOAD32i(self, op, imm, rx, ry, ri):
+        self.regs[0] = self.load(imm, 4)
+        self.cycle += 3
+
+    def opSTORE8i(self, op, imm, rx, ry, ri):
+        self.store(imm, self.regs[0], 1)
+        self.cycle += 3
+
+    def opSTORE16i(self, op, imm, rx, ry, ri):
+        self.store(imm, self.regs[0], 2)
+        self.cycle += 3
+
+    def opSTORE32i(self, op, imm, rx, ry, ri):
+        self.store(imm, self.regs[0], 4)
+        self.cycle += 3
+
+    def opLOAD8(self, op, imm, rx, ry, ri):
+        self.handleLoad(rx, ry, 1)
+        self.cycle += 3
+
+    def opLOAD16(self, op, imm, rx, ry, ri):
+        self.handleLoad(rx, ry, 2)
+        self.cycle += 3
+
+    def opLOAD32(self, op, imm, rx, ry, ri):
+        self.handleLoad(rx, ry, 4)
+        self.cycle += 3
+
+    def opSTORE8(self, op, imm, rx, ry, ri):
+        self.handleStore(rx, ry, 1)
+        self.cycle += 3
+
+    def opSTORE16(self, op, imm, rx, ry, ri):
+        self.handleStore(rx, ry, 2)
+        self.cycle += 3
+
+    def opSTORE32(self, op, imm, rx, ry, ri):
+        self.handleStore(rx, ry, 4)
+        self.cycle += 3
+
+    def opLOADADDRi(self, op, imm, rx, ry, ri):
+        self.regs[0] = imm
+        self.cycle += 3
+
+    ## MOV/SWP
+    def opMOV(self, op, imm, rx, ry, ri):
+        if rx is None:
+            return self.illegalInstruction(op, imm, rx, ry, ri)
+        src = 0
+        if ry is not None:
+            src = self.regs[ry]
+        if ri is not None:
+            src += ri
+        self.regs[rx] = src & self.alu.mask
+        self.cycle += 2
+
+    def opMOVi(self, op, imm, rx, ry, ri):
+        self.regs[0] = imm
+        self.cycle += 2
+
+    def opSWP(self, op, imm, rx, ry, ri):
+        if rx is None or ry is None:
+            return self.illegalInstruction(op, imm, rx, ry, ri)
+        if ri is None:
+            ri = 0
+        mask = self.alu.mask
+        tmp = self.regs[rx]
+        self.regs[rx] = (self.regs[ry] + ri) & mask
+        self.regs[ry] = (tmp + ri) & mask
+        self.cycle += 2
+
+    ## ALU
+    def opADD(self, op, imm, rx, ry, ri):
+        if rx is not None:
+            self.regs[rx] = self.alu.add3(*self.regValues(rx, ry, ri))
+        self.cycle += 1
+
+    def opSUB(self, op, imm, rx, ry, ri):
+        if rx is not None:
+            self.regs[rx] = self.alu.sub3(*self.regValues(rx, ry, ri))
+        self.cycle += 1
+
+    def opMUL(self, op, imm, rx, ry, ri):
+        if rx is not None:
+            self.regs[rx] = self.alu.mul3(*self.regValues(rx, ry, ri))
+        self.cycle += 1
+
+    def opDIV(self, op, imm, rx, ry, ri):
+        if rx is not None:
+            self.regs[rx] = self.alu.div3(*self.regValues(rx, ry, ri))
+        self.cycle += 1
+
+    def opMOD(self, op, imm, rx, ry, ri):
+        if rx is not None:
+            self.regs[rx] = self.alu.mod3(*self.regValues(rx, ry, ri))
+        self.cycle += 1
+
+    def opSHL(self, op, imm, rx, ry, ri):
+        if rx is None or ri is None:
+            return self.illegalInstruction(op, imm, rx, ry, ri)
+        if ry is not None:
+            target = ry
+        else:
+            target = rx
+        self.regs[target] = self.alu.shl32(self.regs[rx], ri)
+        self.cycle += 1
+
+    def opSHR(self, op, imm, rx, ry, ri):
+        if rx is None or ri is None:
+            return self.illegalInstruction(op, imm, rx, ry, ri)
+        if ry is not None:
+            target = ry
+        else:
+            target = rx
+        self.regs[target] = self.alu.shr32(self.regs[rx], ri)
+        self.cycle += 1
+
+    def opAND(self, op, imm, rx, ry, ri):
+        if rx is None or ry is None:
+            return self.illegalInstruction(op, imm, rx, ry, ri)
+        self.regs[rx] = self.alu.and32(self.regs[rx], self.regs[ry])
+        self.cycle += 1
+
+    def opOR(self, op, imm, rx, ry, ri):
+        if rx is None or ry is None:
+            return self.illegalInstruction(op, imm, rx, ry, ri)
+        self.regs[rx] = self.alu.or32(self.regs[rx], self.regs[ry])
+        self.cycle += 1
+
+    def opXOR(self, op, imm, rx, ry, ri):
+        if rx is None or ry is None:
+            return self.illegalInstruction(op, imm, rx, ry, ri)
+        self.regs[rx] = self.alu.xor32(self.regs[rx], self.regs[ry])
+        self.cycle += 1
+
+    def opNOT(self, op, imm, rx, ry, ri):
+        if rx is None:
+            return self.illegalInstruction(op, imm, rx, ry, ri)
+        if ry is not None:
+            target = ry
+        else:
+            target = rx
+        self.regs[target] = self.alu.not32(self.regs[rx])
+        self.cycle += 1
+
+    ## Branching
+    def opBi(self, op, imm, rx, ry, ri):
+        self.regs[self.pc] = imm
+        self.cycle += 5
+
+    def opB(self, op, imm, rx, ry, ri):
+        if rx is not None:
+            self.regs[self.pc] = self.regs[rx]
+        self.cycle += 5
+
+    def opBZi(self, op, imm, rx, ry, ri):
+        if self.regs[0] == 0:
             self.regs[self.pc] = imm
-        elif op == self.opcodes.rev_opcodes['BSUB']:
-            self.regs[self.retreg] = self.regs[self.pc] + self.wordsize
-            (rx, ry, imm) = self.solveRegNames(imm)
-            if imm is None:
-                imm = 0
-            if rx is not None:
-                imm += self.regs[rx]
+        self.cycle += 5
+
+    def opBZ(self, op, imm, rx, ry, ri):
+        reg = 0
+        if ry is not None:
+            reg = ry
+        if self.regs[reg] == 0:
+            self.regs[self.pc] = self.regs[rx]
+        self.cycle += 5
+
+    def opBNZi(self, op, imm, rx, ry, ri):
+        if self.regs[0] != 0:
             self.regs[self.pc] = imm
-        elif op == self.opcodes.rev_opcodes['BRET']:
-            self.regs[self.pc] = self.regs[self.retreg]
+        self.cycle += 5
 
-        if handled:
-            self.cycle += 5
+    def opBNZ(self, op, imm, rx, ry, ri):
+        reg = 0
+        if ry is not None:
+            reg = ry
+        if self.regs[reg] != 0:
+            self.regs[self.pc] = self.regs[rx]
+        self.cycle += 5
+
+    def opBE(self, op, imm, rx, ry, ri):
+        if rx is None or ry is None or ri is None:
+            return self.illegalInstruction(op, imm, rx, ry, ri)
+        if self.regs[rx] == self.regs[ry]:
+            self.regs[self.pc] += ri
+        self.cycle += 5
+
+    def opBNE(self, op, imm, rx, ry, ri):
+        if rx is None or ry is None or ri is None:
+            return self.illegalInstruction(op, imm, rx, ry, ri)
+        if self.regs[rx] != self.regs[ry]:
+            self.regs[self.pc] += ri
+        self.cycle += 5
+
+    def opBLE(self, op, imm, rx, ry, ri):
+        if rx is None or ry is None:
+            return self.illegalInstruction(op, imm, rx, ry, ri)
+        im = 0
+        if ri is not None:
+            im = ri
+        if self.regs[ry] == 0:
+            self.regs[self.pc] = self.regs[rx] + im
+        self.cycle += 5
+
+    def opBSUBi(self, op, imm, rx, ry, ri):
+        self.regs[self.retreg] = self.regs[self.pc] + self.wordsize
+        self.regs[self.pc] = imm
+        self.cycle += 5
+
+    def opBSUB(self, op, imm, rx, ry, ri):
+        self.regs[self.retreg] = self.regs[self.pc] + self.wordsize
+        target = 0
+        if ri is not None:
+            target = ri
+        if rx is not None:
+            target += self.regs[rx]
+        self.regs[self.pc] = target
+        self.cycle += 5
 
-        return handled
+    def opBRET(self, op, imm, rx, ry, ri):
+        self.regs[self.pc] = self.regs[self.retreg]
+        self.cycle += 5
 
-    def illegalInstruction(self, op, imm):
+    def illegalInstruction(self, op, imm, rx=None, ry=None, ri=None):
         raise ValueError('Illegal instruction: %s  (%s)' % (op, imm))
 
-    def handleIntvec(self, op, imm):
-        """ Check if we have intvec opcode.
-            If found, try to read and setup new Iterrupt Vector or setup new flags.
+    ## Interrupt vector
+    def opINTVEC(self, op, imm, rx, ry, ri):
+        """ Try to read and setup new Iterrupt Vector or setup new flags.
         """
-        handled = False
-        if op == self.opcodes.rev_opcodes['INTVEC']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-
-            if rx is not None:
-                pos = self.regs[rx]
-                if imm is not None:
-                    pos += imm
-                self.intvec = IntVec()
-                self.intvec.read(self.mmu, pos, self.wordsize)
-                handled = True
-
-            if ry is not None and self.intvec is not None:
-                flags = self.regs[ry]
-                self.intvec.setFlags(flags)
-                handled = True
-        elif op == self.opcodes.rev_opcodes['SETI']:
-            self.intvec.setFlags(1)
-            handled = True
-        elif op == self.opcodes.rev_opcodes['CLRI']:
-            self.intvec.setFlags(0)
-            handled = True
-
-        return handled
-
-    def handleMMU(self, op, imm):
-        """ Check if we have intvec opcode.
-            If found, try to read and setup new Iterrupt Vector or setup new flags.
-        """
-        handled = False
-        if op == self.opcodes.rev_opcodes['MAP']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            if rx is not None and ry is not None:
-                pos = self.regs[rx]
-                size = self.regs[ry]
-                self.mmu.initialize(pos, size)
-            if imm is not None:
-                if imm & 0x1 == 0x1:
-                    self.mmu.enable()
-                if imm & 0x2 == 0x2:
-                    self.mmu.disable()
-            handled = True
-
-        return handled
-
-    def handleStack(self, op, imm):
-        handled = False
-        if op == self.opcodes.rev_opcodes['PUSH']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            if rx is None:
-                dest = self.stackreg
-            else:
-                dest = rx
+        if rx is None and ry is None:
+            return self.illegalInstruction(op, imm, rx, ry, ri)
 
-            if ry is None:
-                data = 0
-            else:
-                data = self.regs[ry]
-
-            if imm is None:
-                imm = 0
-            data += imm
-
-            stack = Stack(self.regs[dest], self.mmu, self.wordsize)
-            stack.push(data)
-            self.regs[dest] = stack.getPos()
-            del stack
-
-            handled = True
-        elif op == self.opcodes.rev_opcodes['POP']:
-            (rx, ry, imm) = self.solveRegNames(imm)
-            if rx is None:
-                dest = self.stackreg
+        if rx is not None:
+            pos = self.regs[rx]
+            if ri is not None:
+                pos += ri
+            intvec = IntVec()
+            if self.intvec is not None:
+                intvec.priorities = list(self.intvec.priorities)
+                intvec.prioritized = self.intvec.prioritized
+            self.intvec = intvec
+            self.intvec.read(self.mmu, pos, self.wordsize)
+
+        if ry is not None and self.intvec is not None:
+            flags = self.regs[ry]
+            self.intvec.setFlags(flags)
+
+    def opSETI(self, op, imm, rx, ry, ri):
+        self.intvec.setFlags(1)
+
+    def opCLRI(self, op, imm, rx, ry, ri):
+        self.intvec.setFlags(0)
+
+    def opIRET(self, op, imm, rx, ry, ri):
+        self.returnInterrupt()
+
+    def opSTOP(self, op, imm, rx, ry, ri):
+        self.running = False
+        raise StopExecution()
+
+    ## MMU / Mapping
+    def opMAP(self, op, imm, rx, ry, ri):
+        """ Setup MMU page table and enable or disable paging
+
+        Immediate bits: 0x1 enable, 0x2 disable,
+        0x4 append table to current mapping instead of replacing it
+        """
+        if rx is not None and ry is not None:
+            pos = self.regs[rx]
+            size = self.regs[ry]
+            if ri is not None and ri & 0x4 == 0x4:
+                self.mmu.extend(pos, size)
             else:
-                dest = rx
-
-            if imm is None:
-                imm = 0
-
-            stack = Stack(self.regs[dest], self.mmu, self.wordsize)
-            data = stack.pop()
-            self.regs[dest] = stack.getPos()
-            del stack
-
-            if ry is not None:
-                self.regs[ry] = data + imm
+                self.mmu.initialize(pos, size)
+        if ri is not None:
+            if ri & 0x1 == 0x1:
+                self.mmu.enable()
+            if ri & 0x2 == 0x2:
+                self.mmu.disable()
+        self.mappingChanged()
+
+    ## Stack
+    def opPUSH(self, op, imm, rx, ry, ri):
+        """ Push register plus immediate, results wrap to word size
+        like in ALU, also in translated MOV and SWP
+
+        >>> from assembler import assembleSource
+        >>> from runner import imageMachine
+        >>> image = assembleSource('''
+        ... LOADADDRi stack
+        ... MOV r15, r0
+        ... MOV r1, 0, 0
+        ... SUB r1, 0, 1
+        ... MOV r2, r1, 2
+        ... PUSH r15, r1, 1
+        ... POP r15, r4, 5
+        ... MOV r3, r1
+        ... SWP r3, r1, 1
+        ... STOP
+        ... .base 0x2000
+        ... .data
+        ... dd 0
+        ... stack:
+        ... ''')
+        >>> for translate in (False, True):
+        ...     (cpu, term, clock) = imageMachine(image, echo=False)
+        ...     cpu.enableTranslation(translate)
+        ...     res = cpu.run()
+        ...     print (['%X' % (cpu.regs[reg]) for reg in (1, 2, 3, 4)])
+        ['0', '1', '0', '5']
+        ['0', '1', '0', '5']
+        """
+        if rx is None:
+            dest = self.stackreg
+        else:
+            dest = rx
+
+        if ry is None:
+            data = 0
+        else:
+            data = self.regs[ry]
+
+        mask = self.alu.mask
+        if ri is not None:
+            data = (data + ri) & mask
+
+        pos = (self.regs[dest] - self.wordsize) & mask
+        if self.stack_limit is not None and pos < self.stack_limit[0]:
+            raise IndexError('Stack overflow!')
+        self.mmu.write32(pos, data)
+        self.regs[dest] = pos
+
+    def opPOP(self, op, imm, rx, ry, ri):
+        if rx is None:
+            dest = self.stackreg
+        else:
+            dest = rx
+
+        if ri is None:
+            ri = 0
+
+        pos = self.regs[dest]
+        if self.stack_limit is not None and pos >= self.stack_limit[1]:
+            raise IndexError('Stack underflow!')
+        data = self.mmu.read32(pos)
+        mask = self.alu.mask
+        self.regs[dest] = (pos + self.wordsize) & mask
 
-            handled = True
+        if ry is not None:
+            self.regs[ry] = (data + ri) & mask
 
-        return handled
+    def setStackLimit(self, base, size=None):
+        """ Enable stack bounds checking for PUSH and POP
+        @param base Top of the stack, stack grows down from here
+        @param size Stack size in bytes, None disables checking
+        """
+        if size is None:
+            self.stack_limit = None
+        else:
+            self.stack_limit = (base - size, base)
 
     def saveState(self):
         tmp = {}
         tmp['pc'] = self.regs[self.pc]
         tmp['stack'] = self.regs[self.stackreg]
-        tmp['regs'] = self.regs.copy()
+        tmp['regs'] = dict(self.regnames.items())
         return tmp
 
     def loadState(self, state):
-        self.regs = tmp['regs']
-        self.regs[self.pc] = tmp['pc']
-        self.regs[self.stackreg] = tmp['stack']
+        for (name, val) in state['regs'].items():
+            self.regs[self.regnames.index(name)] = val
+        self.regs[self.pc] = state['pc']
+        self.regs[self.stackreg] = state['stack']
 
     def raiseInterrupt(self, intnum):
         if self.intvec is None:
             return
-    
+
         if not self.intvec.isEnabled():
             return
 
         self.intvec.disable()
         self.interrupt.append(intnum)
+        self.pending = True
         #print "int", self.interrupt
 
     def handleInterrupts(self):
         if not self.interrupt:
+            self.pending = False
             return
 
-        intnum = self.interrupt[0]
-        self.interrupt = self.interrupt[1:]
+        intnum = self.intvec.selectPending(self.interrupt)
+        self.pending = len(self.interrupt) > 0
 
         handler = self.intvec.getHandler(intnum)
         if handler is not None:
@@ -499,243 +849,246 @@ class RISC1:
 
         self.intvec.enable()
 
-    def start(self, verbose=False):
-    #def start(self, verbose=True):
-        while True:
-            if self.interrupt is not None:
-                self.handleInterrupts()
-
-            inst = self.fetch()
-            (op, imm) = self.decode(inst)
-            if verbose:
-                if (op in self.opcodes.opcodes and self.opcodes.opcodes[op][-1] == 'i'):
-                    print ("[PC %4s] %3s %s %s" % (self.regs[self.pc], op, self.opcodes.opcodes[op], imm))
-                else:
-                    print ("[PC %4s] %3s %s %s" % (self.regs[self.pc], op, self.opcodes.opcodes[op], self.solveRegNames(imm)))
-
-            if op == self.opcodes.rev_opcodes['STOP']:
-                break
+    def addTimer(self, timer):
+        """ Add timer ticked from cycle counter, see VirtualClock
+        """
+        self.timers.append(timer)
+        self.updateEvents()
+
+    def removeTimer(self, timer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+        self.updateEvents()
+
+    def updateEvents(self):
+        deadlines = [timer.deadline for timer in self.timers if timer.deadline is not None]
+        if deadlines:
+            self.next_event = min(deadlines)
+        else:
+            self.next_event = None
+
+    def runTimers(self):
+        """ Tick timers whose deadline is passed
+        """
+        for timer in self.timers:
+            timer.tick(self.cycle)
+        self.updateEvents()
 
-            handled = False
+    def addBreakpoint(self, pos):
+        """ Stop before executing instruction at virtual address
+        """
+        self.breakpoints.add(pos)
 
-            # Are we returning from an interrupt?
-            if op == self.opcodes.rev_opcodes['IRET']:
-                self.returnInterrupt()
-                handled = True
+    def removeBreakpoint(self, pos):
+        self.breakpoints.discard(pos)
 
-            ## Store/Load
-            if not handled:
-                handled = self.handleStoreLoad(op, imm)
+    def interpret(self, count):
+        """ Interpret at most count instructions
 
-            ## MOV/SWP
-            if not handled:
-                handled = self.handleMov(op, imm)
+        There's no budget check per instruction, STOP and faults leave
+        the loop by exception.
+        """
+        fetch = self.fetchDecoded
+        i = 0
+        try:
+            for i in xrange(count):
+                (handler, op, imm, rx, ry, ri) = fetch()
+                handler(op, imm, rx, ry, ri)
+        except StopExecution:
+            self.instret += i + 1
+            raise
+        except Exception:
+            self.instret += i
+            raise
+        self.instret += count
+
+    def interpretChecked(self, count, resume=True):
+        """ Interpret at most count instructions, stop at breakpoints
+
+        @param resume Ignore breakpoint at the first instruction, so
+            execution can continue from breakpoint
+        """
+        fetch = self.fetchDecoded
+        regs = self.regs
+        breakpoints = self.breakpoints
+        i = 0
+        try:
+            for i in xrange(count):
+                if (i > 0 or not resume) and regs[self.pc] in breakpoints:
+                    raise BreakpointHit(regs[self.pc])
+                (handler, op, imm, rx, ry, ri) = fetch()
+                handler(op, imm, rx, ry, ri)
+        except StopExecution:
+            self.instret += i + 1
+            raise
+        except Exception:
+            self.instret += i
+            raise
+        self.instret += count
+
+    def step(self):
+        """ Interpret one instruction
+        """
+        if self.pending:
+            self.handleInterrupts()
+        self.interpret(1)
 
-            ## ALU
-            if not handled:
-                handled = self.handleBasicALU(op, imm)
-            if not handled:
-                handled = self.handleBitwiseALU(op, imm)
+    def runBlocks(self, limit=None, deadline=None):
+        """ Run translated basic blocks until STOP or budget is used
 
-            ## Branching
-            if not handled:
-                handled = self.handleBranching(op, imm)
+        Cycles are accounted, budget and interrupts checked only at block
+        boundaries. Instructions not translated are interpreted one at a time.
+        @param limit Stop when instret reaches this
+        @param deadline Stop when cycle reaches this
+        """
+        translator = self.translator
+        regs = self.regs
+        pcreg = self.pc
+        blk = None
+        while True:
+            if limit is not None and self.instret >= limit:
+                return
+            if deadline is not None and self.cycle >= deadline:
+                return
+            if self.next_event is not None and self.cycle >= self.next_event:
+                self.runTimers()
+            if self.pending:
+                self.handleInterrupts()
+                blk = None
+
+            pos = regs[pcreg]
+            nxt = None
+            if blk is not None:
+                nxt = blk.links.get(pos, None)
+                if nxt is not None and not nxt.valid:
+                    nxt = None
+            if nxt is None:
+                try:
+                    nxt = translator.lookup(pos)
+                except IndexError:
+                    # Fetch fault, interpreter raises it with same accounting
+                    self.interpret(1)
+                    blk = None
+                    continue
+                if blk is not None:
+                    blk.links[pos] = nxt
+
+            if nxt.func is None:
+                self.interpret(1)
+                blk = None
+                continue
+
+            # Block accounts instructions itself, it may be left early
+            regs[pcreg] = nxt.func(regs, self, nxt)
+            blk = nxt
+
+    def execute(self, limit=None, deadline=None):
+        """ Execute until STOP, fault, breakpoint or until budget is used
+        @param limit Stop when instret reaches this
+        @param deadline Stop when cycle reaches this
+        """
+        self.updateEvents()
+        if self.translator is not None and not self.breakpoints:
+            return self.runBlocks(limit, deadline)
 
-            # Interrupt vector
-            if not handled:
-                handled = self.handleIntvec(op, imm)
+        checked = len(self.breakpoints) > 0
+        resume = True
+        while True:
+            count = min(self.batch, self.int_latency)
+            if limit is not None:
+                count = min(count, limit - self.instret)
+            if deadline is not None:
+                if self.cycle >= deadline:
+                    return
+                count = min(count, max(1, (deadline - self.cycle) // self.max_inst_cycles))
+            if self.next_event is not None:
+                if self.cycle >= self.next_event:
+                    self.runTimers()
+                if self.next_event is not None:
+                    count = min(count, max(1, (self.next_event - self.cycle) // self.max_inst_cycles))
+            if count <= 0:
+                return
+            if self.pending:
+                self.handleInterrupts()
+                resume = False
+            if checked:
+                self.interpretChecked(count, resume)
+                resume = False
+            else:
+                self.interpret(count)
 
-            # Stack
-            if not handled:
-                self.handleStack(op, imm)
+    def run(self, instructions=None, cycles=None):
+        """ Run bounded batch of instructions
 
-            # MMU / Mapping
-            if not handled:
-                handled = self.handleMMU(op, imm)
+        Budget may be overrun by one instruction, or by one block
+        when translating.
+        @param instructions Maximum number of instructions to execute
+        @param cycles Maximum number of cycles to execute
+        @returns RunResult
+        """
+        instret = self.instret
+        cycle = self.cycle
+        limit = None
+        deadline = None
+        if instructions is not None:
+            limit = self.instret + instructions
+        if cycles is not None:
+            deadline = self.cycle + cycles
+
+        self.running = True
+        reason = RunResult.BUDGET
+        error = None
+        try:
+            self.execute(limit, deadline)
+        except StopExecution:
+            reason = RunResult.STOPPED
+        except BreakpointHit:
+            reason = RunResult.BREAKPOINT
+        except Exception as e:
+            self.running = False
+            reason = RunResult.FAULT
+            error = e
+
+        return RunResult(reason, self.instret - instret, self.cycle - cycle, self.regs[self.pc], error)
+
+    def runUntil(self, cycle):
+        """ Run until cycle counter reaches given cycle
+        @returns RunResult
+        """
+        return self.run(cycles=max(0, cycle - self.cycle))
 
-            if not handled:
-                self.illegalInstruction(op, imm)
+    def start(self, verbose=False):
+    #def start(self, verbose=True):
+        self.running = True
+        try:
+            if verbose:
+                self.trace()
+            else:
+                self.execute()
+        except StopExecution:
+            pass
 
         self.dump()
 
-""" Instruction set - 32 bit
-
-imm         coding = AABBCC
-rx          coding = 0000xx
-rx, ry      coding = 00yyxx
-rx, ry, imm coding = iiyyxx
-
-
-0x00 NOP
-0x01 LOAD8i imm
-  Load 8 bit value from imm memory location to r0
-0x02 LOAD16i imm
-  Load 16 bit value from imm memory location to r0
-0x03 LOAD32i imm
-  Load 32 bit value from imm memory location to r0
-0x04 STORE8i imm
-  Store 8 bit value from r0 to memory location imm
-0x05 STORE16i imm
-  Store 16 bit value from r0 to memory location imm
-0x06 STORE32i imm
-  Store 32 bit value from r0 to memory location imm
-0x07 LOAD8 rx, ry
-  Load 8 bit value from ry memory location to rx/r0
-0x08 LOAD16 rx, ry
-  Load 16 bit value from ry memory location to rx/r0
-0x09 LOAD32 rx, ry
-  Load 32 bit value from ry memory location to rx/r0
-#0x0A LOAD64 rx, ry
-#  Load 64 bit value from ry memory location to rx/r0 = low 32 bit, ry = high 32 bit
-0x0B STORE8 rx, ry
-  Store 8 bit value to rx memory location from ry/r0
-0x0C STORE16 rx, ry
-  Store 16 bit value to rx memory location from ry/r0
-0x0D STORE32 rx, ry
-  Store 32 bit value to rx memory location from ry/r0
-#0x0E STORE64 rx, ry, imm
-#  Store 64 bit value to rx memory location from ry/r0 = low 32 bit, r0 = high 32 bit
-0x0F LOADADDR imm
-  Load address of immediate to r0
-
-0x10 ADD rx, ry, imm
-  Do rx = rx + ry + imm, store result to rx
-0x11 SUB rx, ry, imm
-  Subtract rx = rx - ry - imm, store result to rx
-0x12 MUL rx, ry, imm
-  Multiply rx = rx * ry * imm, store result to rx
-0x13 DIV rx, ry, imm
-  Divide rx = rx / ry /imm, store result to rx
-0x14 MOD rx, ry, imm
-  Take remainder of rx = rx % ry % imm, store result to rx
-0x15 SHL rx, ry, imm
-  Shift left rx by imm, store result to ry or in rx if ry not defined
-0x16 SHR rx, ry, imm
-  Shift right rx by imm, store result to ry or in rx if ry not defined
-0x17 AND rx, ry
-  Does bitwise and (rx&ry), store result to rx
-0x18 OR rx, ry
-  Does bitwise or (rx|ry), store result to rx
-0x19 XOR rx, ry
-  Does bitwise exclusive or (rx^ry), store result to rx
-0x20 NOT rx
-  Does bitwise not (~rx), store result to ry or rx if ry not defined
-
-0x21 PUSH rx, ry, imm
-  Push value of ry+imm to stack defined in rx or in case rx==0 use r43
-0x22 POP rx, ry, imm
-  Pop value+imm to register ry from stack defined in rx or in case rx==0 use r43
-0x23 MOV rx, ry, imm
-  Move value of register ry to register rx, add imm
-0x24 MOVi imm
-  Move imm to r0
-0x25 SWP rx, ry, imm
-  Swap value of registers ry and rx, add imm to both
-
-0x2D MAP rx, ry, imm
-  Define MMU page map table
-   rx = physical address for page start, can't be zero. If zero, just read immediate
-   ry = number of items in table
-   imm = 0x0 = no change, 0x1 enable paging, 0x2 disable paging
-  Table should contain mapping items like:
-    0x00006100 # Page, virtual start at 24, size 4k (0x1000)
-    0x00001101 # Subtable, starts at phys 4k (0x1000)
-    0x00008110 # Page, virtual start at 32k, size 64k (0x10000)
-    0x00018100 # Page, virtual start at 96, size 4k (0x1000)
-  Format is:
-    0xFFFFF000 == address, virtual in case of page, physical in case of subtable
-    0x???????1 == subtable,  0=page,              1=subtable
-    0x???????2 == execute,   0=no execute,        1=executable
-    0x???????4 == write,     0=no write,          1=writable
-    0x???????8 == userspace, 0=no access from us, 1=accessable
-    0x?????1?? == ok,        0=disabled,          1=in use
-    0x??????0? == 4k page
-    0x??????1? == 64k page
-    0x??????2? == 1M page
-    0x??????3? == 64M page
-            if flags & 0x1 == 0x1:
-                data['subtable'] = True
-            if flags & 0x2 == 0x2:
-                data['execute'] = True
-            if flags & 0x4 == 0x4:
-                data['write'] = True
-            if flags & 0x8 == 0x8:
-                data['userspace'] = True
-            if flags & 0x10 == 0x10:
-                data['size1'] = True
-            if flags & 0x20 == 0x20:
-                data['size2'] = True
-            if flags & 0x100 == 0x100:
-                data['ok'] = True
-  
-0x2E START rx, ry, imm
-  Start a HW process
-   rx + imm = Address of first instruction
-   ry = Address of process structure (see Appendix A)
-0x2F INTVEC rx, ry, imm
-  Program interrupt vector, by default read from position 0
-   rx + imm = Address of interrupt vector or 0 == no change
-   ry = Interrupt flags (enable/disable/etc)
-
-0x30 Bi imm
-  Branch to location imm
-0x31 B rx
-  Branch to location defined by rx
-0x32 BZi imm
-  Branch to location imm, if r0 is zero
-0x33 BZ rx, ry
-  Branch to location defined by rx, if ry/r0 is zero
-0x34 BNZi imm
-  Branch to location imm, if r0 is not zero
-0x35 BNZ rx, ry
-  Branch to location defined by rx, if ry/r0 is not zero
-0x36 BE rx, ry, imm
-  Increase PC by imm if value rx == ry
-0x37 BNE rx, ry, imm
-  Increase PC by imm if value rx != ry
-0x38 BLE rx, ry, imm
-  Branch long if ry is zero, target address = rx + imm
-0x3A BSUBi imm
-  Branch to subprocess defined by imm, save return address to return register
-0x3B BSUB rx, ry, imm
-  Branch to subprocess, save return address to return register
-    rx + imm = subprocess address
-0x3C BRET
-  Return from a subprocess
-0x3D IRET
-  Return from an interrupt
-0x3E SETI
-  Turn interrupts on
-0x3F CLRI
-  Turn interrupts off
-
-0x40 CO rx, ry, imm
-  Co-processor query call, will write:
-    rx = Return status register for information about coprocessors
-    ry = Return status register for reference number for communication
-0x41 COS rx, ry, imm
-  Order a co-processor to start running code
-    rx = beginning of code to run
-    ry = refernce nuber for communication
-    imm = index of co-processor
-0x42 COQ rx, ry, imm
-  Query status of co-processor
-    rx = Return status register of co-processor
-    ry = refernce nuber for communication
-    imm = index of co-processor
-0x43 COH rx, ry, imm
-  Halt co-processor
-    rx = Free form data to pass to co-processor
-    ry = refernce nuber for communication
-    imm = index of co-processor
-
-0xFF END
-  End execution
-
-Appendix A - HW process table
- HW task/process structure
- pid       Process ID. Shoulb be 0, will be changed by START opcode
- perm      permissions flags
- PC        program counter
- r0..r31  registers
-"""
+    def trace(self):
+        """ Interpret printing every instruction
+        """
+        self.updateEvents()
+        while True:
+            if self.next_event is not None and self.cycle >= self.next_event:
+                self.runTimers()
+            if self.pending:
+                self.handleInterrupts()
+
+            (handler, op, imm, rx, ry, ri) = self.fetchDecoded()
+            if (op in self.opcodes.opcodes and self.opcodes.opcodes[op][-1] == 'i'):
+                print ("[PC %4s] %3s %s %s" % (self.regs[self.pc], op, self.opcodes.opcodes[op], imm))
+            else:
+                print ("[PC %4s] %3s %s %s" % (self.regs[self.pc], op, self.opcodes.opcodes[op], self.solveRegNames(imm)))
+
+            try:
+                handler(op, imm, rx, ry, ri)
+            except StopExecution:
+                self.instret += 1
+                raise
+            self.instret += 1
@@ -0,0 +1,87 @@
+import bisect
+
+class SymbolTable:
+    """ Map addresses back to assembler labels
+
+    >>> s = SymbolTable({'main': 0, 'loop': 8, 'func': 0x20, 'data': 0x40})
+    >>> s.lookup(8)
+    ('loop', 0)
+    >>> s.lookup(0x2C)
+    ('func', 12)
+    >>> s.name(0x2C)
+    'func+0xc'
+    >>> s.name(0x24, offset=False)
+    'func'
+    >>> SymbolTable().name(0x24)
+    '00000024'
+    >>> SymbolTable.parse(s.toText().splitlines()).symbols == s.symbols
+    True
+    """
+    def __init__(self, symbols=None):
+        self.symbols = {}
+        self.addrs = []
+        self.names = []
+        if symbols:
+            self.update(symbols)
+
+    def update(self, symbols):
+        """ Add symbols
+        @param symbols Dictionary from label to address
+        """
+        self.symbols.update(symbols)
+        # First name in sorted order wins when labels share address
+        items = sorted((addr, name) for (name, addr) in self.symbols.items())
+        self.addrs = []
+        self.names = []
+        for (addr, name) in items:
+            if self.addrs and self.addrs[-1] == addr:
+                continue
+            self.addrs.append(addr)
+            self.names.append(name)
+
+    def lookup(self, addr):
+        """ Get nearest label at or below address
+        @returns Tuple (name, offset) or None
+        """
+        idx = bisect.bisect_right(self.addrs, addr) - 1
+        if idx < 0:
+            return None
+        return (self.names[idx], addr - self.addrs[idx])
+
+    def name(self, addr, offset=True):
+        """ Get printable name for address
+        @param offset Include offset from label
+        """
+        res = self.lookup(addr)
+        if res is None:
+            return '%.8X' % (addr)
+        if not offset or res[1] == 0:
+            return res[0]
+        return '%s+0x%x' % res
+
+    def toText(self):
+        """ Get symbols as text, one "ADDRESS name" per line
+        """
+        items = sorted((addr, name) for (name, addr) in self.symbols.items())
+        return ''.join('%.8X %s\n' % (addr, name) for (addr, name) in items)
+
+    @staticmethod
+    def parse(lines):
+        """ Parse symbols from "ADDRESS name" lines
+        """
+        symbols = {}
+        for line in lines:
+            line = line.strip()
+            if not line or line[0] == '#':
+                continue
+            (addr, name) = line.split(None, 1)
+            symbols[name.strip()] = int(addr, 16)
+        return SymbolTable(symbols)
+
+    @staticmethod
+    def load(fname):
+        f = open(fname, 'r')
+        try:
+            return SymbolTable.parse(f.readlines())
+        finally:
+            f.close()
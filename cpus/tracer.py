@@ -0,0 +1,284 @@
+import struct
+import sys
+
+if sys.version >= '3':
+    xrange = range
+
+class TraceRecorder:
+    """ Record executed instructions as fixed size binary records
+
+    Records go to preallocated ring buffer, so only the last records are
+    kept. When stream is given the buffer is written out whenever it
+    fills up, and the whole execution is kept.
+
+    >>> from assembler import assembleSource
+    >>> from runner import imageMachine
+    >>> image = assembleSource('''
+    ... LOADi num
+    ... ADD r0, 0, 2
+    ... STOREi num
+    ... STOP
+    ... .data
+    ... num: dd 40
+    ... ''')
+    >>> (cpu, term, clock) = imageMachine(image, echo=False)
+    >>> t = TraceRecorder(3, cpu=cpu)
+    >>> cpu.run()
+    stopped: instructions=4, cycles=15, pc=00000010
+    >>> t.detach()
+    >>> t.count
+    4
+    >>> for rec in t.records():
+    ...     print (formatRecord(rec))
+             8 00000004 ADD r0, 0, 2
+            13 00000008 STORE32i 0x10            store 4 @00000010 = 0000002A
+            15 0000000C STOP
+
+    Buffer which is exactly filled keeps all records:
+
+    >>> (cpu, term, clock) = imageMachine(image, echo=False)
+    >>> t = TraceRecorder(4, cpu=cpu)
+    >>> cpu.run()
+    stopped: instructions=4, cycles=15, pc=00000010
+    >>> t.detach()
+    >>> [rec[0] for rec in t.records()]
+    [0, 4, 8, 12]
+
+    Recorder without memory tracing doesn't remove hooks of others:
+
+    >>> (cpu, term, clock) = imageMachine(image, echo=False)
+    >>> a = TraceRecorder(4, cpu=cpu)
+    >>> b = TraceRecorder(4, memory=False, cpu=cpu)
+    >>> b.detach()
+    >>> cpu.run()
+    stopped: instructions=4, cycles=15, pc=00000010
+    >>> a.detach()
+    >>> [rec[5] for rec in a.records()]
+    [20, 0, 36, 0]
+    >>> 'load' in cpu.__dict__ or 'store' in cpu.__dict__
+    False
+    """
+    # Record: pc, instruction word, cycle after instruction, memory address, value, access
+    record = struct.Struct('<IIQIIBxxx')
+    # Trace file header: magic, record size, version
+    header = struct.Struct('<4sII')
+    version = 1
+
+    # Memory access of record, low bits are access size in bytes
+    NONE = 0x00
+    LOAD = 0x10
+    STORE = 0x20
+
+    def __init__(self, size=1024*1024, stream=None, memory=True, cpu=None):
+        """ Initialize recorder
+        @param size Number of records in buffer
+        @param stream File to write all records to, or None to keep last records only
+        @param memory Record load and store addresses and values
+        @param cpu CPU to attach to
+        """
+        self.size = size
+        self.buf = bytearray(size * self.record.size)
+        self.stream = stream
+        self.memory = memory
+        self.cpu = None
+        # Hooked memory functions as (name, hook, previous)
+        self.hooked = []
+        # Next record index in buffer
+        self.pos = 0
+        # Total number of recorded instructions
+        self.count = 0
+        self.resetAccess()
+        if stream is not None:
+            stream.write(self.header.pack(b'RT01', self.record.size, self.version))
+        if cpu is not None:
+            self.attach(cpu)
+
+    def resetAccess(self):
+        self.access = self.NONE
+        self.addr = 0
+        self.value = 0
+
+    def attach(self, cpu):
+        """ Start recording, see RISC1.instrument
+        """
+        self.cpu = cpu
+        self.handle = cpu.instrument(self.wrap)
+        if self.memory:
+            self.hookMemory(cpu)
+
+    def detach(self):
+        """ Stop recording and flush stream
+        """
+        if self.cpu is not None:
+            self.cpu.uninstrument(self.handle)
+            self.unhookMemory()
+        self.cpu = None
+        self.flush()
+
+    def hookMemory(self, cpu):
+        """ Catch loads and stores done by instructions
+        """
+        load = cpu.load
+        store = cpu.store
+        wordsize = cpu.wordsize
+        tracer = self
+
+        def tracedLoad(imm, size=None):
+            if size is None:
+                size = wordsize
+            value = load(imm, size)
+            if tracer.cpu is None:
+                return value
+            tracer.access = tracer.LOAD | size
+            tracer.addr = imm
+            tracer.value = value
+            return value
+
+        def tracedStore(imm, data, size=None):
+            if size is None:
+                size = wordsize
+            store(imm, data, size)
+            if tracer.cpu is None:
+                return
+            tracer.access = tracer.STORE | size
+            tracer.addr = imm
+            tracer.value = data
+
+        for (name, func) in (('load', tracedLoad), ('store', tracedStore)):
+            self.hooked.append((name, func, cpu.__dict__.get(name, None)))
+            setattr(cpu, name, func)
+
+    def unhookMemory(self):
+        """ Restore load and store, unless another recorder hooked them after this
+        """
+        cpu = self.cpu
+        for (name, func, previous) in self.hooked:
+            if cpu.__dict__.get(name, None) is not func:
+                continue
+            if previous is None:
+                delattr(cpu, name)
+            else:
+                setattr(cpu, name, previous)
+        self.hooked = []
+
+    def wrap(self, op, handler):
+        """ Get wrapper appending record after handler
+        """
+        cpu = self.cpu
+        regs = cpu.regs
+        pcreg = cpu.pc
+        wordsize = cpu.wordsize
+        pack = self.record.pack_into
+        recsize = self.record.size
+        tracer = self
+
+        def traced(op_, imm, rx, ry, ri):
+            pc = regs[pcreg] - wordsize
+            try:
+                return handler(op_, imm, rx, ry, ri)
+            finally:
+                pos = tracer.pos
+                pack(tracer.buf, pos * recsize, pc & 0xFFFFFFFF, op_ | (imm << 8),
+                    cpu.cycle, tracer.addr & 0xFFFFFFFF, tracer.value & 0xFFFFFFFF, tracer.access)
+                if tracer.access:
+                    tracer.access = 0
+                    tracer.addr = 0
+                    tracer.value = 0
+                tracer.count += 1
+                pos += 1
+                if pos >= tracer.size:
+                    pos = 0
+                    if tracer.stream is not None:
+                        tracer.stream.write(tracer.buf)
+                tracer.pos = pos
+        return traced
+
+    def flush(self):
+        """ Write buffered records to stream
+        """
+        if self.stream is None:
+            return
+        if self.pos:
+            self.stream.write(self.buf[:self.pos * self.record.size])
+            self.pos = 0
+        self.stream.flush()
+
+    def data(self):
+        """ Get records in buffer as bytes, oldest first
+        """
+        split = self.pos * self.record.size
+        if self.stream is None and self.count >= self.size:
+            return bytes(self.buf[split:] + self.buf[:split])
+        return bytes(self.buf[:split])
+
+    def records(self):
+        """ Get records in buffer, oldest first
+        """
+        data = self.data()
+        for pos in xrange(0, len(data), self.record.size):
+            yield self.record.unpack_from(data, pos)
+
+    def write(self, f):
+        """ Write buffered records as trace file
+        """
+        f.write(self.header.pack(b'RT01', self.record.size, self.version))
+        f.write(self.data())
+
+    def save(self, fname):
+        f = open(fname, 'wb')
+        try:
+            self.write(f)
+        finally:
+            f.close()
+
+def readTrace(f):
+    """ Read records from trace file, incomplete last record is skipped
+
+    >>> import io
+    >>> t = TraceRecorder(2)
+    >>> t.buf[:t.record.size] = t.record.pack(8, 0xFF, 20, 0, 0, 0)
+    >>> t.pos = 1
+    >>> t.count = 1
+    >>> f = io.BytesIO()
+    >>> t.write(f)
+    >>> list(readTrace(io.BytesIO(f.getvalue() + b'xx')))
+    [(8, 255, 20, 0, 0, 0)]
+    """
+    header = TraceRecorder.header
+    head = f.read(header.size)
+    if len(head) < header.size:
+        raise ValueError('Not a trace file')
+    (magic, recsize, version) = header.unpack(head)
+    if magic != b'RT01':
+        raise ValueError('Not a trace file')
+    if recsize != TraceRecorder.record.size or version != TraceRecorder.version:
+        raise ValueError('Unsupported trace version %s, record size %s' % (version, recsize))
+
+    unpack = TraceRecorder.record.unpack_from
+    chunk = recsize * 4096
+    while True:
+        data = f.read(chunk)
+        for pos in xrange(0, len(data) - recsize + 1, recsize):
+            yield unpack(data, pos)
+        if len(data) < chunk:
+            return
+
+def formatRecord(rec, opcodes=None, symbols=None):
+    """ Format trace record as text line
+    @param opcodes Opcodes used for disassembly
+    @param symbols SymbolTable for naming PC, or None
+    """
+    if opcodes is None:
+        from opcodes import Opcodes
+        opcodes = Opcodes()
+    (pc, word, cycle, addr, value, access) = rec
+    where = '%.8X' % (pc)
+    if symbols is not None:
+        where = '%s %-20s' % (where, symbols.name(pc))
+    line = '%10d %s %s' % (cycle, where, opcodes.disassemble(word & 0xFF, word >> 8))
+    if access:
+        kind = 'load'
+        if access & TraceRecorder.STORE:
+            kind = 'store'
+        line = '%-44s %s %d @%.8X = %.8X' % (line, kind, access & 0xF, addr, value)
+    return line
@@ -0,0 +1,492 @@
+import sys
+
+if sys.version >= '3':
+    xrange = range
+
+
+class Block:
+    """ One translated basic block
+    """
+    def __init__(self, start, phys, func=None, count=0, cycles=0, source=''):
+        self.start = start
+        self.phys = phys
+        self.func = func
+        self.count = count
+        self.cycles = cycles
+        self.source = source
+        self.valid = True
+        # Chained successor blocks keyed by virtual target address
+        self.links = {}
+
+
+class BlockTranslator:
+    """ Translates guest basic blocks into Python functions
+
+    Block is a run of instructions ending at branch, at instruction
+    which needs the interpreter (STOP, IRET, MAP, INTVEC, PUSH, POP, ...),
+    at page boundary or at maximum block length.
+    Registers are kept in function locals for the length of the block.
+
+    Self modifying code leaves the block after the store, and counts
+    the same as interpreted:
+
+    >>> from assembler import assembleSource
+    >>> from runner import imageMachine
+    >>> image = assembleSource('''
+    ... LOADi patch
+    ... STOREi target
+    ... target:
+    ... ADD r1, 0, 1
+    ... ADD r1, 0, 1
+    ... STOP
+    ... .data
+    ... patch: dd 0xFF
+    ... ''')
+    >>> (cpu, term, clock) = imageMachine(image, echo=False)
+    >>> cpu.run()
+    stopped: instructions=3, cycles=12, pc=0000000C
+    >>> (cpu, term, clock) = imageMachine(image, echo=False)
+    >>> cpu.enableTranslation()
+    >>> cpu.run()
+    stopped: instructions=3, cycles=12, pc=0000000C
+    >>> cpu.regs[1]
+    0
+    """
+    pagesize = 0x1000
+    maxlen = 64
+
+    # Fetch and decode cycles, charged also for faulting instruction
+    fetchcost = 2
+    # Cycles per instruction, fetch and decode included
+    costs = {
+        'loadstore': 2 + 3,
+        'mov': 2 + 2,
+        'alu': 2 + 1,
+        'branch': 2 + 5,
+        }
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.blocks = {}
+        self.pages = {}
+        self.namespace = {
+            'load': cpu.load,
+            'store': cpu.store,
+            'alu': cpu.alu,
+            }
+        self.regcnt = len(cpu.regs)
+        # Results wrap to ALU word size
+        self.mask = cpu.alu.mask
+        self.retreg = self.regName(cpu.retreg)
+        self.gen = {}
+        for (op, name) in cpu.opcodes.opcodes.items():
+            gen = getattr(self, 'gen%s' % (name), None)
+            if gen is not None:
+                self.gen[op] = gen
+        cpu.mem.addWriteWatcher(self.invalidate)
+
+    def flush(self):
+        """ Drop all translated blocks
+        """
+        for blk in self.blocks.values():
+            blk.valid = False
+        self.blocks = {}
+        self.pages = {}
+
+    def invalidate(self, page):
+        """ Drop blocks on written memory page
+        """
+        for blk in self.pages.pop(page, ()):
+            blk.valid = False
+            if self.blocks.get(blk.phys, None) is blk:
+                del self.blocks[blk.phys]
+
+    def lookup(self, pos):
+        """ Get block starting at virtual address, translate if needed
+        """
+        mmu = self.cpu.mmu
+        phys = pos
+        if mmu.isEnabled():
+            (phys, flags) = mmu.translate(pos)
+            if not flags.bits & flags.EXECUTE:
+                raise IndexError('Page is not executable: %.8X' % (pos))
+
+        blk = self.blocks.get(phys, None)
+        if blk is None or blk.start != pos:
+            blk = self.translate(pos, phys)
+        return blk
+
+    def translate(self, pos, phys):
+        """ Translate block starting at virtual pos, physical phys
+        """
+        cpu = self.cpu
+        wordsize = cpu.wordsize
+        page = pos // self.pagesize
+        insts = []
+        addr = pos
+        while len(insts) < self.maxlen:
+            if (addr + wordsize - 1) // self.pagesize != page:
+                break
+            try:
+                inst = cpu.mem.getData(phys + addr - pos, wordsize)
+            except IndexError:
+                break
+            op = inst & 0xFF
+            (rx, ry, ri) = cpu.solveRegIndexes(inst >> 8)
+            gen = self.gen.get(op, None)
+            if gen is None or not self.validRegs(rx, ry):
+                break
+            rx = self.regName(rx)
+            ry = self.regName(ry)
+            addr += wordsize
+            res = gen(inst >> 8, rx, ry, ri, addr)
+            if res is None:
+                addr -= wordsize
+                break
+            insts.append((addr, res))
+            if res[0] == 'branch':
+                break
+
+        if insts:
+            (func, cycles, source) = self.compile(pos, insts, addr)
+        else:
+            (func, cycles, source) = (None, 0, '')
+        blk = Block(pos, phys, func, len(insts), cycles, source)
+
+        self.blocks[phys] = blk
+        first = cpu.mem.watchPage(phys)
+        last = cpu.mem.watchPage(phys + max(addr - pos, wordsize) - 1)
+        for index in xrange(first, last + 1):
+            self.pages.setdefault(index, []).append(blk)
+        return blk
+
+    def validRegs(self, rx, ry):
+        """ PC is not kept in locals, so instructions using it are interpreted
+        """
+        for reg in (rx, ry):
+            if reg is not None and (reg >= self.regcnt or reg == self.cpu.pc):
+                return False
+        return True
+
+    def regName(self, reg):
+        """ Local variable name for register index
+        """
+        if reg is None:
+            return None
+        return 'r%d' % (reg)
+
+    def compile(self, pos, insts, end):
+        """ Generate and compile Python function for block
+
+        Function accounts retired instructions and cycles to CPU, and
+        returns next PC. Block may be left early when guest overwrites it.
+        On fault PC and accounting are left as interpreter leaves them:
+
+        >>> from assembler import assembleSource
+        >>> from runner import imageMachine
+        >>> image = assembleSource('''
+        ... MOV r1, 0, 8
+        ... MOV r2, 0, 0
+        ... ADD r1, 0, 1
+        ... LOADi num
+        ... DIV r1, r2
+        ... ADD r1, 0, 1
+        ... STOP
+        ... .data
+        ... num: dd 1
+        ... ''')
+        >>> for translate in (False, True):
+        ...     (cpu, term, clock) = imageMachine(image, echo=False)
+        ...     cpu.enableTranslation(translate)
+        ...     res = cpu.run()
+        ...     print ((res.reason, res.instructions, res.cycles, res.pc, cpu.regs[0], cpu.regs[1]))
+        ('fault', 4, 18, 20, 1, 9)
+        ('fault', 4, 18, 20, 1, 9)
+        """
+        used = set()
+        written = set()
+        body = []
+        cycles = 0
+        # Cycles of instructions before each one, accounted on fault
+        before = []
+        for (index, (npc, (family, lines, reads, writes))) in enumerate(insts):
+            before.append(cycles)
+            cycles += self.costs[family]
+            used.update(reads)
+            used.update(writes)
+            written.update(writes)
+            body += lines
+            if lines and lines[-1].startswith('store('):
+                # Guest may have overwritten this block
+                body.append('if not blk.valid:')
+                body += ['    ' + x for x in self.writeback(written)]
+                body.append('    cpu.instret += %d' % (index + 1))
+                body.append('    cpu.cycle += %d' % (cycles))
+                body.append('    return %d' % (npc))
+
+        if insts[-1][1][0] != 'branch':
+            body.append('_pc = %d' % (end))
+
+        src = ['def block(regs, cpu, blk):']
+        for reg in sorted(used):
+            src.append('    %s = regs[%s]' % (reg, reg[1:]))
+        wordsize = self.cpu.wordsize
+        src.append('    _fpc = %d' % (pos + wordsize))
+        src.append('    try:')
+        src += ['        ' + x for x in body]
+        src.append('    except Exception:')
+        src += ['        ' + x for x in self.writeback(written)]
+        src.append('        regs[%d] = _fpc' % (self.cpu.pc))
+        src.append('        _done = (_fpc - %d) // %d' % (pos + wordsize, wordsize))
+        src.append('        cpu.instret += _done')
+        src.append('        cpu.cycle += %r[_done] + %d' % (tuple(before), self.fetchcost))
+        src.append('        raise')
+        src += ['    ' + x for x in self.writeback(written)]
+        src.append('    cpu.instret += %d' % (len(insts)))
+        src.append('    cpu.cycle += %d' % (cycles))
+        src.append('    return _pc')
+        source = '\n'.join(src) + '\n'
+
+        namespace = dict(self.namespace)
+        code = compile(source, '<block %.8X>' % (pos), 'exec')
+        exec(code, namespace)
+        return (namespace['block'], cycles, source)
+
+    def writeback(self, written):
+        res = []
+        for reg in sorted(written):
+            res.append('regs[%s] = %s' % (reg[1:], reg))
+        if not res:
+            res.append('pass')
+        return res
+
+    # Code generators, each returns (family, lines, read regs, written regs)
+    # or None if instruction can't be translated
+
+    def genLoadi(self, imm, size, npc):
+        return ('loadstore', ['_fpc = %d' % (npc), 'r0 = load(%d, %d)' % (imm, size)], [], ['r0'])
+
+    def genStorei(self, imm, size, npc):
+        return ('loadstore', ['_fpc = %d' % (npc), 'store(%d, r0, %d)' % (imm, size)], ['r0'], [])
+
+    def genLoad(self, rx, ry, size, npc):
+        if rx is None:
+            return None
+        reads = []
+        addr = '0'
+        if ry is not None:
+            addr = ry
+            reads.append(ry)
+        return ('loadstore', ['_fpc = %d' % (npc), '%s = load(%s, %d)' % (rx, addr, size)], reads, [rx])
+
+    def genStore(self, rx, ry, size, npc):
+        if ry is None:
+            ry = 'r0'
+        reads = [ry]
+        addr = '0'
+        if rx is not None:
+            addr = rx
+            reads.append(rx)
+        return ('loadstore', ['_fpc = %d' % (npc), 'store(%s, %s, %d)' % (addr, ry, size)], reads, [])
+
+    def genLOAD8i(self, imm, rx, ry, ri, npc):
+        return self.genLoadi(imm, 1, npc)
+
+    def genLOAD16i(self, imm, rx, ry, ri, npc):
+        return self.genLoadi(imm, 2, npc)
+
+    def genLOAD32i(self, imm, rx, ry, ri, npc):
+        return self.genLoadi(imm, 4, npc)
+
+    def genSTORE8i(self, imm, rx, ry, ri, npc):
+        return self.genStorei(imm, 1, npc)
+
+    def genSTORE16i(self, imm, rx, ry, ri, npc):
+        return self.genStorei(imm, 2, npc)
+
+    def genSTORE32i(self, imm, rx, ry, ri, npc):
+        return self.genStorei(imm, 4, npc)
+
+    def genLOAD8(self, imm, rx, ry, ri, npc):
+        return self.genLoad(rx, ry, 1, npc)
+
+    def genLOAD16(self, imm, rx, ry, ri, npc):
+        return self.genLoad(rx, ry, 2, npc)
+
+    def genLOAD32(self, imm, rx, ry, ri, npc):
+        return self.genLoad(rx, ry, 4, npc)
+
+    def genSTORE8(self, imm, rx, ry, ri, npc):
+        return self.genStore(rx, ry, 1, npc)
+
+    def genSTORE16(self, imm, rx, ry, ri, npc):
+        return self.genStore(rx, ry, 2, npc)
+
+    def genSTORE32(self, imm, rx, ry, ri, npc):
+        return self.genStore(rx, ry, 4, npc)
+
+    def genLOADADDRi(self, imm, rx, ry, ri, npc):
+        return ('loadstore', ['r0 = %d' % (imm)], [], ['r0'])
+
+    def genMOV(self, imm, rx, ry, ri, npc):
+        if rx is None:
+            return None
+        reads = []
+        src = []
+        if ry is not None:
+            src.append(ry)
+            reads.append(ry)
+        if ri is not None:
+            src.append('%d' % (ri))
+        if not src:
+            src.append('0')
+        line = '%s = %s' % (rx, ' + '.join(src))
+        if ri is not None:
+            line = '%s = (%s) & %d' % (rx, ' + '.join(src), self.mask)
+        return ('mov', [line], reads, [rx])
+
+    def genMOVi(self, imm, rx, ry, ri, npc):
+        return ('mov', ['r0 = %d' % (imm)], [], ['r0'])
+
+    def genSWP(self, imm, rx, ry, ri, npc):
+        if rx is None or ry is None:
+            return None
+        if ri is None:
+            ri = 0
+        line = '%s, %s = (%s + %d) & %d, (%s + %d) & %d' % (rx, ry, ry, ri, self.mask, rx, ri, self.mask)
+        return ('mov', [line], [rx, ry], [rx, ry])
+
+    def genArith(self, func, rx, ry, ri, npc):
+        if rx is None:
+            return ('alu', [], [], [])
+        reads = [rx]
+        yval = '0'
+        if ry is not None:
+            yval = ry
+            reads.append(ry)
+        ival = '%d' % (ri or 0)
+        if func == 'add':
+            lines = ['%s = (%s + %s + %s) & %d' % (rx, rx, yval, ival, self.mask)]
+        elif func == 'sub':
+            lines = ['%s = (%s - %s - %s) & %d' % (rx, rx, yval, ival, self.mask)]
+        elif func == 'mul':
+            lines = ['%s = (%s * %s * %s) & %d' % (rx, rx, yval, ival, self.mask)]
+        else:
+            lines = ['_fpc = %d' % (npc), '%s = alu.%s3(%s, %s, %s)' % (rx, func, rx, yval, ival)]
+        return ('alu', lines, reads, [rx])
+
+    def genADD(self, imm, rx, ry, ri, npc):
+        return self.genArith('add', rx, ry, ri, npc)
+
+    def genSUB(self, imm, rx, ry, ri, npc):
+        return self.genArith('sub', rx, ry, ri, npc)
+
+    def genMUL(self, imm, rx, ry, ri, npc):
+        return self.genArith('mul', rx, ry, ri, npc)
+
+    def genDIV(self, imm, rx, ry, ri, npc):
+        return self.genArith('div', rx, ry, ri, npc)
+
+    def genMOD(self, imm, rx, ry, ri, npc):
+        return self.genArith('mod', rx, ry, ri, npc)
+
+    def genShift(self, oper, rx, ry, ri):
+        if rx is None or ri is None:
+            return None
+        target = rx
+        if ry is not None:
+            target = ry
+        return ('alu', ['%s = (%s %s %d) & %d' % (target, rx, oper, ri, self.mask)], [rx], [target])
+
+    def genSHL(self, imm, rx, ry, ri, npc):
+        return self.genShift('<<', rx, ry, ri)
+
+    def genSHR(self, imm, rx, ry, ri, npc):
+        return self.genShift('>>', rx, ry, ri)
+
+    def genBitwise(self, oper, rx, ry):
+        if rx is None or ry is None:
+            return None
+        return ('alu', ['%s = (%s %s %s) & %d' % (rx, rx, oper, ry, self.mask)], [rx, ry], [rx])
+
+    def genAND(self, imm, rx, ry, ri, npc):
+        return self.genBitwise('&', rx, ry)
+
+    def genOR(self, imm, rx, ry, ri, npc):
+        return self.genBitwise('|', rx, ry)
+
+    def genXOR(self, imm, rx, ry, ri, npc):
+        return self.genBitwise('^', rx, ry)
+
+    def genNOT(self, imm, rx, ry, ri, npc):
+        if rx is None:
+            return None
+        target = rx
+        if ry is not None:
+            target = ry
+        return ('alu', ['%s = ~%s & %d' % (target, rx, self.mask)], [rx], [target])
+
+    def genBi(self, imm, rx, ry, ri, npc):
+        return ('branch', ['_pc = %d' % (imm)], [], [])
+
+    def genB(self, imm, rx, ry, ri, npc):
+        if rx is None:
+            return ('branch', ['_pc = %d' % (npc)], [], [])
+        return ('branch', ['_pc = %s' % (rx)], [rx], [])
+
+    def genCond(self, target, reg, cond, npc, reads):
+        line = '_pc = %s if %s %s 0 else %d' % (target, reg, cond, npc)
+        return ('branch', [line], reads + [reg], [])
+
+    def genBZi(self, imm, rx, ry, ri, npc):
+        return self.genCond('%d' % (imm), 'r0', '==', npc, [])
+
+    def genBNZi(self, imm, rx, ry, ri, npc):
+        return self.genCond('%d' % (imm), 'r0', '!=', npc, [])
+
+    def genBZ(self, imm, rx, ry, ri, npc):
+        if rx is None:
+            return None
+        return self.genCond(rx, ry or 'r0', '==', npc, [rx])
+
+    def genBNZ(self, imm, rx, ry, ri, npc):
+        if rx is None:
+            return None
+        return self.genCond(rx, ry or 'r0', '!=', npc, [rx])
+
+    def genCompare(self, cond, rx, ry, ri, npc):
+        if rx is None or ry is None or ri is None:
+            return None
+        line = '_pc = %d if %s %s %s else %d' % (npc + ri, rx, cond, ry, npc)
+        return ('branch', [line], [rx, ry], [])
+
+    def genBE(self, imm, rx, ry, ri, npc):
+        return self.genCompare('==', rx, ry, ri, npc)
+
+    def genBNE(self, imm, rx, ry, ri, npc):
+        return self.genCompare('!=', rx, ry, ri, npc)
+
+    def genBLE(self, imm, rx, ry, ri, npc):
+        if rx is None or ry is None:
+            return None
+        line = '_pc = %s + %d if %s == 0 else %d' % (rx, ri or 0, ry, npc)
+        return ('branch', [line], [rx, ry], [])
+
+    def genBSUBi(self, imm, rx, ry, ri, npc):
+        ret = self.retreg
+        lines = ['%s = %d' % (ret, npc + self.cpu.wordsize), '_pc = %d' % (imm)]
+        return ('branch', lines, [], [ret])
+
+    def genBSUB(self, imm, rx, ry, ri, npc):
+        ret = self.retreg
+        reads = []
+        target = '%d' % (ri or 0)
+        if rx is not None:
+            target = '%s + %s' % (rx, target)
+            reads.append(rx)
+        lines = ['%s = %d' % (ret, npc + self.cpu.wordsize), '_pc = %s' % (target)]
+        return ('branch', lines, reads, [ret])
+
+    def genBRET(self, imm, rx, ry, ri, npc):
+        ret = self.retreg
+        return ('branch', ['_pc = %s' % (ret)], [ret], [])
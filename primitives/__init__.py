@@ -8,6 +8,7 @@ from alu import ALU
 from intvec import IntVec
 from stack import Stack
 from clock import Clock
+from clock import VirtualClock
 
 
 __all__ = [ 'ALU',
@@ -15,4 +16,5 @@ __all__ = [ 'ALU',
         'MMU',
         'IntVec',
         'Stack',
-        'Clock' ]
+        'Clock',
+        'VirtualClock' ]
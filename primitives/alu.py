@@ -2,6 +2,10 @@
 class ALU:
     """ The most simple Arithemetic unit
     """
+    # Word size of the fixed arity operations, results wrap around
+    bits = 32
+    mask = 0xFFFFFFFF
+
     def add(self, *args):
         """ Add numbers together
 
@@ -208,6 +212,125 @@ class ALU:
         """
         return ~ r
 
+    def add3(self, r1, r2, r3):
+        """ Add three words, wraps to word size
+
+        >>> a = ALU()
+        >>> a.add3(1, 2, 3)
+        6
+        >>> '%x' % a.add3(0xFFFFFFFF, 1, 0)
+        '0'
+        """
+        return (r1 + r2 + r3) & self.mask
+
+    def sub3(self, r1, r2, r3):
+        """ Subtract two words from first, wraps to word size
+
+        >>> a = ALU()
+        >>> a.sub3(8, 5, 2)
+        1
+        >>> '%x' % a.sub3(0, 1, 0)
+        'ffffffff'
+        """
+        return (r1 - r2 - r3) & self.mask
+
+    def mul3(self, r1, r2, r3):
+        """ Multiply three words, wraps to word size
+
+        >>> a = ALU()
+        >>> a.mul3(1, 2, 3)
+        6
+        >>> '%x' % a.mul3(0x10000, 0x10000, 3)
+        '0'
+        """
+        return (r1 * r2 * r3) & self.mask
+
+    def div3(self, r1, r2, r3):
+        """ Unsigned divide first word with others
+
+        >>> a = ALU()
+        >>> a.div3(12, 2, 3)
+        2
+        >>> a.div3(7, 2, 1)
+        3
+        >>> a.div3(7, 2, 0)
+        Traceback (most recent call last):
+        ...
+        ZeroDivisionError: integer division or modulo by zero
+        """
+        return (r1 // r2 // r3) & self.mask
+
+    def mod3(self, r1, r2, r3):
+        """ Unsigned remainder of first word with others
+
+        >>> a = ALU()
+        >>> a.mod3(26, 11, 3)
+        1
+        """
+        return (r1 % r2 % r3) & self.mask
+
+    def shl32(self, r1, r2):
+        """ Shift left, wraps to word size
+
+        >>> a = ALU()
+        >>> a.shl32(3, 1)
+        6
+        >>> '%x' % a.shl32(0x80000001, 1)
+        '2'
+        """
+        return (r1 << r2) & self.mask
+
+    def shr32(self, r1, r2):
+        """ Logical shift right
+
+        >>> a = ALU()
+        >>> '%x' % a.shr32(0x80000000, 31)
+        '1'
+        """
+        return (r1 & self.mask) >> r2
+
+    def and32(self, r1, r2):
+        """ Bitwise and of words
+
+        >>> a = ALU()
+        >>> '%x' % a.and32(0x1FFFFFFFF, 0x0F0F0F0F)
+        'f0f0f0f'
+        >>> a.and32(0xF0, 0x0F)
+        0
+        """
+        return r1 & r2 & self.mask
+
+    def or32(self, r1, r2):
+        """ Bitwise or of words, wraps to word size
+
+        >>> a = ALU()
+        >>> '%x' % a.or32(0xF0F0F0F0, 0x0F0F0F0F)
+        'ffffffff'
+        >>> '%x' % a.or32(0x100000000, 1)
+        '1'
+        """
+        return (r1 | r2) & self.mask
+
+    def xor32(self, r1, r2):
+        """ Bitwise exclusive or of words
+
+        >>> a = ALU()
+        >>> '%x' % a.xor32(0xFFFFFFFF, 0x0F0F0F0F)
+        'f0f0f0f0'
+        """
+        return (r1 ^ r2) & self.mask
+
+    def not32(self, r):
+        """ Bitwise not of word, result is unsigned
+
+        >>> a = ALU()
+        >>> '%x' % a.not32(1)
+        'fffffffe'
+        >>> a.not32(0xFFFFFFFF)
+        0
+        """
+        return ~r & self.mask
+
     def forceInt(self, r):
         """ Force number to be integer
         
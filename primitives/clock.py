@@ -1,4 +1,18 @@
+from threading import RLock
 from threading import Timer
+import time
+
+def callback(callfunc, params):
+    """ Call function with params expanded as arguments
+    """
+    if params is None:
+        callfunc()
+    elif type(params) == dict:
+        callfunc(**params)
+    elif type(params) == list:
+        callfunc(*params)
+    else:
+        callfunc(params)
 
 class Clock:
     def __init__(self, hz=100, callfunc=None, params=None):
@@ -11,21 +25,27 @@ class Clock:
             self.hz = 100
         self.timer = None
         self.enabled = False
+        # Held while callback runs, so stop() waits for it
+        self.lock = RLock()
 
     def start(self):
         """ Start the timer
 
-        >>> def tmp(pars):
-        ...   print pars
+        >>> got = []
         >>> import time
-        >>> t = Clock(1000, tmp, 42)
+        >>> t = Clock(1000, got.append, 42)
         >>> t.start()
-        >>> time.sleep(0.5) #doctest: +ELLIPSIS
-        42...
+        >>> time.sleep(0.5)
         >>> t.stop()
+        >>> got[0]
+        42
+        >>> count = len(got)
+        >>> time.sleep(0.05)
+        >>> len(got) == count
+        True
         """
         self.enabled = True
-        self.timer = Timer(100.0/self.hz, self.run)
+        self.timer = Timer(1.0/self.hz, self.run)
         self.timer.start()
 
     def pause(self):
@@ -39,42 +59,140 @@ class Clock:
         self.enabled = True
 
     def stop(self):
-        """ Stop the timer
+        """ Stop the timer, callback is not called after this returns
         """
-        self.callfunc = None
-        self.enabled = False
+        self.lock.acquire()
+        try:
+            self.callfunc = None
+            self.enabled = False
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        finally:
+            self.lock.release()
 
     def run(self):
         """ On timer hit run callback function
+        >>> got = []
         >>> def tmp_list(*pars):
-        ...   print pars
+        ...   got.append(pars)
         >>> def tmp_dict(**pars):
-        ...   print pars
+        ...   got.append(pars)
         >>> import time
         >>> t = Clock(1000, tmp_list, [1,2])
         >>> t.start()
-        >>> time.sleep(0.5) #doctest: +ELLIPSIS
-        (1, 2)...
+        >>> time.sleep(0.5)
         >>> t.stop()
+        >>> got[0]
+        (1, 2)
+        >>> got = []
         >>> t = Clock(1000, tmp_dict, {'test': 42, 'val': 5})
         >>> t.start()
-        >>> time.sleep(0.5) #doctest: +ELLIPSIS
-        {'test': 42, 'val': 5}...
+        >>> time.sleep(0.5)
         >>> t.stop()
+        >>> sorted(got[0].items())
+        [('test', 42), ('val', 5)]
         """
-        if self.callfunc is None:
-            return
-        if not self.enabled:
+        self.lock.acquire()
+        try:
+            callfunc = self.callfunc
+            if callfunc is None:
+                return
+            if not self.enabled:
+                self.start()
+                return
+
+            callback(callfunc, self.params)
+
             self.start()
+        finally:
+            self.lock.release()
+
+class VirtualClock:
+    def __init__(self, cycles=10000, callfunc=None, params=None, hz=None):
+        """ Initialize timer driven by emulated cycles
+
+        CPU calls tick() when its cycle counter reaches the deadline,
+        so ticks happen at the same cycles on every run.
+        @param cycles Emulated cycles between ticks
+        @param hz Optionally pace ticks to this wall clock rate
+        """
+        self.callfunc = callfunc
+        self.params = params
+        self.cycles = cycles
+        if self.cycles <= 0:
+            self.cycles = 10000
+        self.hz = hz
+        self.deadline = None
+        self.ticks = 0
+        self.walltime = None
+        self.enabled = False
+
+    def start(self, cycle=0):
+        """ Start the timer, first tick at cycle + period
+
+        >>> def tmp(pars):
+        ...   print (pars)
+        >>> t = VirtualClock(100, tmp, 42)
+        >>> t.start(50)
+        >>> t.deadline
+        150
+        >>> t.tick(149)
+        >>> t.tick(150)
+        42
+        >>> t.deadline
+        250
+        >>> t.tick(480)
+        42
+        >>> t.deadline
+        550
+        >>> t.ticks
+        2
+        >>> t.stop()
+        >>> t.tick(550)
+        >>> t.deadline is None
+        True
+        """
+        self.enabled = True
+        self.deadline = cycle + self.cycles
+        self.ticks = 0
+        self.walltime = time.time()
+
+    def pause(self):
+        """ Temporarily pause the timer, deadlines still advance
+        """
+        self.enabled = False
+
+    def unpause(self):
+        """ Continue paused timer
+        """
+        self.enabled = True
+
+    def stop(self):
+        """ Stop the timer
+        """
+        self.callfunc = None
+        self.enabled = False
+        self.deadline = None
+
+    def tick(self, cycle):
+        """ Advance timer to cycle, run callback when deadline is passed
+
+        Missed ticks are not replayed, callback runs once per call.
+        """
+        if self.deadline is None or cycle < self.deadline:
+            return
+
+        while self.deadline <= cycle:
+            self.deadline += self.cycles
+
+        if not self.enabled or self.callfunc is None:
             return
 
-        if self.params is None:
-            self.callfunc()
-        elif type(self.params) == dict:
-            self.callfunc(**self.params)
-        elif type(self.params) == list:
-            self.callfunc(*self.params)
-        else:
-            self.callfunc(self.params)
+        self.ticks += 1
+        if self.hz:
+            delay = self.walltime + float(self.ticks) / self.hz - time.time()
+            if delay > 0:
+                time.sleep(delay)
 
-        self.start()
+        callback(self.callfunc, self.params)
@@ -10,6 +10,9 @@ class IntVec:
         self.interrupts = []
         self.intcnt = intcnt
         self.enabled = False
+        # Higher priority interrupts are served first
+        self.priorities = [0] * intcnt
+        self.prioritized = False
 
     def isEnabled(self):
         """ Check whether interrupts are enabled
@@ -47,6 +50,53 @@ class IntVec:
         else:
             self.enabled = False
 
+    def setPriority(self, num, priority):
+        """ Set priority of interrupt, default is 0
+
+        >>> i = IntVec()
+        >>> i.setPriority(2, 5)
+        >>> i.getPriority(2)
+        5
+        >>> i.setPriority(4, 1)
+        Traceback (most recent call last):
+        ...
+        IndexError: No such interrupt: 4
+        """
+        if num < 0 or num >= self.intcnt:
+            raise IndexError('No such interrupt: %s' % (num))
+        self.priorities[num] = priority
+        self.prioritized = max(self.priorities) != min(self.priorities)
+
+    def getPriority(self, num):
+        if num >= 0 and num < self.intcnt:
+            return self.priorities[num]
+        return 0
+
+    def selectPending(self, pending):
+        """ Take next interrupt to serve from pending queue
+        Highest priority first, in order of arrival within same priority
+
+        >>> import collections
+        >>> i = IntVec()
+        >>> q = collections.deque([1, 3, 2])
+        >>> i.selectPending(q)
+        1
+        >>> i.setPriority(2, 1)
+        >>> i.selectPending(q)
+        2
+        >>> list(q)
+        [3]
+        """
+        if not self.prioritized:
+            return pending.popleft()
+
+        best = None
+        for num in pending:
+            if best is None or self.getPriority(num) > self.getPriority(best):
+                best = num
+        pending.remove(best)
+        return best
+
     def read(self, mem, mempos, wordsize):
         """ Read the interrupt vector table
 
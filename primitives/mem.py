@@ -1,37 +1,142 @@
+import bisect
 import math
+import struct
 import sys
 if sys.version >= '3':
     xrange = range
 
+_structs = {
+    1: struct.Struct('<B'),
+    2: struct.Struct('<H'),
+    4: struct.Struct('<I'),
+    8: struct.Struct('<Q'),
+    }
+_U8 = _structs[1]
+_U16 = _structs[2]
+_U32 = _structs[4]
+
 class Mem(object):
     """ Contains main memory for CPU
+
+    By default memory is stored in sparse pages allocated on first write.
+    Flat memory is one contiguous bytearray, with fast paths for word
+    sized accesses when there are no special handlers or submemory.
+
+    >>> m = Mem(0x2000, flat=True)
+    >>> m.write32(0x10, 0x12345678)
+    >>> '%x' % m.read32(0x10)
+    '12345678'
+    >>> '%x' % m.read16(0x12)
+    '1234'
+    >>> m.read8(0x10)
+    120
+    >>> m.setData(0x20, 0x1234, 2)
+    >>> m.getRaw(0x20)
+    52
+    >>> m.write16(0x1ffe, 0xabcd)
+    >>> '%x' % m.getData(0x1ffe, 2)
+    'abcd'
+    >>> m.read32(0x1ffe) #doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    IndexError: Given memory position is invalid: 8193, max size: 8192
+    >>> m.write32(0, 0x100000000) #doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ValueError: Gave too big number: 4294967296, ...
+    >>> m.enlarge(0x3000)
+    >>> m.write32(0x2ffc, 1)
+    >>> m.read32(0x2ffc)
+    1
     """
     _pagesize = 0x1000
     
-    def __init__(self, size=0):
+    def __init__(self, size=0, flat=False):
         """ Initialize the memory
 
         @param size Size of memory in bytes
+        @param flat Use one contiguous block of memory instead of pages
         """
         self._size = size
         if size == 0:
             self._autosize = True
         else:
             self._autosize = False
+        self._flat = flat
         self._submem = None
+        self._watchers = []
+        self._watched = set()
         self.reset()
         self._specials = {}
+        # Memory mapped devices, sorted by start address
+        self._devices = []
+        self._device_starts = []
+        # Pages having special handlers or devices
+        self._iopages = set()
+        self.updateFastPath()
 
     def getSize(self):
         """ Get memory size
         """
         return self._size
 
+    def isFlat(self):
+        """ Is memory stored in one contiguous block
+        """
+        return self._flat
+
+    def updateFastPath(self):
+        """ Word sized accesses can go directly to flat memory
+        when nothing else needs to see them
+        """
+        self._fast = self._flat and self._submem is None
+
     def reset(self):
         """ Reset memory
         Initializes memory to given size
         """
         self._datas = {}
+        if self._flat:
+            self._data = bytearray(self._size)
+        for page in list(self._watched):
+            self.notifyWrite(page)
+
+    def addWriteWatcher(self, callback):
+        """ Add callback to be notified when watched page is written
+        @param callback Function called with page index
+        """
+        self._watchers.append(callback)
+
+    def watchPage(self, pos):
+        """ Watch page containing position for writes
+        Watch is one shot, it's cleared once page is written.
+        @param pos Position in memory
+        @returns Page index
+
+        >>> m = Mem(0x3000)
+        >>> pages = []
+        >>> m.addWriteWatcher(pages.append)
+        >>> m.watchPage(0x1004)
+        1
+        >>> m.setRaw(0x10, 1)
+        >>> pages
+        []
+        >>> m.setRaw(0x1010, 1)
+        >>> m.setRaw(0x1011, 1)
+        >>> pages
+        [1]
+        """
+        index = pos // self._pagesize
+        self._watched.add(index)
+        return index
+
+    def notifyWrite(self, page):
+        """ Notify watchers that page has been written
+        @param page Page index
+        """
+        self._watched.discard(page)
+        for callback in self._watchers:
+            callback(page)
 
     def addSpecial(self, mem, handler_get, handler_set):
         """ Add special handler for certain memory location
@@ -86,6 +191,72 @@ class Mem(object):
         if mem in self._specials:
             raise ValueError("Special memory handler already registered to %s" % mem)
         self._specials[mem] = (handler_get, handler_set)
+        self._iopages.add(mem // self._pagesize)
+
+    def addDevice(self, start, size, device):
+        """ Add memory mapped device for address range
+        Device gets whole accesses instead of single bytes:
+        device.ioRead(offset, size) and device.ioWrite(offset, size, value),
+        where offset is relative to start of the range.
+        @param start Start address
+        @param size Size of range in bytes
+        @param device Device instance
+
+        >>> class TestDev:
+        ...  def ioRead(self, offset, size):
+        ...   return offset * 0x100 + size
+        ...  def ioWrite(self, offset, size, value):
+        ...   print('write %s %s %x' % (offset, size, value))
+        >>> m = Mem(0x100, flat=True)
+        >>> m.addDevice(0x1000, 0x20, TestDev())
+        >>> m.setData(0x1004, 0x12345678, 4)
+        write 4 4 12345678
+        >>> m.getData(0x1010, 2)
+        4098
+        >>> m.setRaw(0x101f, 0xff)
+        write 31 1 ff
+        >>> m.setData(0x10, 0x1234, 2)
+        >>> m.getData(0x10, 2)
+        4660
+        >>> m.getRaw(0x1020) #doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        IndexError: Given memory position is invalid: 4128, max size: 256
+        >>> m.addDevice(0x101f, 4, TestDev()) #doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        ValueError: Device range overlaps: 0000101F-00001023
+        """
+        end = start + size
+        index = bisect.bisect_right(self._device_starts, start)
+        if index > 0 and self._devices[index - 1][1] > start:
+            raise ValueError("Device range overlaps: %.8X-%.8X" % (start, end))
+        if index < len(self._devices) and self._devices[index][0] < end:
+            raise ValueError("Device range overlaps: %.8X-%.8X" % (start, end))
+
+        self._devices.insert(index, (start, end, device))
+        self._device_starts.insert(index, start)
+        for page in xrange(start // self._pagesize, (end - 1) // self._pagesize + 1):
+            self._iopages.add(page)
+
+    def getDevice(self, pos):
+        """ Get device mapped at position
+        @returns Tuple (start, end, device) or None
+        """
+        index = bisect.bisect_right(self._device_starts, pos) - 1
+        if index >= 0:
+            item = self._devices[index]
+            if pos < item[1]:
+                return item
+        return None
+
+    def isIO(self, pos, size=1):
+        """ Check whether access may hit special handlers or devices
+        """
+        if not self._iopages:
+            return False
+        return (pos // self._pagesize in self._iopages
+            or (pos + size - 1) // self._pagesize in self._iopages)
 
     def getSpecial(self, pos):
         """ Get special location
@@ -110,6 +281,7 @@ class Mem(object):
         """
         self._submem = mem
         self._sub_pos = pos
+        self.updateFastPath()
 
     def enlarge(self, size):
         """ Enlarge memory size
@@ -117,12 +289,14 @@ class Mem(object):
         @param size New memory size
         """
         self._size = size
+        if self._flat and size > len(self._data):
+            self._data.extend(bytearray(size - len(self._data)))
 
     def setData(self, pos, data, size=4):
-        """ Set data, can be sized as 1..size bytes
+        """ Set data, all size bytes are written, same as in flat memory
         @param pos Position
         @param data data
-        @param size Maximum data length in bytes
+        @param size Data length in bytes
 
         >>> m = Mem(100)
         >>> m.setData(4, 0x123456)
@@ -133,18 +307,30 @@ class Mem(object):
         12345678
         >>> print "%x" % m.getData(8, 2)
         5678
+        >>> for flat in (False, True):
+        ...     m = Mem(100, flat=flat)
+        ...     m.setData(8, 0x12345678)
+        ...     m.setData(8, 0x9A, 4)
+        ...     print "%x" % m.getData(8, 4)
+        9a
+        9a
+        >>> m.setData(8, 0x100, 1) #doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        ValueError: Gave too big number: 256, ...
         """
-        tmp = data
-        cnt = 0
-        while tmp:
-            bval = tmp & 0xFF
-            tmp >>= 8
-            self.setRaw(pos, bval)
-            pos += 1
-            cnt += 1
-            if cnt > size:
-                raise ValueError('Gave too big number: %s, %s > %s' % (data, cnt, size))
-                break
+        if self._iopages and self.isIO(pos, size):
+            dev = self.getDevice(pos)
+            if dev is not None and pos + size <= dev[1]:
+                return dev[2].ioWrite(pos - dev[0], size, data)
+        elif self._fast and 0 <= pos and pos + size <= self._size and size in _structs:
+            return self.writeFlat(_structs[size], pos, data, size)
+
+        if data >> (size * 8):
+            raise ValueError('Gave too big number: %s, %s bytes' % (data, size))
+        for cnt in xrange(size):
+            self.setRaw(pos + cnt, data & 0xFF)
+            data >>= 8
 
     def getData(self, pos, size=1):
         """ Get data with size
@@ -152,6 +338,13 @@ class Mem(object):
         @param size Size in bytes
         @returns Data
         """
+        if self._iopages and self.isIO(pos, size):
+            dev = self.getDevice(pos)
+            if dev is not None and pos + size <= dev[1]:
+                return dev[2].ioRead(pos - dev[0], size)
+        elif self._fast and 0 <= pos and pos + size <= self._size and size in _structs:
+            return _structs[size].unpack_from(self._data, pos)[0]
+
         res = 0
         while size > 0:
             tmp = self.getRaw(pos + size - 1)
@@ -161,6 +354,163 @@ class Mem(object):
                 res <<= 8
         return res
 
+    def writeFlat(self, fmt, pos, data, size):
+        """ Write to flat memory, bounds already checked
+        """
+        if self._watched:
+            first = pos // self._pagesize
+            last = (pos + size - 1) // self._pagesize
+            for page in (first, last):
+                if page in self._watched:
+                    self.notifyWrite(page)
+        try:
+            fmt.pack_into(self._data, pos, data)
+        except struct.error:
+            raise ValueError('Gave too big number: %s, %s bytes' % (data, size))
+
+    def read8(self, pos):
+        """ Read one byte
+        """
+        if self._fast and 0 <= pos < self._size and not self.isIO(pos):
+            return self._data[pos]
+        return self.getData(pos, 1)
+
+    def read16(self, pos):
+        """ Read 16 bit little endian word
+        """
+        if self._fast and 0 <= pos <= self._size - 2 and not self.isIO(pos, 2):
+            return _U16.unpack_from(self._data, pos)[0]
+        return self.getData(pos, 2)
+
+    def read32(self, pos):
+        """ Read 32 bit little endian word
+        """
+        if self._fast and 0 <= pos <= self._size - 4 and not self.isIO(pos, 4):
+            return _U32.unpack_from(self._data, pos)[0]
+        return self.getData(pos, 4)
+
+    def write8(self, pos, data):
+        """ Write one byte
+        """
+        if self._fast and 0 <= pos < self._size and not self.isIO(pos):
+            return self.writeFlat(_U8, pos, data, 1)
+        return self.setData(pos, data, 1)
+
+    def write16(self, pos, data):
+        """ Write 16 bit little endian word
+        """
+        if self._fast and 0 <= pos <= self._size - 2 and not self.isIO(pos, 2):
+            return self.writeFlat(_U16, pos, data, 2)
+        return self.setData(pos, data, 2)
+
+    def write32(self, pos, data):
+        """ Write 32 bit little endian word
+        """
+        if self._fast and 0 <= pos <= self._size - 4 and not self.isIO(pos, 4):
+            return self.writeFlat(_U32, pos, data, 4)
+        return self.setData(pos, data, 4)
+
+    def setBytes(self, pos, data):
+        """ Copy block of bytes to memory
+        Copies whole pages at once, special handlers, devices and submemory
+        are written one byte at a time
+        @param pos Position
+        @param data Bytes to copy
+
+        >>> m = Mem(0x3000)
+        >>> m.setBytes(0xffe, bytearray([1, 2, 3, 4]))
+        >>> '%x' % m.getData(0xffe, 4)
+        '4030201'
+        >>> list(m.getBytes(0xffd, 6))
+        [0, 1, 2, 3, 4, 0]
+        >>> f = Mem(0x10, flat=True)
+        >>> f.setBytes(2, b'ab')
+        >>> list(f.getBytes(1, 4))
+        [0, 97, 98, 0]
+        >>> f.setBytes(0xf, b'ab') #doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        IndexError: Given memory position is invalid: 16, max size: 16
+        """
+        size = len(data)
+        if size == 0:
+            return
+        if pos < 0:
+            raise IndexError("Memory position needs to be positive number, got: %s" % (pos))
+        first = pos // self._pagesize
+        last = (pos + size - 1) // self._pagesize
+        if self._submem is not None or self.hasIO(first, last):
+            for (index, value) in enumerate(bytearray(data)):
+                self.setRaw(pos + index, value)
+            return
+
+        end = pos + size
+        if self._size < end:
+            if self._autosize or self._size == 0:
+                self.enlarge(end)
+            else:
+                raise IndexError("Given memory position is invalid: %s, max size: %s" % (end - 1, self._size))
+
+        if self._watched:
+            for page in [page for page in self._watched if first <= page <= last]:
+                self.notifyWrite(page)
+
+        if self._flat:
+            self._data[pos:end] = data
+            return
+
+        offset = 0
+        while offset < size:
+            (page, subindex) = self.getPage(pos + offset, create=True)
+            cnt = min(self._pagesize - subindex, size - offset)
+            page[subindex:subindex + cnt] = data[offset:offset + cnt]
+            offset += cnt
+
+    def getBytes(self, pos, size):
+        """ Copy block of bytes from memory
+        @param pos Position
+        @param size Number of bytes
+        @returns bytearray
+        """
+        if pos < 0:
+            raise IndexError("Memory position needs to be positive number, got: %s" % (pos))
+        first = pos // self._pagesize
+        last = (pos + size - 1) // self._pagesize
+        if self._submem is not None or self.hasIO(first, last):
+            return bytearray([self.getRaw(pos + index) for index in xrange(size)])
+        if pos + size > self._size:
+            raise IndexError("Given memory position is invalid: %s, max size: %s" % (pos + size - 1, self._size))
+
+        if self._flat:
+            return self._data[pos:pos + size]
+
+        res = bytearray()
+        offset = 0
+        while offset < size:
+            (page, subindex) = self.getPage(pos + offset)
+            cnt = min(self._pagesize - subindex, size - offset)
+            if page is None:
+                res.extend(bytearray(cnt))
+            else:
+                res.extend(page[subindex:subindex + cnt])
+            offset += cnt
+        return res
+
+    def hasIO(self, first, last):
+        """ Check whether pages from first to last have special handlers or devices
+        """
+        if not self._iopages:
+            return False
+        if last - first < len(self._iopages):
+            for page in xrange(first, last + 1):
+                if page in self._iopages:
+                    return True
+            return False
+        for page in self._iopages:
+            if first <= page <= last:
+                return True
+        return False
+
     def getBlock(self, pos, size=1):
         """ Get memory blocks at given position and given size
         May return multiple blocks if size is big enough or boundaries crossed
@@ -184,6 +534,10 @@ class Mem(object):
             items += 1
         pos = start
         for i in xrange(items):
+            if self._flat:
+                res.append((pos, self.getFlatPage(pos)))
+                pos += 1
+                continue
             try:
                 res.append((pos, self._datas[pos]))
             except:
@@ -191,6 +545,23 @@ class Mem(object):
             pos += 1
         return res
 
+    def getFlatPage(self, index):
+        """ Get page of flat memory
+
+        On Python 3 page is view to memory without copying. On Python 2
+        memoryview items are strings, so page is copied.
+        @param index Page index
+        @returns Page data or None if page is out of memory
+        """
+        start = index * self._pagesize
+        if start >= len(self._data):
+            return None
+        end = min(start + self._pagesize, len(self._data))
+        if sys.version >= '3':
+            return memoryview(self._data)[start:end]
+        # Python 2 memoryview items are strings
+        return self._data[start:end]
+
     def getPage(self, pos, create=False):
         """ Get page index
 
@@ -277,7 +648,13 @@ class Mem(object):
         if self._size == 0:
             self.enlarge(pos + 1)
 
-        special = self.getSpecial(pos)
+        special = None
+        if self._iopages and pos // self._pagesize in self._iopages:
+            special = self.getSpecial(pos)
+            if special is None:
+                dev = self.getDevice(pos)
+                if dev is not None:
+                    return dev[2].ioWrite(pos - dev[0], 1, data)
         if self._size < (pos + 1) and special is None:
             if self._autosize:
                 self.enlarge(pos + 1)
@@ -293,6 +670,13 @@ class Mem(object):
                 return hset(pos, data)
             return
 
+        if self._watched and pos // self._pagesize in self._watched:
+            self.notifyWrite(pos // self._pagesize)
+
+        if self._flat:
+            self._data[pos] = data
+            return
+
         (page, subindex) = self.getPage(pos, create=True)
         page[subindex] = data
 
@@ -306,7 +690,13 @@ class Mem(object):
                 raise IndexError("Sub memory size limit hit!")
             return self._submem.getRaw(self._sub_pos + pos)
 
-        special = self.getSpecial(pos)
+        special = None
+        if self._iopages and pos // self._pagesize in self._iopages:
+            special = self.getSpecial(pos)
+            if special is None:
+                dev = self.getDevice(pos)
+                if dev is not None:
+                    return dev[2].ioRead(pos - dev[0], 1)
         if self._size < pos and special is None:
             raise IndexError("Given memory position is invalid: %s, max size: %s" % (pos, self._size))
         if pos < 0:
@@ -318,6 +708,11 @@ class Mem(object):
                 return hget(pos)
             return 0
 
+        if self._flat:
+            if pos >= len(self._data):
+                raise IndexError("Given memory position is invalid: %s, max size: %s" % (pos, self._size))
+            return self._data[pos]
+
         (page, subindex) = self.getPage(pos)
         if page == None:
             return 0
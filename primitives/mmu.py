@@ -3,18 +3,29 @@ try:
 except ImportError:
     from mem import Mem
 
+import bisect
+import collections
 import sys
 if sys.version >= '3':
     xrange = range
 
 class MMU():
-    def __init__(self, mem, size=0):
+    # Smallest page size, TLB works on these
+    _pagesize = 0x1000
+    _pageshift = 12
+
+    def __init__(self, mem, size=0, tlbsize=64):
         """ Initialize MMU
+        @param mem Physical memory
+        @param tlbsize Number of translations cached in TLB
         """
         self._enabled = False
         self._mem = mem
         self._wordsize = 4
         self._table = []
+        self._tlbsize = tlbsize
+        self.resetIndex()
+        self.flushTLB()
 
     def isEnabled(self):
         return self._enabled
@@ -23,11 +34,127 @@ class MMU():
         """ Enables MMU
         """
         self._enabled = True
+        self.flushTLB()
 
     def disable(self):
         """ Disables MMU
         """
         self._enabled = False
+        self.flushTLB()
+
+    def flushTLB(self):
+        """ Drop all cached translations
+        """
+        self._tlb = {}
+        self._tlb_order = collections.deque()
+
+    def translate(self, pos):
+        """ Translate virtual address through TLB
+        @returns Tuple (physical address, flags)
+
+        >>> from primitives import Mem
+        >>> m = Mem(1024*100)
+        >>> u = MMU(m, tlbsize=2)
+        >>> # Page, virtual start at 24k, size 4k
+        >>> m.setData(10, 0x00006100, 4)
+        >>> # Page, virtual start at 32k, size 64k
+        >>> m.setData(14, 0x00008110, 4)
+        >>> tmp = u.initialize(10, 2)
+        >>> u.translate(0x6010)[0]
+        16
+        >>> u.translate(0x9010)[0]
+        8208
+        >>> u.translate(0x8010)[0]
+        4112
+        >>> len(u._tlb)
+        2
+        >>> u.translate(0x6011)[0]
+        17
+        >>> # Remapping flushes old translations
+        >>> m.setData(10, 0x00016100, 4)
+        >>> tmp = u.initialize(10, 2)
+        >>> u.translate(0x16010)[0]
+        16
+        >>> u.translate(0x6010) #doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        IndexError: No page mapped at virtual: 00006010
+        """
+        page = pos >> self._pageshift
+        try:
+            (base, flags) = self._tlb[page]
+        except KeyError:
+            (base, flags) = self.fillTLB(page, pos)
+        return (base + (pos & (self._pagesize - 1)), flags)
+
+    def fillTLB(self, page, pos):
+        """ Look up translation of one page from index and cache it
+        """
+        index = bisect.bisect_right(self._starts, pos) - 1
+        if index < 0 or pos >= self._ends[index]:
+            raise IndexError('No page mapped at virtual: %.8X' % (pos))
+        entry = (self._phys[index] + (page << self._pageshift) - self._starts[index], self._flags[index])
+
+        if self._tlbsize <= 0:
+            return entry
+        if len(self._tlb) >= self._tlbsize:
+            del self._tlb[self._tlb_order.popleft()]
+        self._tlb[page] = entry
+        self._tlb_order.append(page)
+        return entry
+
+    def resetIndex(self):
+        """ Clear sorted interval index of mapped ranges
+        """
+        self._starts = []
+        self._ends = []
+        self._phys = []
+        self._flags = []
+        self._physend = 0
+
+    def indexEntries(self, entries):
+        """ Add page entries to sorted interval index
+
+        Index ranges never overlap, earlier entries win over later ones.
+
+        >>> from primitives import Mem
+        >>> u = MMU(Mem())
+        >>> f = MMU.Flags(0x100)
+        >>> u.indexEntries([(0x8000, MMU.Flags(0x110), 0), (0x6000, f, 0x10000), (0x10000, f, 0x11000)])
+        >>> u.indexEntries([(0x5000, MMU.Flags(0x110), 0x12000)])
+        >>> [(hex(a), hex(b), hex(c)) for (a, b, c) in zip(u._starts, u._ends, u._phys)]
+        [('0x5000', '0x6000', '0x12000'), ('0x6000', '0x7000', '0x10000'), ('0x7000', '0x8000', '0x14000'), ('0x8000', '0x18000', '0x0')]
+        >>> u._physend
+        139264
+        """
+        starts = self._starts
+        ends = self._ends
+        physs = self._phys
+        flagss = self._flags
+        for item in entries:
+            (addr, end, phys) = self.getRange(item)
+            flags = item[1]
+            self._physend = max(self._physend, phys + end - addr)
+            offset = phys - addr
+
+            index = bisect.bisect_right(starts, addr)
+            if index > 0 and ends[index - 1] > addr:
+                addr = ends[index - 1]
+            while addr < end:
+                if index < len(starts) and starts[index] < end:
+                    stop = starts[index]
+                else:
+                    stop = end
+                if addr < stop:
+                    starts.insert(index, addr)
+                    ends.insert(index, stop)
+                    physs.insert(index, addr + offset)
+                    flagss.insert(index, flags)
+                    index += 1
+                if stop >= end:
+                    break
+                addr = ends[index]
+                index += 1
 
     def getEntries(self, entries, startpos=None):
         """ Get page entries and parse them, handle recursively
@@ -85,6 +212,36 @@ class MMU():
         """
         entries = self.readTable(tablepos, tablesize)
         self._table = self.getEntries(entries)
+        self.resetIndex()
+        self.indexEntries(self._table)
+        self.flushTLB()
+        return self._table
+
+    def extend(self, tablepos, tablesize):
+        """ Append page table to current mapping
+        Already mapped virtual ranges are kept as is
+
+        >>> from primitives import Mem
+        >>> m = Mem(1024*100)
+        >>> u = MMU(m)
+        >>> # Page, virtual start at 24k, size 4k
+        >>> m.setData(10, 0x00006100, 4)
+        >>> tmp = u.initialize(10, 1)
+        >>> # Pages, virtual start at 24k and 32k, size 4k
+        >>> m.setData(14, 0x00006100, 4)
+        >>> m.setData(18, 0x00008100, 4)
+        >>> len(u.extend(14, 2))
+        3
+        >>> u.virtToPhys(0x6010)
+        16
+        >>> u.virtToPhys(0x8010)
+        8208
+        """
+        entries = self.readTable(tablepos, tablesize, self._physend)
+        entries = self.getEntries(entries)
+        self._table = self._table + entries
+        self.indexEntries(entries)
+        self.flushTLB()
         return self._table
 
     def diffTime(self, a, b):
@@ -116,6 +273,24 @@ class MMU():
         (4096, execute=False,ok=True,size=65536,size1=True,size2=False,subtable=True,userspace=False,write=False, 0)
         >>> tmp[1]
         (32768, execute=False,ok=True,size=64,size1=True,size2=False,subtable=False,userspace=False,write=False, 67108864)
+
+        Table ending at end of memory, and table crossing page boundary:
+
+        >>> m = Mem(0x1008, flat=True)
+        >>> u = MMU(m)
+        >>> m.setData(0x1000, 0x00006100, 4)
+        >>> m.setData(0x1004, 0x00008100, 4)
+        >>> [hex(entry[0]) for entry in u.readTable(0x1000, 2)] == [hex(0x6000), hex(0x8000)]
+        True
+        >>> m = Mem(0x3000)
+        >>> u = MMU(m)
+        >>> for i in xrange(6):
+        ...   m.setData(0xFF6 + i * 4, 0x00010100 + i * 0x1000, 4)
+        >>> m.setData(0x100E, 0x00020100, 4)
+        >>> [hex(entry[0]) for entry in u.readTable(0xFF6, 5)] == [hex(0x10000 + i * 0x1000) for i in xrange(5)]
+        True
+        >>> len(u.readTable(0xFF6, 7))
+        7
         """
         import datetime
         datas = []
@@ -130,6 +305,8 @@ class MMU():
         oldtmp = 0
         items = 0
         preindex = 0
+        # Offset of first entry in block
+        index = tablepos % 0x1000
         for (bpos, data) in block:
             if data is None:
                 continue
@@ -146,33 +323,33 @@ class MMU():
                 (ok, pos, res) = self.readEntry(oldtmp, pos)
                 if ok:
                     datas.append(res)
-                tablepos = preindex
+                items += 1
+                if items >= tablesize:
+                    break
+                index = preindex
+                preindex = 0
 
             datalen = len(data)
-            l = int(datalen / 4 - 1)
-            index = tablepos % 0x1000
-            for item in xrange(l):
+            while index <= datalen - 4:
                 tmp = data[index] + (data[index+1] << 8) + (data[index+2] << 16) + (data[index+3] << 24)
                 (ok, pos, res) = self.readEntry(tmp, pos)
                 if ok:
                     datas.append(res)
                 index += 4
-                items += 4
-                if index > datalen - 4:
-                    miss = datalen - index
-                    preindex = 0
-
-                    # Check if we didn't read all the data...
-                    if miss > 0:
-                        oldtmp = data[index]
-                        if miss > 1:
-                            oldtmp += (data[index+1] << 8)
-                        if miss > 2:
-                            oldtmp += (data[index+2] << 16)
-                        preindex = 4 - miss
-                    break
-                if items > (tablesize + tablepos):
-                    break
+                items += 1
+                if items >= tablesize:
+                    return datas
+
+            # Check if we didn't read all the data...
+            miss = datalen - index
+            if miss > 0:
+                oldtmp = data[index]
+                if miss > 1:
+                    oldtmp += (data[index+1] << 8)
+                if miss > 2:
+                    oldtmp += (data[index+2] << 16)
+                preindex = 4 - miss
+            index = 0
         return datas
 
         """
@@ -210,12 +387,12 @@ class MMU():
         (False, 0, (0, execute=False,ok=False,size=4,size1=False,size2=False,subtable=False,userspace=False,write=False, 0))
         """
         if data > 0:
-            flags = MMU.Flags(data & 0xFFF)
+            flags = MMU.Flags.lookup(data)
             vaddr = data & 0xFFFFF000
             ok = True
         else:
             vaddr = 0
-            flags = MMU.Flags(data & 0xFFF)
+            flags = MMU.Flags.lookup(data)
             ok = False
             return (ok, pos, (vaddr, flags, pos))
 
@@ -280,13 +457,7 @@ class MMU():
         ...
         IndexError: No page mapped at virtual: 00000000
         """
-        for item in self._table:
-            (a, b, c) = self.getRange(item)
-            if a <= pos and pos < b:
-                index = (pos - a)
-                phys = c + index
-                return phys
-        raise IndexError('No page mapped at virtual: %.8X' % (pos))
+        return self.translate(pos)[0]
 
     def getPageFlags(self, pos):
         """ Get flags at position
@@ -338,11 +509,7 @@ class MMU():
         if not self._enabled:
             return None
 
-        for item in self._table:
-            (a, b, c) = self.getRange(item)
-            if a <= pos and pos < b:
-                return item[1]
-        raise IndexError('No page mapped at virtual: %.8X' % (pos))
+        return self.translate(pos)[1]
 
     def setData(self, pos, data, size=4):
         """ Set data, if MMU enabled, solve physical locations first
@@ -421,6 +588,33 @@ class MMU():
         else:
             return self._mem.getData(pos, size)
 
+    def read32(self, pos):
+        """ Read 32 bit word, if MMU enabled, solve physical location first
+
+        >>> from primitives import Mem
+        >>> m = Mem(1024*100, flat=True)
+        >>> u = MMU(m)
+        >>> # Page, virtual start at 24k, size 4k
+        >>> m.setData(10, 0x00006100, 4)
+        >>> tmp = u.initialize(10, 1)
+        >>> u.enable()
+        >>> u.write32(0x6010, 0x12345678)
+        >>> m.read32(0x10) == 0x12345678
+        True
+        >>> u.read32(0x6010) == 0x12345678
+        True
+        """
+        if self._enabled:
+            pos = self.translate(pos)[0]
+        return self._mem.read32(pos)
+
+    def write32(self, pos, data):
+        """ Write 32 bit word, if MMU enabled, solve physical location first
+        """
+        if self._enabled:
+            pos = self.translate(pos)[0]
+        self._mem.write32(pos, data)
+
     def setRaw(self, pos, data):
         """ Set one byte, if MMU enabled, solve physical location first
 
@@ -469,15 +663,55 @@ class MMU():
         else:
             return self._mem.getRaw(pos)
         
-    class Flags:
+    class Flags(object):
+        """ Page entry flags, stored as a bitmask
+        """
+        SUBTABLE = 0x1
+        EXECUTE = 0x2
+        WRITE = 0x4
+        USERSPACE = 0x8
+        SIZE1 = 0x10
+        SIZE2 = 0x20
+        OK = 0x100
+
+        _bits = {
+            'subtable': SUBTABLE,
+            'execute': EXECUTE,
+            'write': WRITE,
+            'userspace': USERSPACE,
+            'size1': SIZE1,
+            'size2': SIZE2,
+            'ok': OK,
+            }
+        # Page sizes in kilobytes indexed by size bits
+        _sizes = (4, 64, 1024, 1024 * 64)
+
+        __slots__ = ('bits', 'size')
+
         def __init__(self, flags=0, solved=None):
             """ Initialize flags
             """
-            self._flags = flags
             if solved is None:
-                self._data = self.solveFlags(flags)
+                self.solveFlags(flags)
             else:
-                self._data = solved
+                bits = 0
+                for (name, bit) in self._bits.items():
+                    if solved.get(name, False):
+                        bits |= bit
+                self.solveFlags(bits)
+                if 'size' in solved:
+                    self.size = solved['size']
+
+        @staticmethod
+        def lookup(flags):
+            """ Get shared flags object for number data
+
+            >>> MMU.Flags.lookup(0x112) is MMU.Flags.lookup(0x112)
+            True
+            >>> MMU.Flags.lookup(0x112)
+            execute=True,ok=True,size=64,size1=True,size2=False,subtable=False,userspace=False,write=False
+            """
+            return MMU.Flags._interned[flags & 0xFFF]
 
         def solveFlags(self, flags):
             """ Solve flags from given number data
@@ -514,47 +748,14 @@ class MMU():
             >>> f
             execute=True,ok=True,size=67108864,size1=True,size2=True,subtable=True,userspace=True,write=True
             """
-            data = {
-                'subtable': False,
-                'execute': False,
-                'write': False,
-                'userspace': False,
-                'size': 0,
-                'size1': False,
-                'size2': False,
-                'ok': False,
-                }
-                #'size3': False,
-            if flags & 0x1 == 0x1:
-                data['subtable'] = True
-            if flags & 0x2 == 0x2:
-                data['execute'] = True
-            if flags & 0x4 == 0x4:
-                data['write'] = True
-            if flags & 0x8 == 0x8:
-                data['userspace'] = True
-            if flags & 0x10 == 0x10:
-                data['size1'] = True
-            if flags & 0x20 == 0x20:
-                data['size2'] = True
-            if flags & 0x100 == 0x100:
-                data['ok'] = True
-
+            self.bits = flags
             # Determine page size in kilobytes
-            if not data['size1'] and not data['size2']:
-                data['size'] = 4
-            elif data['size1'] and not data['size2']:
-                data['size'] = 64
-            elif not data['size1'] and data['size2']:
-                data['size'] = 1024
-            elif data['size1'] and data['size2']:
-                data['size'] = 1024 * 64
+            size = self._sizes[(flags >> 4) & 0x3]
             # For subtables multiply by 1024
-            if data['subtable']:
-                data['size'] *= 1024
-
-            self._data = data
-            return data
+            if flags & self.SUBTABLE:
+                size *= 1024
+            self.size = size
+            return self.dump()
 
         def isSet(self, name):
             """ Checks whether element is set, or get value
@@ -569,34 +770,42 @@ class MMU():
             >>> f.isSet('subtable')
             True
             """
-            if not name in self._data:
+            res = self[name]
+            if res is None:
                 return False
+            return res
 
-            return self._data[name]
-    
         def __getitem__(self, name):
-            if not name in self._data:
+            if name == 'size':
+                return self.size
+            bit = self._bits.get(name, None)
+            if bit is None:
                 return None
 
-            return self._data[name]
+            return self.bits & bit == bit
 
         def dump(self):
             """ Dumps the flag status
             """
-            return self._data
+            data = {'size': self.size}
+            for name in self._bits:
+                data[name] = self[name]
+            return data
 
         def __repr__(self):
             """ Get string representation of the flags
             """
-            #return "%s" % self.dump()
-            a = self._data.keys()
+            data = self.dump()
             res = ''
-            for k in sorted(a):
+            for k in sorted(data.keys()):
                 if res:
                     res += ','
-                res += '%s=%s' % (k, self._data[k])
+                res += '%s=%s' % (k, data[k])
             return res
 
+# All possible flag values, shared by page table entries
+MMU.Flags._interned = tuple([MMU.Flags(x) for x in xrange(0x1000)])
+
 """
 MMU
 
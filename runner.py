@@ -1,91 +1,168 @@
 #!/usr/bin/env python
 
+import argparse
+import mmap
+import os
+import struct
 import sys
 
 from primitives import Mem
 from primitives import ALU
-from primitives import Clock
+from primitives import VirtualClock
 from cpus import RISC1
+from cpus import OpcodeProfiler
+from cpus import PCProfiler
+from cpus import SymbolTable
+from cpus import TraceRecorder
+from cpus import MemStats
 from sysio import Terminal
 
 if sys.version >= '3':
     xrange = range
 
-def fileLoad(fname):
-    if fname == '':
-        f = sys.stdin
-    else:
-        f = open(fname, 'rb')
-    header_size = 12
-    header = f.read(header_size)
-    if header[:4] != b'RE01':
-        f.close()
-        return None
+# RE01 header: magic, data section position, data base address
+header = struct.Struct('<4sII')
 
-    tmp = header[4:8]
-    datapos = 0
-    for i in reversed(tmp):
-        if sys.version < '3':
-            datapos |= ord(i)
-        else:
-            datapos |= i
-        datapos <<= 8
-    datapos >>= 8
-
-    tmp = header[8:]
-    basepos = 0
-    for i in reversed(tmp):
-        if sys.version < '3':
-            basepos |= ord(i)
-        else:
-            basepos |= i
-        basepos <<= 8
-    basepos >>= 8
+def imageLoad(image):
+    """ Split RE01 image to code and data
+    @param image Bytes, or anything else supporting slicing and buffer protocol
+    @returns Tuple (code, data, base) or None if not valid image
+    """
+    if len(image) < header.size or image[:4] != b'RE01':
+        return None
 
-    code = f.read(datapos - header_size)
-    data = f.read()
-    f.close()
+    (magic, datapos, basepos) = header.unpack_from(image, 0)
+    code = image[header.size:datapos]
+    data = image[datapos:]
 
     return (code, data, basepos)
 
+def fileLoad(fname):
+    if fname == '':
+        # Binary stdin on Python 3
+        f = getattr(sys.stdin, 'buffer', sys.stdin)
+        return imageLoad(f.read())
+
+    f = open(fname, 'rb')
+    try:
+        try:
+            image = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # Empty files and pipes can't be mapped
+            return imageLoad(f.read())
+        try:
+            return imageLoad(image)
+        finally:
+            image.close()
+    finally:
+        f.close()
+
 def moveToMem(mem, data, i=None):
     if i is None:
         i = 0
-    for c in data:
-        mem.setRaw(i, c)
-        i += 1
+    mem.setBytes(i, data)
 
-def main():
-    if len(sys.argv) > 1:
-        fname = sys.argv[1]
-    else:
-        fname = ''
-    (code, data, base) = fileLoad(fname)
-
-    mainmem = Mem(len(code) + len(data))
+def setupMachine(code, data, base, echo=True):
+    """ Create machine with image loaded and devices attached
+    @param echo Print terminal when guest requests it
+    @returns Tuple (cpu, terminal, clock), clock is started
+    """
+    mainmem = Mem(len(code) + len(data), flat=True)
     moveToMem(mainmem, code)
     mainmem.enlarge(base - len(code) + mainmem.getSize())
     moveToMem(mainmem, data, base)
 
     term = Terminal()
-    term.setBase(0x8010)
-
-    mainmem.addSpecial(0x8000, None, term.setControl)
-    mainmem.addSpecial(0x8001, None, term.setControl)
-    mainmem.addSpecial(0x8002, None, term.setControl)
-    mainmem.addSpecial(0x8003, None, term.setControl)
-    for i in xrange(100):
-        mainmem.addSpecial(0x8010 + i, term.getData, term.setData)
+    term.echo = echo
+    mainmem.addDevice(0x8000, term.getIOSize(), term)
 
     cpu = RISC1(mainmem, ALU())
-    clock = Clock(hz=1000, callfunc=cpu.raiseInterrupt, params=1)
-    clock.start()
+    clock = VirtualClock(cycles=10000, callfunc=cpu.raiseInterrupt, params=1)
+    clock.start(cpu.cycle)
+    cpu.addTimer(clock)
+
+    return (cpu, term, clock)
+
+def imageMachine(image, echo=True):
+    """ Create machine from assembled image, see assembler.assembleSource
+    @returns Tuple (cpu, terminal, clock)
+    """
+    return setupMachine(image.code, image.data, image.base, echo)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run RE01 binary')
+    parser.add_argument('fname', nargs='?', default='', help='Binary to run, default is stdin')
+    parser.add_argument('-p', '--profile', action='store_true', help='Print opcode profile to stderr')
+    parser.add_argument('--profile-json', default=None, help='Write opcode profile as JSON to file')
+    parser.add_argument('--hot', type=int, default=None, metavar='N', help='Print N hottest PCs and loops to stderr')
+    parser.add_argument('--callgraph', default=None, help='Write cycles per call stack in collapsed stack format to file')
+    parser.add_argument('--symbols', default=None, help='Symbol file from assembler, default is binary name with .sym extension')
+    parser.add_argument('--trace', default=None, help='Write binary execution trace to file, see tracedump.py')
+    parser.add_argument('--trace-last', type=int, default=None, metavar='N', help='Keep only last N instructions in trace')
+    parser.add_argument('--memstats', default=None, help='Write per page memory statistics to file, CSV if name ends with .csv, otherwise JSON')
+    parser.add_argument('--memstats-interval', type=int, default=10000, metavar='CYCLES', help='Working set sampling interval')
+    args = parser.parse_args()
+    if args.trace_last is not None and args.trace is None:
+        parser.error('Give trace file with --trace')
+
+    (code, data, base) = fileLoad(args.fname)
+
+    (cpu, term, clock) = setupMachine(code, data, base)
+    profiler = None
+    if args.profile or args.profile_json is not None:
+        profiler = OpcodeProfiler(cpu)
+    pcprofiler = None
+    if args.hot is not None or args.callgraph is not None:
+        symfile = args.symbols
+        if symfile is None and args.fname:
+            symfile = os.path.splitext(args.fname)[0] + '.sym'
+            if not os.path.isfile(symfile):
+                symfile = None
+        symbols = None
+        if symfile is not None:
+            symbols = SymbolTable.load(symfile)
+        pcprofiler = PCProfiler(cpu, symbols)
+    memstats = None
+    if args.memstats is not None:
+        memstats = MemStats(args.memstats_interval, cpu=cpu)
+    tracer = None
+    tracefile = None
+    if args.trace is not None:
+        if args.trace_last is not None:
+            tracer = TraceRecorder(args.trace_last, cpu=cpu)
+        else:
+            tracefile = open(args.trace, 'wb')
+            tracer = TraceRecorder(64*1024, tracefile, cpu=cpu)
     try:
         cpu.start()
-    except:
+    finally:
         clock.stop()
-        raise
-    clock.stop()
+        if memstats is not None:
+            memstats.detach()
+            memstats.save(args.memstats)
+        # Trace is most useful after a fault
+        if tracer is not None:
+            tracer.detach()
+            if tracefile is not None:
+                tracefile.close()
+            else:
+                tracer.save(args.trace)
+
+    if profiler is not None:
+        profiler.detach()
+        if args.profile:
+            sys.stderr.write(profiler.report() + '\n')
+        if args.profile_json is not None:
+            with open(args.profile_json, 'w') as f:
+                f.write(profiler.toJSON() + '\n')
+
+    if pcprofiler is not None:
+        pcprofiler.detach()
+        if args.hot is not None:
+            sys.stderr.write(pcprofiler.report(args.hot) + '\n')
+        if args.callgraph is not None:
+            with open(args.callgraph, 'w') as f:
+                f.write(pcprofiler.collapsed())
 
 if __name__ == "__main__":
     main()
@@ -1,4 +1,13 @@
+import sys
+
+if sys.version >= '3':
+    xrange = range
+
 class Terminal:
+    # Memory mapped layout: control bytes at start, screen from screen_offset
+    control_size = 4
+    screen_offset = 0x10
+
     def __init__(self):
         self.screen = []
         self.width = 80
@@ -6,6 +15,8 @@ class Terminal:
         self.base = 0
         self.resize()
         self.control = None
+        # Print screen when requested by guest
+        self.echo = True
 
     def setBase(self, base):
         self.base = base
@@ -26,7 +37,8 @@ class Terminal:
             self.height = 0
         elif data & 0xFF == 0x01:
             self.control = 'print'
-            self.printScreen()
+            if self.echo:
+                self.printScreen()
         else:
             if self.control == 'height':
                 self.height <<= 8
@@ -49,16 +61,58 @@ class Terminal:
             return self.screen[pos]
         return None
 
+    def getIOSize(self):
+        """ Size of memory mapped range for current screen size
+        """
+        return self.screen_offset + self.width * self.height
+
+    def ioWrite(self, offset, size, value):
+        """ Memory mapped write, bytes are handled in little endian order
+        """
+        for i in xrange(size):
+            data = (value >> (8 * i)) & 0xFF
+            pos = offset + i
+            if pos < self.control_size:
+                self.setControl(pos, data)
+            elif pos >= self.screen_offset:
+                pos -= self.screen_offset
+                if pos < len(self.screen):
+                    self.screen[pos] = data
+
+    def ioRead(self, offset, size):
+        """ Memory mapped read, control bytes read as zero
+        """
+        res = 0
+        for i in xrange(size):
+            pos = offset + i - self.screen_offset
+            if pos >= 0 and pos < len(self.screen):
+                res |= self.screen[pos] << (8 * i)
+        return res
+
     def getScreen(self):
         return self.screen
 
-    def printScreen(self):
-        print ('==== Terminal ====')
+    def getLines(self):
+        """ Get screen contents as text lines
+
+        >>> t = Terminal()
+        >>> t.ioWrite(t.screen_offset, 2, 0x6948)
+        >>> t.getLines()[0].rstrip()
+        'Hi'
+        >>> len(t.getLines())
+        24
+        """
+        lines = []
         tmp = self.screen
         while tmp:
             line = tmp[:self.width]
             tmp = tmp[self.width:]
             s = ''.join([chr(i) for i in line])
-            s = s.replace('\x00',' ')
-            print (s)
+            lines.append(s.replace('\x00',' '))
+        return lines
+
+    def printScreen(self):
+        print ('==== Terminal ====')
+        for line in self.getLines():
+            print (line)
         print ('==================')
@@ -5,9 +5,4 @@ if [ ! -e tests ] ; then
 	exit 1
 fi
 
-mkdir -p tests/output
-ls tests/*.asm | while read p
-do
-	name=$(basename "$p" .asm)
-	python assembler.py "$p" "tests/output/$name.bin"
-done
+python assembler.py --cache .asmcache -s -d tests/output tests/*.asm
@@ -5,8 +5,4 @@ if [ ! -d "tests/output" ] ; then
 	exit 1
 fi
 
-ls tests/output/*.bin | while read p
-do
-	echo "*** Running $p"
-	python runner.py "$p"
-done
+python batchrun.py "$@" "tests/output/*.bin"
@@ -0,0 +1,10 @@
+#!/bin/bash
+
+baseline="bench/baseline.json"
+
+if [ -e "$baseline" ] ; then
+	python bench/bench.py -b "$baseline" "$@"
+else
+	echo "No baseline yet, saving results to $baseline"
+	python bench/bench.py -o "$baseline" "$@"
+fi
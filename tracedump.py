@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import sys
+
+from cpus import Opcodes
+from cpus import SymbolTable
+from cpus.tracer import formatRecord
+from cpus.tracer import readTrace
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode and disassemble RT01 execution trace')
+    parser.add_argument('trace', help='Trace file written by runner.py --trace')
+    parser.add_argument('-s', '--symbols', default=None, help='Symbol file from assembler')
+    parser.add_argument('-n', '--last', type=int, default=None, help='Show only last N records')
+    parser.add_argument('--pc', default=None, help='Show only records at given hex address')
+    args = parser.parse_args()
+
+    symbols = None
+    if args.symbols is not None:
+        symbols = SymbolTable.load(args.symbols)
+    pc = None
+    if args.pc is not None:
+        pc = int(args.pc, 16)
+
+    f = open(args.trace, 'rb')
+    try:
+        records = readTrace(f)
+        if pc is not None:
+            records = (rec for rec in records if rec[0] == pc)
+        if args.last is not None:
+            records = collections.deque(records, args.last)
+        opcodes = Opcodes()
+        out = sys.stdout
+        for rec in records:
+            out.write(formatRecord(rec, opcodes, symbols) + '\n')
+    except ValueError as e:
+        sys.stderr.write('%s: %s\n' % (args.trace, e))
+        sys.exit(1)
+    finally:
+        f.close()
+
+if __name__ == "__main__":
+    main()